@@ -14,6 +14,8 @@ from app.auth import auth, user_datastore, security, mail
 from app.views import views
 from app.api import api, sock
 from app.admin import admin
+from app.ledger import ledger_cli
+from app.rollups import rollups_cli
 
 
 def create_app(test_config=None):
@@ -37,6 +39,9 @@ def create_app(test_config=None):
     app.register_blueprint(api, url_prefix='/api')
     app.register_blueprint(admin, url_prefix='/admin')
 
+    app.cli.add_command(ledger_cli)
+    app.cli.add_command(rollups_cli)
+
     @app.route('/manifest.json')
     def manifest():
         return send_from_directory('static', 'manifest.json')
@@ -77,6 +82,8 @@ def create_app(test_config=None):
     security.init_app(app, user_datastore)
     mail.init_app(app)
 
+    app.config.setdefault('REDIS_URL', 'redis://localhost:6379')
+
     app.config.from_mapping(
         CELERY=dict(
             broker_url="redis://localhost",
@@ -9,11 +9,11 @@ from app.auth import user_datastore
 from app.models import User, Role, WashingCycle, ScheduleEvent, WashingMachine, CeleryTask, Notification
 from app.forms import EditProfileForm, EditRolesForm, UpdateWashingMachineForm, AdminSettings
 from app.statistics import (calculate_unpaid_cycles_cost, admin_users_usage_statistics, calculate_energy_usage,
-                            users_unpaid_cycles_cost_statistics)
+                            users_unpaid_cycles_cost_statistics, shift_month)
 from app.functions import (delete_user, recalculate_cycles_cost, trigger_relay, get_washer_info, admin_stop_cycle,
-                           admin_start_cycle, send_push_to_all)
-from app.tasks import recalculate_cycles_cost_task
+                           admin_start_cycle, queue_push_to_all, get_cycles_page)
 from app.candy import CandyWashingMachine
+from app.machine import get_machine_config, get_active_cycle
 
 admin = Blueprint('admin', __name__)
 
@@ -28,7 +28,10 @@ def handle_admin_stop():
                 pass
             return redirect(request.path)
         elif request.form.get('admin_start') is not None:
-            recalculate_cycles_cost_task()
+            try:
+                CeleryTask.start_recalculate_cycles_cost_task()
+            except RuntimeError as e:
+                flash(f'Error! {e}', 'toast-error')
             return redirect(request.path)
 
 
@@ -37,7 +40,7 @@ def handle_admin_stop():
 @roles_required('admin')
 def index():
     update_wm_form = UpdateWashingMachineForm()
-    washing_machine = WashingMachine.query.first()
+    washing_machine = get_machine_config()
 
     if update_wm_form.update_washing_machine_submit.data and update_wm_form.validate_on_submit():
         if update_wm_form.update_washing_machine_submit.data:
@@ -47,6 +50,7 @@ def index():
                 flash('Nothing to update', 'toast-info')
                 return redirect(request.path)
 
+            washing_machine = db.session.get(WashingMachine, washing_machine.id)
             if update_wm_form.costperkwh.data and update_wm_form.costperkwh.data != washing_machine.costperkwh:
                 washing_machine.costperkwh = update_wm_form.costperkwh.data
                 try:
@@ -60,7 +64,8 @@ def index():
                 flash('Public wash cost updated successfully', 'toast-success')
             db.session.commit()
         elif update_wm_form.cancel_recalculation_unpaid_cycles.data:
-            if recalculation_task := CeleryTask.query.filter_by(kind=CeleryTask.TaskKinds.RECALCULATE_CYCLES_COST).first():
+            recalculation_task = CeleryTask.query.filter_by(kind=CeleryTask.TaskKinds.RECALCULATE_CYCLES_COST).first()
+            if recalculation_task and (recalculation_task.payload or {}).get('step') != 'done':
                 recalculation_task.terminate()
                 flash('Recalculation task terminated successfully', 'toast-success')
             else:
@@ -82,8 +87,7 @@ def index():
 
     if 'relay' in request.args:
         if mode := request.args.get('relay'):
-            washing_cycle = WashingCycle.query.filter_by(end_timestamp=None).first()
-            if washing_cycle:
+            if get_active_cycle():
                 flash('Cannot trigger relay while washing cycle is in progress', 'toast-error')
             elif trigger_relay(mode) != 200:
                 current_app.logger.error("Request to turn on the relay through Shelly Cloud API FAILED!")
@@ -106,18 +110,19 @@ def index():
 
     if admin_settings.admin_settings_submit.data and admin_settings.validate_on_submit():
         print('Admin settings update...')
+        washing_machine = db.session.get(WashingMachine, washing_machine.id)
         washing_machine.global_shutdown = admin_settings.kill_switch.data
         if washing_machine.require_scheduling != admin_settings.require_scheduling.data:
             washing_machine.require_scheduling = admin_settings.require_scheduling.data
             if washing_machine.require_scheduling:
-                send_push_to_all(Notification(
+                queue_push_to_all(Notification(
                     title='Scheduling requirement is now active!',
                     body='Scheduling is now required for washing cycles. Please check the schedule page for available '
                          'timeslots.',
                     icon='android-chrome-512x512.png'
                 ))
             else:
-                send_push_to_all(Notification(
+                queue_push_to_all(Notification(
                     title='Scheduling requirement is now disabled!',
                     body='Scheduling is no longer required for washing cycles. You can now start a cycle at any time.',
                     icon='android-chrome-512x512.png'
@@ -142,7 +147,8 @@ def index():
         relay_temperature=washing_machine_info['relay_temperature'],
         relay_wifi_rssi=washing_machine_info['relay_wifi_rssi'],
         admin_settings=admin_settings,
-        users_unpaid_cycles_cost=json.dumps(users_unpaid_cycles_cost_statistics())
+        users_unpaid_cycles_cost=json.dumps(users_unpaid_cycles_cost_statistics()),
+        recalculation_task=CeleryTask.query.filter_by(kind=CeleryTask.TaskKinds.RECALCULATE_CYCLES_COST).first()
     )
 
 
@@ -281,17 +287,17 @@ def users_view():
 @login_required
 @roles_required('admin')
 def cycles_view():
-    cycles = WashingCycle.query.order_by(WashingCycle.start_timestamp.desc()).limit(1000).all()
-    for cycle in cycles:
-        cycle.start_timestamp_formatted = cycle.start_timestamp.strftime("%d-%m-%Y %H:%M:%S")
-        if cycle.end_timestamp:
-            cycle.end_timestamp_formatted = cycle.end_timestamp.strftime("%d-%m-%Y %H:%M:%S")
-            cycle.duration = str(cycle.end_timestamp - cycle.start_timestamp).split('.')[0]
+    try:
+        cycles = get_cycles_page(cursor=request.args.get('cursor'))
+    except ValueError:
+        flash('Invalid page', category='toast-error')
+        return redirect(request.path)
 
     return render_template(
         'admin/cycles.html',
         is_cycles=True,
-        cycles=cycles
+        cycles=cycles.items,
+        next_cursor=cycles.next_cursor
     )
 
 
@@ -303,7 +309,7 @@ def schedule_view():
     start_date = datetime.datetime(year=current_date.year, month=current_date.month, day=1)
     events = ScheduleEvent.query.filter(
         ScheduleEvent.start_timestamp >= start_date,
-        ScheduleEvent.start_timestamp <= start_date + datetime.timedelta(days=31)
+        ScheduleEvent.start_timestamp < shift_month(start_date, 1)
     ).all()
 
     events_json = []
@@ -1,10 +1,10 @@
 import os, json, time, datetime
-from requests.exceptions import RequestException
 
 from sqlalchemy.exc import OperationalError
 from itsdangerous import URLSafeTimedSerializer
 
-from flask import Blueprint, request, make_response, current_app, render_template, session, url_for
+from flask import Blueprint, Response, request, current_app, render_template, session, url_for
+from flask import stream_with_context
 from flask_security import login_required, roles_required, current_user
 from flask_security.utils import hash_password
 from flask_sock import Sock
@@ -12,14 +12,22 @@ from flask_sock import Sock
 from app.db import db
 from app.auth import user_datastore
 
-from app.models import User, WashingMachine, PushSubscription, WashingCycle, NotificationURL, ScheduleEvent, CeleryTask
+from app.models import User, WashingMachine, WashingCycle, NotificationURL, ScheduleEvent, CeleryTask
 from app.functions import send_push_to_all, send_push_to_user, get_realtime_current_usage, get_running_time
 from app.functions import get_washer_info, get_relay_temperature, get_relay_wifi_rssi
+from app.functions import get_usage_page, get_cycles_page, get_payments_page, mark_cycles_paid
+from app.pagination import page_json
+from app.push import register_push_subscription
+from app.export import export_cycles_rows, iter_csv, iter_ndjson, parse_export_date
 from app.candy import CandyWashingMachine
+from app.telemetry import subscribe_telemetry, TelemetryDeltaEncoder
+from app.statistics import get_statistics_cache
 
 api = Blueprint('api', __name__)
 sock = Sock()
 
+MAX_PAGE_SIZE = 100
+
 
 @api.errorhandler(OperationalError)
 def handle_db_error(error):
@@ -64,8 +72,7 @@ def reset_password():
 @api.route('/update_usage', methods=['PATCH'])
 def update_usage():
     if os.getenv('FLASK_API_SECRET_KEY') == request.headers.get('Authorization').split(' ')[1]:
-        washing_machine = WashingMachine.query.first()
-        washing_machine.currentkwh = request.args.get('currentkwh')
+        db.session.execute(db.update(WashingMachine).values(currentkwh=request.args.get('currentkwh')))
         db.session.commit()
         return {'status': 'success'}
     return {'status': 'invalid authenticator'}
@@ -74,21 +81,62 @@ def update_usage():
 @api.route('/get_usage', methods=['GET'])
 @login_required
 def get_usage():
-    return {'currentkwh': WashingMachine.query.first().currentkwh}
+    return {'currentkwh': db.session.query(WashingMachine.currentkwh).limit(1).scalar()}
+
+
+def page_response(get_page, *args):
+    """ Returns a JSON page of the listing, limited by the limit and cursor arguments of the request. """
+    limit = min(request.args.get('limit', 20, type=int), MAX_PAGE_SIZE)
+    try:
+        return page_json(get_page(*args, limit=max(limit, 1), cursor=request.args.get('cursor')))
+    except ValueError:
+        return {'error': 'invalid cursor'}, 400
+
+
+@api.route('/usage', methods=['GET'])
+@login_required
+def usage():
+    return page_response(get_usage_page, current_user)
+
+
+@api.route('/cycles', methods=['GET'])
+@login_required
+@roles_required('admin')
+def cycles():
+    return page_response(get_cycles_page)
+
+
+@api.route('/payments', methods=['GET'])
+@login_required
+@roles_required('room_owner')
+def payments():
+    return page_response(get_payments_page)
+
+
+@api.route('/mark_paid', methods=['POST'])
+@login_required
+def mark_paid():
+    cycle_ids = (request.get_json(silent=True) or {}).get('cycle_ids')
+    if not isinstance(cycle_ids, list) or not cycle_ids or \
+            not all(isinstance(cycle_id, int) and not isinstance(cycle_id, bool) for cycle_id in cycle_ids):
+        return {'error': 'invalid args'}, 400
+    payment = mark_cycles_paid(current_user, cycle_ids)
+    return {
+        'outcomes': [{'cycle_id': cycle_id, 'outcome': outcome} for cycle_id, outcome in payment.outcomes.items()],
+        'amount': str(payment.amount)
+    }
 
 
 @api.route('/push_subscriptions', methods=['POST'])
 @login_required
 def push_subscriptions():
     json_data = request.get_json()
-    subscription = PushSubscription.query.filter_by(subscription_json=json_data['subscription_json']).first()
-    if subscription is None:
-        subscription = PushSubscription(
-            subscription_json=json_data['subscription_json'],
-            user_id=json_data['user_id']
-        )
-        db.session.add(subscription)
-        db.session.commit()
+    try:
+        register_push_subscription(json_data['subscription_json'], json_data['user_id'],
+                                   request.headers.get('User-Agent'))
+    except ValueError:
+        return {'error': 'invalid subscription'}, 400
+    db.session.commit()
     return {"status": "success"}
 
 
@@ -157,34 +205,43 @@ def ws_washing_machine_info(ws):
     else:
         shelly = True
 
-    while True:
-        try:
-            ws.send(json.dumps(get_washer_info(shelly)))
-            time.sleep(1)
-        except RequestException as ex:
-            current_app.logger.error(f'Error fetching washing machine info. Error: {ex}')
-            return
+    encoder = TelemetryDeltaEncoder()
+    for state in subscribe_telemetry():
+        washer_info = state['washer']
+        if not shelly:
+            washer_info = {'cycle_start': washer_info['cycle_start']}
+        if message := encoder.encode(washer_info):
+            ws.send(message)
 
 
 @api.route('/export_washing_cycles.csv', methods=['GET'])
+@api.route('/export_washing_cycles.ndjson', methods=['GET'])
 @login_required
 @roles_required('admin')
 def export_washing_cycles():
-    query = WashingCycle.query.filter(WashingCycle.end_timestamp.is_not(None))
-    if request.args.get('count'):
-        query.limit(request.args.get('count'))
+    try:
+        rows = export_cycles_rows(
+            start=parse_export_date(request.args.get('start')),
+            end=parse_export_date(request.args.get('end')),
+            user_id=request.args.get('user_id', type=int),
+            count=request.args.get('count', type=int)
+        )
+    except ValueError:
+        return {'error': 'invalid args'}, 400
+
+    if request.path.endswith('.ndjson'):
+        return Response(stream_with_context(iter_ndjson(rows)), mimetype='application/x-ndjson',
+                        headers={'Content-Disposition': 'attachment'})
+    return Response(stream_with_context(iter_csv(rows, excel=bool(request.args.get('excel')))), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment'})
 
-    cycles: list[WashingCycle] = query.order_by(WashingCycle.start_timestamp.desc()).all()
 
-    csv = 'id,user,date,used_kwh,cost\n'
-    for cycle in cycles:
-        csv += f'{cycle.id},{cycle.user_id},{cycle.start_timestamp.strftime("%Y-%m-%d")},{cycle.endkwh - cycle.startkwh},{cycle.cost}\n'
-    if request.args.get('excel'):
-        csv = csv.replace(',', ';').replace('.', ',')
-    output = make_response(csv)
-    output.headers["Content-Disposition"] = "attachment"
-    output.headers["Content-type"] = "text/csv"
-    return output
+@api.route('/statistics/cache', methods=['GET'])
+@login_required
+@roles_required('admin')
+def statistics_cache():
+    cache = get_statistics_cache()
+    return {**cache.counters, 'version': cache.version()}
 
 
 @api.route('/get_candy_data', methods=['GET'])
@@ -198,15 +255,15 @@ def get_candy_data():
 @sock.route('/api/candy_data')
 @login_required
 def ws_candy_data(ws):
-    interval = 60
-    if request.args.get('interval'):
-        interval = int(request.args.get('interval'))
-
-    machine = CandyWashingMachine()
-    while True:
-        ws.send(machine.json())
-        time.sleep(interval)
-        machine.update()
+    # The Candy sample is sent right away, then whenever it changes and at least every interval seconds
+    interval = request.args.get('interval', 60, type=int)
+    last_candy, last_sent = None, None
+    for state in subscribe_telemetry():
+        if (candy := state.get('candy')) is None:
+            continue
+        if candy != last_candy or time.monotonic() - last_sent >= interval:
+            ws.send(json.dumps(candy))
+            last_candy, last_sent = candy, time.monotonic()
 
 
 @api.route('/schedule_events', methods=['POST'])
@@ -0,0 +1,89 @@
+import os
+import time
+import threading
+from typing import Callable, Optional
+
+import redis
+from flask import current_app
+
+
+def get_redis() -> redis.Redis:
+    """ Returns the Redis client of the current app, creating it on first use. """
+    if 'redis' not in current_app.extensions:
+        current_app.extensions['redis'] = redis.Redis.from_url(current_app.config['REDIS_URL'])
+    return current_app.extensions['redis']
+
+
+class BroadcastCache:
+    """
+    Process-wide cache of a single value which is read far more often than it changes. Writers call publish()
+    after committing a change, which drops the value locally and broadcasts over Redis pub/sub, so every web and
+    Celery process reloads it on the next read. Without Redis, e.g. when testing, the value expires after ttl seconds.
+    """
+    _unset = object()
+
+    def __init__(self, channel: str, load: Callable, ttl: int = 5):
+        self.channel = channel
+        self.load = load
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._value = self._unset
+        self._expires = 0.0
+        self._generation = 0
+        self._listener: Optional[threading.Thread] = None
+        self._listener_pid: Optional[int] = None
+
+    def _redis(self) -> Optional[redis.Redis]:
+        if current_app.testing or current_app.debug:
+            return None
+        return get_redis()
+
+    def _listen(self) -> bool:
+        """ Subscribes to the invalidation channel once per process, returns whether the subscription is alive. """
+        if self._listener is not None and self._listener_pid == os.getpid() and self._listener.is_alive():
+            return True
+        if (redis_client := self._redis()) is None:
+            return False
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self.handle_message})
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+            self._listener_pid = os.getpid()
+            # Invalidations published while there was no subscription are lost, so the cached value is not trusted
+            self.invalidate()
+            return True
+        except redis.RedisError as e:
+            current_app.logger.warning(f'Cache of {self.channel} falls back to a TTL. Error: {e}')
+            return False
+
+    def handle_message(self, message: dict):
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._value = self._unset
+            self._generation += 1
+
+    def get(self):
+        listening = self._listen()
+        with self._lock:
+            if self._value is not self._unset and (listening or self._expires > time.monotonic()):
+                return self._value
+            generation = self._generation
+
+        value = self.load()
+        with self._lock:
+            # Do not keep a value loaded before an invalidation which arrived in the meantime
+            if generation == self._generation:
+                self._value = value
+                self._expires = time.monotonic() + self.ttl
+        return value
+
+    def publish(self):
+        """ Drops the cached value in this and, through Redis, every other process. """
+        self.invalidate()
+        if (redis_client := self._redis()) is not None:
+            try:
+                redis_client.publish(self.channel, 'invalidate')
+            except redis.RedisError as e:
+                current_app.logger.warning(f'Failed to broadcast the change of {self.channel}. Error: {e}')
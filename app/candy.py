@@ -1,6 +1,5 @@
 import os
 import json
-import requests
 import datetime
 from enum import Enum
 from typing import Optional
@@ -12,7 +11,9 @@ from flask import current_app
 from wtforms import SelectField, BooleanField, SubmitField, ValidationError, Label
 
 from app.db import db
-from app.models import WashingMachine, User
+from app.models import WashingMachine, CandySnapshot, User
+from app.machine import get_machine_config
+from app.clients import candy_client, candy_auth_client
 
 
 class CandyStatusCode(Enum):
@@ -48,6 +49,10 @@ class CandyMachineState(CandyStatusCode):
     FINISHED1 = (7, "Finished")
     FINISHED2 = (8, "Finished")
 
+    @property
+    def finished(self):
+        return self in (CandyMachineState.FINISHED1, CandyMachineState.FINISHED2)
+
 
 class CandyWashProgramState(CandyStatusCode):
     UNKNOWN = (-1, "Unknown")
@@ -155,6 +160,7 @@ class CandyWashingMachine:
     _instance = None
     _instance_initialized = None
     last_updated = None
+    stored_state = None
     programs = []
     downloaded_programs = []
 
@@ -226,12 +232,23 @@ class CandyWashingMachine:
         return json.dumps(self.asdict())
 
     def update_db_model(self):
-        washing_machine = WashingMachine.query.first()
-        washing_machine.candy_appliance_data = self.asdict()
+        """ Stores the state as the Candy snapshot, only if it has changed since it was last stored. """
+        state = self.asdict()
+        del state['last_updated']
+        if state == self.stored_state:
+            return
+        washing_machine_id = get_machine_config().id
+        snapshot = db.session.get(CandySnapshot, washing_machine_id)
+        if snapshot is None:
+            db.session.add(CandySnapshot(washing_machine_id=washing_machine_id, data=state))
+        elif snapshot.data != state:
+            snapshot.data = state
         db.session.commit()
+        self.stored_state = state
 
     def update(self):
-        if self.last_updated and (datetime.datetime.now() - self.last_updated).seconds < int(os.getenv('CANDY_VALIDITY', 60)):
+        if self.last_updated and \
+                (datetime.datetime.now() - self.last_updated).total_seconds() < int(os.getenv('CANDY_VALIDITY', 60)):
             print('CWM is up to date!')
             return
         print('Updating CWM...')
@@ -292,13 +309,26 @@ class CandyWashingMachine:
         current_app.logger.debug(f'Response from Candy API: {command_response}')
 
 
+def get_candy_snapshot() -> Optional[dict]:
+    """ Returns the last stored state of the washing machine reported by the Candy API, if there is any. """
+    return db.session.query(CandySnapshot.data).limit(1).scalar()
+
+
+def get_last_machine_state() -> CandyMachineState:
+    """ Returns the machine state from the last Candy snapshot stored in the database, without polling the API. """
+    snapshot = get_candy_snapshot()
+    if not snapshot or 'machine_state' not in snapshot:
+        return CandyMachineState.UNKNOWN
+    return CandyMachineState.from_code(snapshot['machine_state']['code'])
+
+
 def refresh_candy_token():
     """ Refreshes the Candy API token for the washing machine """
     washing_machine = WashingMachine.query.first()
     if not washing_machine.candy_api_refresh_token:
         current_app.logger.error('Tried to refresh the bearer token, but failed. No refresh token found')
         raise RuntimeError('No refresh token found for Candy API')
-    url = f'{os.getenv("CANDY_AUTH_ENDPOINT")}/services/oauth2/token?device_id={washing_machine.candy_device_id}'
+    url = f'/services/oauth2/token?device_id={washing_machine.candy_device_id}'
 
     payload = {'grant_type': 'hybrid_refresh',
                'client_id': os.getenv('CANDY_CLIENT_ID'),
@@ -310,7 +340,7 @@ def refresh_candy_token():
         'Cookie': 'CookieConsentPolicy=0:1; LSKey-c$CookieConsentPolicy=0:1'
     }
 
-    refresh_request = requests.post(url, headers=headers, data=payload)
+    refresh_request = candy_auth_client.post(url, headers=headers, data=payload)
     if refresh_request.status_code != 200:
         current_app.logger.error(f'Tried to refresh the bearer token, but failed. More info: {refresh_request.text}')
         raise RuntimeError('Failed to refresh Candy API token')
@@ -321,11 +351,12 @@ def refresh_candy_token():
 
 def fetch_appliance_data():
     """ Fetches appliance data from Candy API """
-    washing_machine = WashingMachine.query.first()
+    washing_machine = get_machine_config()
     if not washing_machine.candy_api_token:
         refresh_candy_token()
+        washing_machine = get_machine_config()
 
-    url = f'{os.getenv("CANDY_API_ENDPOINT")}/api/v1/appliances/{washing_machine.candy_appliance_id}.json?with_programs=0'
+    url = f'/api/v1/appliances/{washing_machine.candy_appliance_id}.json?with_programs=0'
 
     headers = {
         'Host': 'simply-fi.herokuapp.com',
@@ -339,7 +370,7 @@ def fetch_appliance_data():
         'Authorization': f'Bearer {washing_machine.candy_api_token}'
     }
 
-    response = requests.get(url, headers=headers)
+    response = candy_client.get(url, headers=headers)
     if response.status_code == 401:
         refresh_candy_token()
         return fetch_appliance_data()
@@ -352,11 +383,12 @@ def fetch_appliance_data():
 
 def send_command(command_body: str):
     """ Sends command to washing machine through Candy API """
-    washing_machine = WashingMachine.query.first()
+    washing_machine = get_machine_config()
     if not washing_machine.candy_api_token:
         refresh_candy_token()
+        washing_machine = get_machine_config()
 
-    url = f'{os.getenv("CANDY_API_ENDPOINT")}/api/v1/commands.json'
+    url = '/api/v1/commands.json'
 
     headers = {
         'Host': 'simply-fi.herokuapp.com',
@@ -371,7 +403,7 @@ def send_command(command_body: str):
         'Authorization': f'Bearer {washing_machine.candy_api_token}'
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps({
+    response = candy_client.post(url, headers=headers, data=json.dumps({
         "appliance_id": washing_machine.candy_appliance_id,
         "body": command_body
     }))
@@ -0,0 +1,89 @@
+import os
+import threading
+import requests
+from typing import Optional
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class ApiClient:
+    """
+    Long-lived HTTP client for a cloud API. Each process gets its own pooled keep-alive session (sessions must
+    not be shared across the gunicorn/Celery fork), every request has connect/read timeouts and failed
+    requests are retried a bounded number of times with exponential backoff.
+    """
+
+    def __init__(self, base_url_env: str, retry_methods: frozenset = frozenset({'GET', 'HEAD'}),
+                 pool_maxsize: int = 10):
+        self.base_url_env = base_url_env
+        self.retry_methods = retry_methods
+        self.pool_maxsize = pool_maxsize
+        self._base_url: Optional[str] = None
+        self._session: Optional[requests.Session] = None
+        self._session_pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        """ The explicitly configured base URL or the one from the environment, e.g. a local fake server. """
+        return (self._base_url or os.getenv(self.base_url_env) or '').rstrip('/')
+
+    @base_url.setter
+    def base_url(self, value: Optional[str]):
+        self._base_url = value
+
+    @property
+    def timeout(self) -> tuple[float, float]:
+        return float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05)), float(os.getenv('HTTP_READ_TIMEOUT', 10))
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None or self._session_pid != os.getpid():
+                self._session = self._create_session()
+                self._session_pid = os.getpid()
+            return self._session
+
+    def _create_session(self) -> requests.Session:
+        retry = Retry(
+            total=int(os.getenv('HTTP_MAX_RETRIES', 3)),
+            backoff_factor=float(os.getenv('HTTP_RETRY_BACKOFF', 0.5)),
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=self.retry_methods,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def url(self, path: str) -> str:
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return f'{self.base_url}{path}'
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, self.url(path), **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._session_pid = None
+
+
+# Relay control is not retried here, so a request thread is never held for the backoff. The release door task
+# retries it on its own.
+shelly_client = ApiClient('SHELLY_CLOUD_ENDPOINT')
+candy_client = ApiClient('CANDY_API_ENDPOINT')
+candy_auth_client = ApiClient('CANDY_AUTH_ENDPOINT', retry_methods=frozenset({'GET', 'HEAD', 'POST'}))
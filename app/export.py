@@ -0,0 +1,74 @@
+import io
+import csv
+import json
+import decimal
+import datetime
+from typing import Iterator, Optional
+
+from app.db import db
+from app.models import WashingCycle
+
+EXPORT_COLUMNS = ('id', 'user', 'date', 'used_kwh', 'cost')
+EXPORT_BATCH_SIZE = 1000
+
+
+class ExcelDialect(csv.excel):
+    """ CSV dialect of Excel in locales with a decimal comma, which expect semicolons between the fields. """
+    delimiter = ';'
+
+
+def export_cycles_rows(start: datetime.date = None, end: datetime.date = None, user_id: int = None,
+                       count: int = None) -> Iterator[tuple]:
+    """
+    Yields the finished cycles, newest first, optionally started within [start, end] or belonging to a user.
+    The rows are fetched from a server-side cursor in batches, so memory use does not grow with the export.
+    """
+    query = db.select(
+        WashingCycle.id, WashingCycle.user_id, WashingCycle.start_timestamp,
+        WashingCycle.endkwh - WashingCycle.startkwh, WashingCycle.cost
+    ).where(WashingCycle.end_timestamp.is_not(None))
+    if start is not None:
+        query = query.where(WashingCycle.start_timestamp >= start)
+    if end is not None:
+        query = query.where(WashingCycle.start_timestamp < end + datetime.timedelta(days=1))
+    if user_id is not None:
+        query = query.where(WashingCycle.user_id == user_id)
+    query = query.order_by(WashingCycle.start_timestamp.desc(), WashingCycle.id.desc()).limit(count)
+
+    for cycle_id, cycle_user_id, start_timestamp, used_kwh, cost in \
+            db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE)):
+        yield cycle_id, cycle_user_id, start_timestamp.strftime('%Y-%m-%d'), used_kwh, cost
+
+
+def iter_csv(rows: Iterator[tuple], excel: bool = False) -> Iterator[str]:
+    """ Yields the header and then every row as a line of CSV, with decimal commas in the Excel dialect. """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, dialect=ExcelDialect if excel else csv.excel)
+
+    def line(row) -> str:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        return buffer.getvalue()
+
+    # The byte order mark makes Excel read the file as UTF-8
+    yield ('\ufeff' if excel else '') + line(EXPORT_COLUMNS)
+    for row in rows:
+        if excel:
+            row = [str(value).replace('.', ',') if isinstance(value, (decimal.Decimal, float)) else value
+                   for value in row]
+        yield line(row)
+
+
+def iter_ndjson(rows: Iterator[tuple]) -> Iterator[str]:
+    """ Yields every row as a line of JSON, with the decimals as strings. """
+    for row in rows:
+        yield json.dumps({
+            column: str(value) if isinstance(value, (decimal.Decimal, float)) else value
+            for column, value in zip(EXPORT_COLUMNS, row)
+        }) + '\n'
+
+
+def parse_export_date(value: Optional[str]) -> Optional[datetime.date]:
+    """ Parses a date argument in the YYYY-MM-DD format, raises ValueError if it is malformed. """
+    return datetime.date.fromisoformat(value) if value else None
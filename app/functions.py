@@ -1,31 +1,39 @@
-import os, decimal, datetime, json, requests, time, pytz
+import os, decimal, datetime, json, requests, time, pytz, dataclasses
+from typing import Optional
 from requests.exceptions import RequestException
 
 from flask import current_app, flash, request, redirect, session
 from flask_security import roles_required
-from pywebpush import webpush, WebPushException
-from sqlalchemy import or_, and_
-from requests_cache import CachedSession, RedisCache
+from sqlalchemy import or_, and_, func, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, aliased, undefer_group
 
 from app.db import db
 from app.auth import user_datastore
 from app.models import User, WashingCycle, WashingCycleSplit, WashingMachine, PushSubscription, CeleryTask, WashingCyclePayment
+from app.models import UserBalance, MonthlyRollup
 from app.models import Notification, SplitRequestNotification, unpaid_cycles_reminder_notification, ScheduleEvent, NotificationURL
 from app.forms import SplitCycleForm
-from app.statistics import calculate_unpaid_cycles_cost
+from app.statistics import calculate_unpaid_cycles_cost, calculate_unpaid_cycles_cost_by_user, cents_to_decimal
+from app.ledger import refresh_balances, refresh_cycles_balances, cycle_participant_ids
+from app.rollups import refresh_rollups, refresh_cycles_rollups, cycle_rollup_keys
+from app.machine import get_machine_config, get_active_cycle
+from app.candy import get_candy_snapshot
+from app.pagination import Page, paginate_keyset
+from app.push import send_push, queue_push
+from app.shelly import get_device_status, device_status_cache
+from app.clients import shelly_client
 
 
 def start_cycle(user: User, admin_start: bool = False):
     """ Initiates a new cycle for a user. """
-    if WashingCycle.query.filter_by(endkwh=None, end_timestamp=None).all():
+    if db.session.query(WashingCycle.id).filter(WashingCycle.end_timestamp.is_(None)).first():
         # User has an already running cycle
         current_app.logger.error(f"User {user.username} tried to start a cycle, but one was already active.")
         flash('You already have a cycle running!', category='toast-warning')
         raise ChildProcessError('User already has a cycle running!')
 
-    washing_machine = WashingMachine.query.first()
-
-    if washing_machine.require_scheduling and not admin_start:
+    if get_machine_config().require_scheduling and not admin_start:
         now = datetime.datetime.now(pytz.timezone(session['timezone']))
         event = ScheduleEvent.query.filter(
             ScheduleEvent.start_timestamp <= now,
@@ -46,7 +54,7 @@ def start_cycle(user: User, admin_start: bool = False):
             current_app.logger.error("Request to turn on the relay through Shelly Cloud API FAILED!")
             flash('Request to turn on the relay failed!\nPlease try again!', category='toast-error')
             raise ChildProcessError('Request to turn on the relay failed!')
-    except requests.exceptions.ConnectionError:
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         current_app.logger.error("Shelly Cloud API request failed! API is probably down...")
         flash('Request to turn off the relay failed!\nPlease try again!', category='toast-error')
         raise ChildProcessError('Request to turn off the relay failed!')
@@ -61,6 +69,12 @@ def start_cycle(user: User, admin_start: bool = False):
 
         CeleryTask.start_cycle_end_notification_task(user.id, new_cycle.id)
 
+    except IntegrityError:
+        # Another cycle was started in the meantime
+        current_app.logger.error(f"User {user.username} tried to start a cycle, but one was started concurrently.")
+        flash('Another cycle is already running!', category='toast-warning')
+        db.session.rollback()
+        raise ChildProcessError('Another cycle is already running!')
     except RequestException:
         current_app.logger.error(f'Error with initialising a cycle for user {user.username}.')
         flash('Unexpected error occurred!\nPlease try again!', category='toast-error')
@@ -80,28 +94,35 @@ def stop_cycle(user: User):
                 current_app.logger.error("Request to turn off the relay through Shelly Cloud API FAILED!")
                 flash('Request to turn off the relay failed!\nPlease try again!', category='toast-error')
                 raise ChildProcessError('Request to turn off the relay failed!')
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             current_app.logger.error("Shelly Cloud API request failed! API is probably down...")
             flash('Request to turn off the relay failed!\nPlease try again!', category='toast-error')
             raise ChildProcessError('Request to turn off the relay failed!')
 
         try:
-            update_energy_consumption()
-            cycle.endkwh = WashingMachine.query.first().currentkwh
+            cycle.endkwh = update_energy_consumption()
             cycle.end_timestamp = db.func.current_timestamp()
-            cycle.cost = (cycle.endkwh - cycle.startkwh) * WashingMachine.query.first().costperkwh
+            cycle.cost = (cycle.endkwh - cycle.startkwh) * get_machine_config().costperkwh
 
-            tasks = CeleryTask.query.filter_by(ref_id=cycle.id).all()
+            tasks = CeleryTask.query.filter(
+                CeleryTask.kind.in_([CeleryTask.TaskKinds.CYCLE_NOTIFICATION, CeleryTask.TaskKinds.WASH_THEN_DRY]),
+                CeleryTask.ref_id == cycle.id
+            ).all()
             for task in tasks:
                 try:
-                    task.terminate()
+                    # The cycle, its tasks and the ledger are committed together below
+                    task.terminate(commit=False)
                     current_app.logger.info(f'Stopped task of kind {task.kind.name} referenced to cycle.')
                 except Exception as e:
                     current_app.logger.error(f'Error with stopping task of kind {task.kind.name}. {e}')
 
             if cycle.cost == 0:
                 db.session.delete(cycle)
+            else:
+                db.session.flush()
+                refresh_rollups(cycle_rollup_keys(cycle))
 
+            refresh_balances({user.id})
             db.session.commit()
 
             if user.has_role('guest'):
@@ -115,6 +136,7 @@ def stop_cycle(user: User):
             flash('Unexpected error occurred!\nPlease try again!', category='toast-error')
             raise ChildProcessError('Error with updating energy consumption!')
         except Exception as e:
+            db.session.rollback()
             current_app.logger.error(f'Error with terminating a cycle for user {user.username}. {e.__str__()}')
             flash('Unexpected error occurred!\nPlease try again!', category='toast-error')
             raise ChildProcessError('Error with terminating a cycle.')
@@ -126,21 +148,19 @@ def stop_cycle(user: User):
 
 def update_cycle(user: User):
     """ Updates the running cycle for a user. Should be executed on every request. """
-    cycle = WashingCycle.query.filter_by(end_timestamp=None).first()
+    cycle = get_active_cycle()
     if cycle:
         if cycle.user_id == user.id:
             return {'state': 'running', 'id': cycle.id}
         else:
-            return {'state': 'unavailable', 'id': None, 'user': cycle.user.first_name}
+            return {'state': 'unavailable', 'id': None, 'user': cycle.user_first_name}
     else:
         return {'state': 'available', 'id': None}
 
 
 def get_running_time() -> str:
     """ Calculate the running time of the current cycle. """
-    cycle: WashingCycle = WashingCycle.query.filter(
-        WashingCycle.end_timestamp.is_(None)
-    ).first()
+    cycle = get_active_cycle()
     if cycle is not None:
         return str(datetime.datetime.now(datetime.timezone.utc) - cycle.start_timestamp).split('.')[0].zfill(8)
     else:
@@ -149,13 +169,13 @@ def get_running_time() -> str:
 
 def get_remaining_minutes() -> int:
     """ Fetch the remaining minutes of the current cycle. """
-    washing_machine: WashingMachine = WashingMachine.query.first()
-    if washing_machine.candy_appliance_data is None:
+    snapshot = get_candy_snapshot()
+    if snapshot is None:
         return 0
-    elif 'remaining_minutes' not in washing_machine.candy_appliance_data:
+    elif 'remaining_minutes' not in snapshot:
         return 0
 
-    return washing_machine.candy_appliance_data['remaining_minutes']
+    return snapshot['remaining_minutes']
 
 
 def get_unpaid_list(user: User):
@@ -169,225 +189,184 @@ def get_unpaid_list(user: User):
             ),
             WashingCycle.splits.any(user_id=user.id, paid=False)
         )
+    ).options(
+        selectinload(WashingCycle.splits),
+        selectinload(WashingCycle.user),
+        undefer_group('splits')
     ).order_by(WashingCycle.start_timestamp.desc(), WashingCycle.end_timestamp.desc()).all()
 
     for cycle in cycles:
-        if split_users_count := len(cycle.splits):
-            cycle.split_cost = round(cycle.cost / (split_users_count + 1), 2)
-            if cycle.split_cost * (split_users_count + 1) < cycle.cost:
-                cycle.split_cost = round(cycle.split_cost + decimal.Decimal(0.01), 2)
+        if cycle.splits_count:
             cycle.split_paid = False
         cycle.start_timestamp_formatted = cycle.start_timestamp.strftime("%d-%m-%Y %H:%M:%S")
         cycle.end_timestamp_formatted = cycle.end_timestamp.strftime("%d-%m-%Y %H:%M:%S")
     return cycles
 
 
-def get_usage_list(user: User, limit: int = 10):
-    """ Get the usage list for a user. """
-    cycles: list[WashingCycle] = WashingCycle.query.filter(
+def get_usage_page(user: User, limit: Optional[int] = 10, cursor: str = None) -> Page:
+    """
+    Get a page of the finished cycles of a user and the cycles split with them, newest first.
+    Rows hold only the listed columns and the user's own split, if there is one.
+    """
+    own_split = aliased(WashingCycleSplit)
+    query = db.session.query(
+        WashingCycle.id, WashingCycle.user_id, WashingCycle.startkwh, WashingCycle.endkwh,
+        WashingCycle.start_timestamp, WashingCycle.end_timestamp, WashingCycle.cost, WashingCycle.paid,
+        WashingCycle.splits_count, WashingCycle.share_cents,
+        own_split.paid.label('split_paid'), own_split.accepted.label('split_accepted')
+    ).outerjoin(own_split, and_(own_split.cycle_id == WashingCycle.id, own_split.user_id == user.id)).filter(
         WashingCycle.end_timestamp.is_not(None),
-        or_(
-            WashingCycle.user_id == user.id,
-            WashingCycle.splits.any(user_id=user.id)
-        )
-    ).order_by(WashingCycle.start_timestamp.desc(), WashingCycle.end_timestamp.desc()).limit(limit).all()
+        or_(WashingCycle.user_id == user.id, own_split.user_id.is_not(None))
+    )
+    return paginate_keyset(query, WashingCycle.start_timestamp, WashingCycle.id, limit, cursor)
 
-    for cycle in cycles:
-        cycle.usedkwh = round(cycle.endkwh - cycle.startkwh, 2)
-        if split_users_count := len(cycle.splits):
-            # print(cycle.splits)
-            cycle.split_cost = round(cycle.cost / (split_users_count + 1), 2)
-            if cycle.split_cost * (split_users_count + 1) < cycle.cost:
-                cycle.split_cost = round(cycle.split_cost + decimal.Decimal(0.01), 2)
-            if cycle.user_id != user.id:
-                cycle.split_paid = WashingCycleSplit.query.filter_by(cycle_id=cycle.id, user_id=user.id).first().paid
-        cycle.start_timestamp_formatted = cycle.start_timestamp.strftime("%d-%m-%Y %H:%M:%S")
-        cycle.end_timestamp_formatted = cycle.end_timestamp.strftime("%d-%m-%Y %H:%M:%S")
-        cycle.duration = str(cycle.end_timestamp - cycle.start_timestamp).split('.')[0]
-    return cycles
 
+def get_cycles_page(limit: int = 100, cursor: str = None) -> Page:
+    """ Get a page of all cycles, newest first. """
+    query = db.session.query(
+        WashingCycle.id, User.username, WashingCycle.startkwh, WashingCycle.endkwh, WashingCycle.start_timestamp,
+        WashingCycle.end_timestamp, WashingCycle.cost, WashingCycle.paid
+    ).outerjoin(User, User.id == WashingCycle.user_id)
+    return paginate_keyset(query, WashingCycle.start_timestamp, WashingCycle.id, limit, cursor)
 
-def trigger_push_notification(push_subscription, notification: Notification):
-    """ Sends a push notification through a push subscription. """
-    try:
-        response = webpush(
-            subscription_info=json.loads(push_subscription.subscription_json),
-            data=json.dumps(notification.__dict__()),
-            vapid_private_key=current_app.config["PUSH_PRIVATE_KEY"],
-            vapid_claims={"sub": "mailto:{}".format(current_app.config["PUSH_CLAIM_EMAIL"])}
-        )
-        return response.ok
-    except WebPushException as ex:
-        current_app.logger.error(f'Error trying to send notification.')
-        if ex.response and ex.response.json():
-            extra = ex.response.json()
-            current_app.logger.error("Remote service replied with a {}:{}, {}", extra.code, extra.errno, extra.message)
-        return False
+
+def get_payments_page(limit: int = 50, cursor: str = None) -> Page:
+    """ Get a page of the payments which are not propagated to the room owner yet, newest first. """
+    query = db.session.query(
+        WashingCyclePayment.id, WashingCyclePayment.timestamp, User.username, WashingCyclePayment.amount,
+        WashingCyclePayment.propagated
+    ).outerjoin(User, User.id == WashingCyclePayment.user_id).filter(WashingCyclePayment.propagated.is_(False))
+    return paginate_keyset(query, WashingCyclePayment.timestamp, WashingCyclePayment.id, limit, cursor)
 
 
 def send_push_to_all(notification: Notification):
     """ Sends push to all users through all push subscriptions. """
     current_app.logger.info('Sending push notification to all users.')
-    subscriptions = PushSubscription.query.all()
-    return [trigger_push_notification(subscription, notification) for subscription in subscriptions]
+    return send_push(PushSubscription.query.all(), notification)
 
 
 def send_push_to_user(user: User, notification: Notification):
     """ Sends push to a user through all push subscriptions associated with them. """
     current_app.logger.info(f'Sending push notification to {user.username}.')
-    subscriptions = PushSubscription.query.filter_by(user_id=user.id).all()
-    return [trigger_push_notification(subscription, notification) for subscription in subscriptions]
+    return send_push(PushSubscription.query.filter_by(user_id=user.id).all(), notification)
+
+
+def queue_push_to_all(notification: Notification):
+    """ Queues a push to all users, which is sent once the current transaction commits. """
+    queue_push(notification)
+
+
+def queue_push_to_user(user: User, notification: Notification):
+    """ Queues a push to a user, which is sent once the current transaction commits. """
+    queue_push(notification, user.id)
+
+
+def queue_push_to_room_owners(notification: Notification):
+    """ Queues a push to every room owner, which is sent once the current transaction commits. """
+    for room_owner in User.query.filter(User.roles.any(name='room_owner')).all():
+        queue_push_to_user(room_owner, notification)
 
 
 def trigger_relay(mode: str):
     """ Changes the relay state of a Shelly device. """
     current_app.logger.info(f'Triggering relay through Shelly API to be {mode}.')
-    response = requests.post(
-        url='{}/device/relay/control'.format(os.getenv('SHELLY_CLOUD_ENDPOINT')),
+    response = shelly_client.post(
+        '/device/relay/control',
         data={
             'auth_key': os.getenv('SHELLY_CLOUD_AUTH_KEY'),
             'id': os.getenv('SHELLY_DEVICE_ID'),
             'channel': '0',
             'turn': 'on' if mode == 'on' else 'off'
         })
+    # The relay state has changed, so the cached device status is stale
+    device_status_cache.invalidate()
     return response.status_code
 
 
 def get_energy_consumption():
-    """ Queries Shelly Cloud API for energy consumption data in Watt-minute and returns in kWatt-hour. """
-    data = requests.get(
-        url="{}/device/status".format(os.getenv('SHELLY_CLOUD_ENDPOINT')),
-        params={
-            'auth_key': os.getenv('SHELLY_CLOUD_AUTH_KEY'),
-            'id': os.getenv('SHELLY_DEVICE_ID')
-        }
-    )
-
-    if data.status_code != 200:
-        current_app.logger.error('Failed to get power consumption data from Shelly Cloud API')
-        raise RequestException('Failed to get power consumption data from Shelly Cloud API')
-
-    return data.json()['data']['device_status']['meters'][0]['total'] / 60000
+    """ Returns the energy consumption from the Shelly device status in kWatt-hour. """
+    return get_device_status().total_kwh
 
 
 def get_realtime_current_usage():
-    """ Queries Shelly Cloud API for current usage data in Watt. """
-    data = requests.get(
-        url="{}/device/status".format(os.getenv('SHELLY_CLOUD_ENDPOINT')),
-        params={
-            'auth_key': os.getenv('SHELLY_CLOUD_AUTH_KEY'),
-            'id': os.getenv('SHELLY_DEVICE_ID')
-        }
-    )
-
-    if data.status_code != 200:
-        current_app.logger.error('Failed to get current usage data from Shelly Cloud API')
-        raise RequestException('Failed to get current usage data from Shelly Cloud API')
-
-    return data.json()['data']['device_status']['meters'][0]['power']
+    """ Returns the current usage from the Shelly device status in Watt. """
+    return get_device_status().power
 
 
 def update_energy_consumption():
-    """ Updates the energy consumption in the database """
-    washing_machine = WashingMachine.query.first()
-    washing_machine.currentkwh = get_energy_consumption()
+    """ Updates the energy consumption in the database and returns it. """
+    currentkwh = get_energy_consumption()
+    db.session.execute(update(WashingMachine).values(currentkwh=currentkwh))
     db.session.commit()
+    return currentkwh
 
 
 def get_relay_temperature():
-    """ Queries Shelly Cloud API for relay temperature in Celsius. """
-    data = requests.get(
-        url="{}/device/status".format(os.getenv('SHELLY_CLOUD_ENDPOINT')),
-        params={
-            'auth_key': os.getenv('SHELLY_CLOUD_AUTH_KEY'),
-            'id': os.getenv('SHELLY_DEVICE_ID')
-        }
-    )
-
-    if data.status_code != 200:
-        raise RequestException('Failed to get data from Shelly Cloud API')
-
-    return data.json()['data']['device_status']['temperature']
+    """ Returns the relay temperature from the Shelly device status in Celsius. """
+    return get_device_status().temperature
 
 
 def get_relays_state():
-    """ Queries Shelly Cloud API for relay state. """
-    data = requests.get(
-        url="{}/device/status".format(os.getenv('SHELLY_CLOUD_ENDPOINT')),
-        params={
-            'auth_key': os.getenv('SHELLY_CLOUD_AUTH_KEY'),
-            'id': os.getenv('SHELLY_DEVICE_ID')
-        }
-    )
-
-    if data.status_code != 200:
-        raise RequestException('Failed to get data from Shelly Cloud API')
-
-    return data.json()['data']['device_status']['relays'][0]['ison']
+    """ Returns the relay state from the Shelly device status. """
+    return get_device_status().relay_ison
 
 
 def get_relay_wifi_rssi():
-    """ Queries Shelly Cloud API for relay Wi-Fi RSSI. """
-    data = requests.get(
-        url="{}/device/status".format(os.getenv('SHELLY_CLOUD_ENDPOINT')),
-        params={
-            'auth_key': os.getenv('SHELLY_CLOUD_AUTH_KEY'),
-            'id': os.getenv('SHELLY_DEVICE_ID')
-        }
-    )
+    """ Returns the relay Wi-Fi RSSI from the Shelly device status. """
+    return get_device_status().wifi_rssi
 
-    if data.status_code != 200:
-        raise RequestException('Failed to get data from Shelly Cloud API')
-
-    return data.json()['data']['device_status']['wifi_sta']['rssi']
 
+def get_running_cycle_start():
+    """ Returns the start timestamp of the current cycle in ISO format, if there is one. """
+    cycle = get_active_cycle()
+    if cycle is not None:
+        return cycle.start_timestamp.isoformat()
+    return None
 
-def get_washer_info(shelly=True):
-    """ Returns a dict with washing machine information """
-    if shelly:
-        cache_session = CachedSession(
-            backend=RedisCache() if not current_app.debug else 'sqlite',
-            cache_name='shelly_cache',
-            expire_after=1 if current_app.debug else 30
-        )
-        shelly_request = cache_session.get(
-            url="{}/device/status".format(os.getenv('SHELLY_CLOUD_ENDPOINT')),
-            params={
-                'auth_key': os.getenv('SHELLY_CLOUD_AUTH_KEY'),
-                'id': os.getenv('SHELLY_DEVICE_ID')
-            }
-        )
 
-        if shelly_request.status_code != 200:
-            current_app.logger.error('Failed to get current usage data from Shelly Cloud API')
-            raise RequestException('Failed to get current usage data from Shelly Cloud API')
+def get_washer_info(shelly=True, cycle_start=False):
+    """
+    Returns a dict with washing machine information. With cycle_start the start timestamp of the current cycle is
+    returned instead of the running time, so that clients can run the stopwatch themselves.
+    """
+    if cycle_start:
+        info = {"cycle_start": get_running_cycle_start()}
+    else:
+        info = {"running_time": get_running_time()}
 
-        shelly_data = shelly_request.json()
+    if shelly:
+        device_status = get_device_status()
 
-        return {
-            "running_time": get_running_time(),
+        info.update({
             "remaining_minutes": get_remaining_minutes(),
-            "current_usage": shelly_data['data']['device_status']['meters'][0]['power'],
-            "relay_ison": shelly_data['data']['device_status']['relays'][0]['ison'],
-            "relay_temperature": shelly_data['data']['device_status']['temperature'],
-            "relay_wifi_rssi": shelly_data['data']['device_status']['wifi_sta']['rssi']
-        }
+            "current_usage": device_status.power,
+            "relay_ison": device_status.relay_ison,
+            "relay_temperature": device_status.temperature,
+            "relay_wifi_rssi": device_status.wifi_rssi
+        })
 
-    return {"running_time": get_running_time()}
+    return info
 
 
 def delete_user(user: User):
     """ Deletes a user and all associated data excl. washing cycles. """
-    from app.models import User, UserSettings, PushSubscription, ScheduleEvent, WashingCycle, WashingCycleSplit, \
-        roles_users
+    from app.models import User, UserSettings, PushSubscription, PushOutbox, ScheduleEvent, WashingCycle, \
+        WashingCycleSplit, roles_users
     UserSettings.query.filter_by(user_id=user.id).delete()
     PushSubscription.query.filter_by(user_id=user.id).delete()
+    PushOutbox.query.filter_by(user_id=user.id).delete()
     ScheduleEvent.query.filter_by(user_id=user.id).delete()
     cycles = WashingCycle.query.filter_by(user_id=user.id).all()
+    split_cycles = [split.washing_cycle for split in WashingCycleSplit.query.filter_by(user_id=user.id, paid=False)]
+    rollup_keys = set().union(*[cycle_rollup_keys(cycle, exclude_user_ids={user.id}) for cycle in split_cycles])
     WashingCycleSplit.query.filter_by(user_id=user.id, paid=False).delete()
+    UserBalance.query.filter_by(user_id=user.id).delete()
+    MonthlyRollup.query.filter_by(user_id=user.id).delete()
 
     for cycle in cycles:
         cycle.user_id = None
+    refresh_balances({cycle.user_id for cycle in split_cycles} - {user.id, None})
+    refresh_rollups(rollup_keys)
 
     roles_users.delete().where(roles_users.c.user_id == user.id)
     user_datastore.delete_user(user)
@@ -417,7 +396,9 @@ def split_cycle(user: User, split_cycle_form: SplitCycleForm):
                 continue
             split_participant = User.query.filter_by(id=split_participant_user_id).first()
             cycle.splits.append(WashingCycleSplit(cycle_id=cycle.id, user_id=split_participant_user_id))
-            send_push_to_user(split_participant, SplitRequestNotification(user, cycle))
+            queue_push_to_user(split_participant, SplitRequestNotification(user, cycle))
+        refresh_balances(cycle_participant_ids(cycle))
+        refresh_rollups(cycle_rollup_keys(cycle))
         db.session.commit()
         flash('Cycle split successfully, users need to confirm to complete!', category='toast-success')
 
@@ -438,6 +419,7 @@ def mark_cycle_paid(user: User, cycle_id: int, mass_marking: bool = False):
         if split:
             if split.accepted:
                 split.paid = True
+                refresh_balances({user.id})
                 db.session.commit()
                 if not mass_marking:
                     flash(f'Cycle #{cycle_id} marked as paid', category='toast-success')
@@ -452,6 +434,7 @@ def mark_cycle_paid(user: User, cycle_id: int, mass_marking: bool = False):
         flash(f'Cycle #{cycle_id} already marked as paid', category='toast-error')
     else:
         cycle.paid = True
+        refresh_balances({cycle.user_id})
         db.session.commit()
         if not mass_marking:
             flash(f'Cycle #{cycle_id} marked as paid', category='toast-success')
@@ -462,33 +445,62 @@ def mark_cycle_paid(user: User, cycle_id: int, mass_marking: bool = False):
 
 def notify_debtors():
     """ Sends push notifications to all users owing money. """
-    if calculate_unpaid_cycles_cost() < os.getenv('DEBTS_THRESHOLD', 5):
+    if calculate_unpaid_cycles_cost() < decimal.Decimal(os.getenv('DEBTS_THRESHOLD', 5)):
         current_app.logger.info('Debts are below the threshold, no notifications sent.')
         return
-    room_owner = User.query.filter(User.roles.any(name='room_owner')).first()
-    debtors = {cycle.user for cycle in WashingCycle.query.filter_by(paid=False).all()} - {room_owner}
+    debts = calculate_unpaid_cycles_cost_by_user()
+    debtors = User.query.filter(
+        User.id.in_([user_id for user_id, debt in debts.items() if debt > 0]),
+        ~User.roles.any(name='room_owner')
+    ).all()
     for debtor in debtors:
         send_push_to_user(user=debtor, notification=unpaid_cycles_reminder_notification)
 
 
-def recalculate_cycles_cost():
-    """ Recalculates the cost of all unpaid cycles based on new price per kWh. """
+def recalculate_cycles_cost(task: CeleryTask = None, chunk_size: int = None) -> int:
+    """
+    Recalculates the cost of all unpaid cycles based on new price per kWh. The cycles are priced by set-based
+    UPDATEs in keyset chunks of chunk_size ids, each committed together with the progress of the task.
+    Returns the number of updated cycles.
+    """
     if current_app.debug:
         current_app.logger.warning('We are debugging, no changes applied to the database.')
-        return
+        return 0
 
-    # Grace period to terminate the task if it's a mistake
-    time.sleep(10 * 60)
+    started = time.monotonic()
+    chunk_size = chunk_size or int(os.getenv('RECALCULATE_CHUNK_SIZE', 5000))
+    costperkwh = db.session.query(WashingMachine.costperkwh).limit(1).scalar()
+    unpaid = and_(WashingCycle.end_timestamp.is_not(None), WashingCycle.paid.is_(False))
+    total = db.session.query(func.count(WashingCycle.id)).filter(unpaid).scalar()
+
+    updated = 0
+    last_id = 0
+    while True:
+        # The last id of the next chunk, None if the rest of the rows fit in one chunk
+        upper_id = db.session.query(WashingCycle.id).filter(unpaid, WashingCycle.id > last_id) \
+            .order_by(WashingCycle.id).offset(chunk_size - 1).limit(1).scalar()
+
+        statement = update(WashingCycle) \
+            .where(unpaid, WashingCycle.id > last_id) \
+            .values(cost=(WashingCycle.endkwh - WashingCycle.startkwh) * costperkwh) \
+            .execution_options(synchronize_session=False)
+        if upper_id is not None:
+            statement = statement.where(WashingCycle.id <= upper_id)
+        updated += db.session.execute(statement).rowcount
+        refresh_cycles_balances(last_id, upper_id)
+        refresh_cycles_rollups(last_id, upper_id)
+
+        if task is not None:
+            task.update_payload(rows_total=total, rows_updated=updated,
+                                duration=round(time.monotonic() - started, 3))
+        db.session.commit()
 
-    recalc_cycles = WashingCycle.query.filter(
-        WashingCycle.end_timestamp.is_not(None),
-        WashingCycle.paid.is_(False)
-    ).all()
+        if upper_id is None:
+            break
+        last_id = upper_id
 
-    for cycle in recalc_cycles:
-        cycle.cost = (cycle.endkwh - cycle.startkwh) * WashingMachine.query.first().costperkwh
-
-    db.session.commit()
+    current_app.logger.info(f'Recalculated the cost of {updated} cycles in {time.monotonic() - started:.3f} seconds.')
+    return updated
 
 
 def schedule_check_for_overlapping(start_timestamp: datetime.datetime, end_timestamp: datetime.datetime, event_id):
@@ -522,19 +534,16 @@ def schedule_create_new_event(start_timestamp: datetime.datetime, end_timestamp:
         user_id=user.id
     )
     db.session.add(event)
+    queue_push_to_room_owners(NotificationURL(
+        title=f'{user.first_name} scheduled washing on {start_timestamp.strftime("%d-%m at %H:%M")}.',
+        body='Go check the schedule for more details.',
+        icon='cycle-reminder-icon.png',
+        url=f'/schedule?date={start_timestamp.strftime("%Y-%m-%d")}'
+    ))
     db.session.commit()
 
     CeleryTask.start_schedule_notification_task(user.id, event.id, start_timestamp, session['timezone'])
 
-    interested_users = User.query.filter(User.roles.any(name='room_owner')).all()
-    for interested_user in interested_users:
-        send_push_to_user(interested_user, NotificationURL(
-            title=f'{user.first_name} scheduled washing on {start_timestamp.strftime("%d-%m at %H:%M")}.',
-            body='Go check the schedule for more details.',
-            icon='cycle-reminder-icon.png',
-            url=f'/schedule?date={start_timestamp.strftime("%Y-%m-%d")}'
-        ))
-
 
 def schedule_update_event(event_id: int, start_timestamp: datetime.datetime, end_timestamp: datetime.datetime, user: User):
     """ Updates an existing event in the schedule. """
@@ -552,21 +561,18 @@ def schedule_update_event(event_id: int, start_timestamp: datetime.datetime, end
         return redirect(request.path)
     event.start_timestamp = start_timestamp
     event.end_timestamp = end_timestamp
+    queue_push_to_room_owners(NotificationURL(
+        title=f'{user.first_name} rescheduled washing on {start_timestamp.strftime("%d-%m at %H:%M")}.',
+        body='Go check the schedule for more details.',
+        icon='cycle-reminder-icon.png',
+        url=f'/schedule?date={start_timestamp.strftime("%Y-%m-%d")}'
+    ))
     db.session.commit()
 
     if event.notification_task:
         event.notification_task.terminate()
         CeleryTask.start_schedule_notification_task(user.id, event.id, start_timestamp, session['timezone'])
 
-    interested_users = User.query.filter(User.roles.any(name='room_owner')).all()
-    for interested_user in interested_users:
-        send_push_to_user(interested_user, NotificationURL(
-            title=f'{user.first_name} rescheduled washing on {start_timestamp.strftime("%d-%m at %H:%M")}.',
-            body='Go check the schedule for more details.',
-            icon='cycle-reminder-icon.png',
-            url=f'/schedule?date={start_timestamp.strftime("%Y-%m-%d")}'
-        ))
-
 
 def schedule_delete_event(event_id: int, user: User):
     """ Deletes an event from the schedule. """
@@ -580,17 +586,14 @@ def schedule_delete_event(event_id: int, user: User):
     else:
         if event.notification_task:
             event.notification_task.terminate()
-        db.session.delete(event)
-        db.session.commit()
-
-    interested_users = User.query.filter(User.roles.any(name='room_owner')).all()
-    for interested_user in interested_users:
-        send_push_to_user(interested_user, NotificationURL(
+        queue_push_to_room_owners(NotificationURL(
             title=f'{user.first_name} canceled washing on {event.start_timestamp.strftime("%d-%m at %H:%M")}.',
             body='Go check the schedule for more details.',
             icon='cycle-reminder-icon.png',
             url=f'/schedule?date={event.start_timestamp.strftime("%Y-%m-%d")}'
         ))
+        db.session.delete(event)
+        db.session.commit()
 
 
 def on_washing_machine_notes_limit_breach(request_limit):
@@ -601,10 +604,11 @@ def on_washing_machine_notes_limit_breach(request_limit):
 
 @roles_required('admin')
 def admin_stop_cycle(user: User):
-    cycle: WashingCycle = WashingCycle.query.filter_by(end_timestamp=None).first()
-    if not cycle:
+    active_cycle = get_active_cycle()
+    if not active_cycle:
         flash('No cycle to stop!', category='toast-warning')
         return redirect(request.path)
+    cycle = db.session.get(WashingCycle, active_cycle.id)
 
     current_app.logger.info(f'Admin {user.username} is stopping the cycle for user {cycle.user.username}.')
     try:
@@ -612,11 +616,12 @@ def admin_stop_cycle(user: User):
     except ChildProcessError as exc:
         flash(exc, category='toast-error')
         return
-    send_push_to_user(cycle.user, Notification(
+    queue_push_to_user(cycle.user, Notification(
         title='Cycle stopped by admin',
         body='The admin has stopped your cycle.',
         icon='cycle-reminder-icon.png'
     ))
+    db.session.commit()
     flash('Cycle stopped by admin', category='toast-success')
 
 
@@ -628,27 +633,87 @@ def admin_start_cycle(user: User):
     except ChildProcessError as exc:
         flash(exc, category='toast-error')
         return
-    send_push_to_user(user, Notification(
+    queue_push_to_user(user, Notification(
         title='Cycle started by admin',
         body='The admin has started a cycle for you.',
         icon='cycle-reminder-icon.png'
     ))
+    db.session.commit()
     flash('Cycle started by admin', category='toast-success')
 
 
-def record_payment(user: User, amount: decimal.Decimal):
-    """ Records a payment for washing cycles by a user. """
-    if user.has_role('room_owner'):
-        # Room owners cannot pay for cycles
-        return
-    record = WashingCyclePayment(user_id=user.id, amount=amount)
-    db.session.add(record)
-    db.session.commit()
+PAYMENT_OUTCOME_MESSAGES = {
+    'paid': 'Marked as paid',
+    'not_found': 'The cycle was not found',
+    'running': 'The cycle is still running',
+    'split_pending': 'You can mark the cycle as paid only after all users have accepted the split',
+    'not_owner': 'You can only mark your own cycles as paid',
+    'already_paid': 'The cycle is already marked as paid',
+}
+
+
+@dataclasses.dataclass
+class BatchPayment:
+    """ The outcome of marking each of the requested cycles as paid, and the amount paid for them. """
+    outcomes: dict[int, str]
+    amount: decimal.Decimal
+
+
+def mark_cycles_paid(user: User, cycle_ids: list[int]) -> BatchPayment:
+    """
+    Marks the cycles of a user and their accepted shares of split cycles as paid, records the payment and queues
+    the notification of the room owners, all in one transaction. Each cycle gets one of the outcomes 'paid',
+    'not_found', 'running', 'split_pending', 'not_owner' or 'already_paid'.
+    """
+    cycle_ids = list(dict.fromkeys(cycle_ids))
+    own_split = aliased(WashingCycleSplit)
+    pending_splits = db.select(db.func.count(WashingCycleSplit.user_id)).where(
+        WashingCycleSplit.cycle_id == WashingCycle.id, WashingCycleSplit.accepted.is_not(True)
+    ).correlate(WashingCycle).scalar_subquery()
+    rows = db.session.query(
+        WashingCycle.id, WashingCycle.user_id, WashingCycle.end_timestamp, WashingCycle.paid,
+        WashingCycle.share_cents, pending_splits.label('pending_splits'),
+        own_split.user_id.label('split_user_id'), own_split.paid.label('split_paid')
+    ).outerjoin(own_split, and_(own_split.cycle_id == WashingCycle.id, own_split.user_id == user.id)).filter(
+        WashingCycle.id.in_(cycle_ids)
+    ).with_for_update(of=WashingCycle).all()
+
+    outcomes = dict.fromkeys(cycle_ids, 'not_found')
+    own_cycle_ids, split_cycle_ids, cents = [], [], 0
+    for row in rows:
+        if row.end_timestamp is None:
+            outcomes[row.id] = 'running'
+        elif row.pending_splits:
+            outcomes[row.id] = 'split_pending'
+        elif row.user_id != user.id and row.split_user_id is None:
+            outcomes[row.id] = 'not_owner'
+        elif row.paid if row.user_id == user.id else row.split_paid:
+            outcomes[row.id] = 'already_paid'
+        else:
+            outcomes[row.id] = 'paid'
+            (own_cycle_ids if row.user_id == user.id else split_cycle_ids).append(row.id)
+            cents += row.share_cents
 
-    interested_users = User.query.filter(User.roles.any(name='room_owner')).all()
-    for interested_user in interested_users:
-        send_push_to_user(interested_user, Notification(
+    if not own_cycle_ids and not split_cycle_ids:
+        db.session.rollback()
+        return BatchPayment(outcomes, decimal.Decimal('0.00'))
+
+    if own_cycle_ids:
+        db.session.execute(update(WashingCycle).where(WashingCycle.id.in_(own_cycle_ids)).values(paid=True))
+    if split_cycle_ids:
+        db.session.execute(update(WashingCycleSplit).where(
+            WashingCycleSplit.user_id == user.id, WashingCycleSplit.cycle_id.in_(split_cycle_ids)
+        ).values(paid=True))
+    refresh_balances({user.id})
+
+    payment = BatchPayment(outcomes, cents_to_decimal(cents))
+    # Room owners cannot pay for cycles
+    if not user.has_role('room_owner'):
+        db.session.add(WashingCyclePayment(user_id=user.id, amount=payment.amount))
+        queue_push_to_room_owners(Notification(
             title=f'{user.first_name} marked cycles as paid!',
-            body=f'They marked cycles for {amount} lv. as paid!',
+            body=f'They marked cycles for {payment.amount} lv. as paid!',
             icon='paid-cycles-icon.png'
         ))
+    db.session.commit()
+    return payment
@@ -0,0 +1,99 @@
+import decimal
+from typing import Iterable
+
+import click
+from flask.cli import AppGroup
+
+from app.db import db
+from app.models import User, UserBalance, WashingCycle
+from app.statistics import cycle_shares, aggregate_cycle_shares
+
+ledger_cli = AppGroup('ledger', help='Maintain the ledger of user balances.')
+
+
+def cycle_participant_ids(cycle: WashingCycle) -> set[int]:
+    """ Returns the ids of the users whose balance depends on the cycle, i.e. its owner and split users. """
+    return {user_id for user_id in [cycle.user_id, *[split.user_id for split in cycle.splits]] if user_id is not None}
+
+
+def compute_balances(user_ids: Iterable[int] = None) -> dict[int, tuple[int, decimal.Decimal]]:
+    """ Computes the unpaid cycles count and cost of the given users or all users from their cycle shares. """
+    shares = cycle_shares()
+    criteria = [shares.c.end_timestamp.is_not(None), shares.c.paid.is_(False), shares.c.user_id.is_not(None)]
+    if user_ids is not None:
+        criteria.append(shares.c.user_id.in_(user_ids))
+    return aggregate_cycle_shares(shares, *criteria)
+
+
+def refresh_balances(user_ids: Iterable[int]):
+    """
+    Recomputes the balances of the given users within the current transaction, so they are committed together
+    with the change of their cycles. The balance rows are locked first, so concurrent changes are serialized.
+    """
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return
+
+    balances = {balance.user_id: balance for balance in UserBalance.query.filter(
+        UserBalance.user_id.in_(user_ids)
+    ).order_by(UserBalance.user_id).with_for_update().all()}
+    computed = compute_balances(user_ids)
+
+    for user_id in user_ids:
+        if (balance := balances.get(user_id)) is None:
+            balance = UserBalance(user_id=user_id)
+            db.session.add(balance)
+        balance.unpaid_cycles, balance.unpaid_cost = computed.get(user_id, (0, decimal.Decimal('0.00')))
+
+
+def refresh_all_balances():
+    """ Recomputes the balances of every user, e.g. after the cycles have been repriced. """
+    refresh_balances(user_id for user_id, in db.session.query(User.id))
+
+
+def refresh_cycles_balances(after_id: int, up_to_id: int = None):
+    """ Recomputes the balances of the users taking part in the cycles with ids in the range (after_id, up_to_id]. """
+    shares = cycle_shares()
+    query = db.session.query(shares.c.user_id).filter(shares.c.cycle_id > after_id, shares.c.user_id.is_not(None))
+    if up_to_id is not None:
+        query = query.filter(shares.c.cycle_id <= up_to_id)
+    refresh_balances(user_id for user_id, in query.distinct())
+
+
+def diff_balances() -> dict[int, tuple[decimal.Decimal, decimal.Decimal]]:
+    """ Rebuilds the balances from scratch and returns the users whose ledger differs as (ledger, expected). """
+    computed = {user_id: cost for user_id, (count, cost) in compute_balances().items()}
+    ledger = {balance.user_id: balance.unpaid_cost for balance in UserBalance.query.all()}
+
+    differences = {}
+    for user_id in computed.keys() | ledger.keys():
+        expected = computed.get(user_id, decimal.Decimal('0.00'))
+        actual = ledger.get(user_id, decimal.Decimal('0.00'))
+        if actual != expected:
+            differences[user_id] = (actual, expected)
+    return differences
+
+
+@ledger_cli.command('verify')
+@click.option('--fix', is_flag=True, help='Rebuild the ledger if it differs.')
+def verify_command(fix: bool):
+    """ Rebuilds the ledger from scratch and compares it with the live one. """
+    differences = diff_balances()
+    for user_id, (actual, expected) in sorted(differences.items()):
+        click.echo(f'User {user_id}: ledger {actual}, expected {expected}')
+    if not differences:
+        click.echo('Ledger is consistent.')
+    elif fix:
+        refresh_all_balances()
+        db.session.commit()
+        click.echo(f'Ledger rebuilt, {len(differences)} balances fixed.')
+    else:
+        raise SystemExit(1)
+
+
+@ledger_cli.command('rebuild')
+def rebuild_command():
+    """ Rebuilds the balances of all users. """
+    refresh_all_balances()
+    db.session.commit()
+    click.echo('Ledger rebuilt.')
@@ -0,0 +1,139 @@
+import os
+import datetime
+import dataclasses
+import decimal
+from itertools import chain
+from typing import Optional
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from app.db import db
+from app.cache import BroadcastCache
+from app.models import User, WashingMachine, WashingCycle
+
+MACHINE_CONFIG_CHANNEL = 'laundrymaster:machine_config'
+ACTIVE_CYCLE_CHANNEL = 'laundrymaster:active_cycle'
+
+
+@dataclasses.dataclass(frozen=True)
+class MachineConfig:
+    """ Read-only snapshot of the washing machine settings, which change rarely but are read on every request. """
+    id: int
+    global_shutdown: bool
+    require_scheduling: bool
+    costperkwh: decimal.Decimal
+    public_wash_cost: decimal.Decimal
+    candy_device_id: str
+    candy_appliance_id: str
+    candy_api_token: Optional[str]
+
+
+MACHINE_CONFIG_COLUMNS = tuple(field.name for field in dataclasses.fields(MachineConfig))
+
+
+@dataclasses.dataclass(frozen=True)
+class ActiveCycle:
+    """ Read-only snapshot of the running cycle, of which there is at most one. """
+    id: int
+    user_id: int
+    user_first_name: str
+    start_timestamp: datetime.datetime
+
+
+def load_machine_config() -> MachineConfig:
+    row = db.session.query(*[getattr(WashingMachine, column) for column in MACHINE_CONFIG_COLUMNS]).first()
+    return MachineConfig(**row._asdict())
+
+
+def load_active_cycle() -> Optional[ActiveCycle]:
+    row = db.session.query(WashingCycle.id, WashingCycle.user_id, User.first_name, WashingCycle.start_timestamp) \
+        .outerjoin(User, User.id == WashingCycle.user_id) \
+        .filter(WashingCycle.end_timestamp.is_(None)).first()
+    return ActiveCycle(*row) if row is not None else None
+
+
+def get_machine_config_cache() -> BroadcastCache:
+    """ Returns the machine configuration cache of the current app, creating it on first use. """
+    if 'machine_config' not in current_app.extensions:
+        current_app.extensions['machine_config'] = BroadcastCache(
+            MACHINE_CONFIG_CHANNEL, load_machine_config, ttl=int(os.getenv('MACHINE_CACHE_TTL', 5))
+        )
+    return current_app.extensions['machine_config']
+
+
+def get_active_cycle_cache() -> BroadcastCache:
+    """ Returns the active cycle cache of the current app, creating it on first use. """
+    if 'active_cycle' not in current_app.extensions:
+        current_app.extensions['active_cycle'] = BroadcastCache(
+            ACTIVE_CYCLE_CHANNEL, load_active_cycle, ttl=int(os.getenv('MACHINE_CACHE_TTL', 5))
+        )
+    return current_app.extensions['active_cycle']
+
+
+def get_machine_config() -> MachineConfig:
+    """ Returns the cached configuration of the washing machine. """
+    return get_machine_config_cache().get()
+
+
+def get_active_cycle() -> Optional[ActiveCycle]:
+    """ Returns the cached running cycle or None if the machine is free. """
+    return get_active_cycle_cache().get()
+
+
+@event.listens_for(Session, 'after_flush')
+def track_machine_writes(session, flush_context):
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, WashingMachine) and \
+                any(inspect(instance).attrs[column].history.has_changes() for column in MACHINE_CONFIG_COLUMNS):
+            session.info['machine_config_changed'] = True
+        elif isinstance(instance, WashingCycle) and \
+                (instance in session.new or instance in session.deleted or
+                 inspect(instance).attrs.end_timestamp.history.has_changes()):
+            session.info['active_cycle_changed'] = True
+
+
+def bulk_updated_columns(orm_execute_state) -> set[str]:
+    """
+    Returns the names of the columns set by a bulk UPDATE, whether by its values or its parameter sets.
+    The primary key of a parameter set only selects the row to update.
+    """
+    statement = orm_execute_state.statement
+    columns = {getattr(column, 'key', column) for column, _ in statement._ordered_values or ()}
+    columns.update(getattr(column, 'key', column) for column in statement._values or ())
+    parameters = orm_execute_state.parameters
+    primary_keys = {column.key for column in orm_execute_state.bind_mapper.primary_key}
+    for row in parameters if isinstance(parameters, list) else [parameters or {}]:
+        columns.update(getattr(column, 'key', column) for column in row if column not in primary_keys)
+    return columns
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def track_bulk_machine_writes(orm_execute_state):
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None:
+        return
+    if issubclass(mapper.class_, WashingMachine) and (orm_execute_state.is_delete or (
+            orm_execute_state.is_update and not bulk_updated_columns(orm_execute_state).isdisjoint(MACHINE_CONFIG_COLUMNS))):
+        orm_execute_state.session.info['machine_config_changed'] = True
+    elif orm_execute_state.is_delete and issubclass(mapper.class_, WashingCycle):
+        orm_execute_state.session.info['active_cycle_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_machine_writes(session):
+    machine_config_changed = session.info.pop('machine_config_changed', False)
+    active_cycle_changed = session.info.pop('active_cycle_changed', False)
+    if not has_app_context():
+        return
+    if machine_config_changed:
+        get_machine_config_cache().publish()
+    if active_cycle_changed:
+        get_active_cycle_cache().publish()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_machine_writes(session):
+    session.info.pop('machine_config_changed', None)
+    session.info.pop('active_cycle_changed', None)
@@ -1,10 +1,14 @@
 import os
+import uuid
+import decimal
 import pytz
 import enum
 import datetime
+from typing import Optional
 
 from app import db
 
+from flask import current_app
 from flask_security import UserMixin, RoleMixin
 from sqlalchemy import func, event
 from sqlalchemy.orm import Session
@@ -53,6 +57,11 @@ class UserSettings(db.Model):
 
 class WashingCycle(db.Model):
     __tablename__ = 'washing_cycles'
+    __table_args__ = (
+        db.Index('ix_washing_cycles_end_timestamp', 'end_timestamp'),
+        db.Index('ix_washing_cycles_user_id_paid_end_timestamp', 'user_id', 'paid', 'end_timestamp'),
+        db.Index('ix_washing_cycles_start_timestamp_id', 'start_timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     startkwh = db.Column(db.Numeric(20, 4))
     endkwh = db.Column(db.Numeric(20, 4))
@@ -65,22 +74,83 @@ class WashingCycle(db.Model):
     splits = db.relationship('WashingCycleSplit', backref='washing_cycle', lazy=True)
     notification_task = db.relationship(
         'CeleryTask',
-        primaryjoin='foreign(CeleryTask.ref_id) == WashingCycle.id',
+        primaryjoin="and_(foreign(CeleryTask.ref_id) == WashingCycle.id, "
+                    "CeleryTask.kind == 'CYCLE_NOTIFICATION')",
         backref='washing_cycles',
         lazy=True,
         uselist=False,
         viewonly=True
     )
 
+    @property
+    def split_cost(self) -> Optional[decimal.Decimal]:
+        """ The share of the cost of each user if the cycle is split, computed by the database. """
+        if not self.splits_count:
+            return None
+        return (decimal.Decimal(self.share_cents) / 100).quantize(decimal.Decimal('0.01'))
+
 
 class WashingCycleSplit(db.Model):
     __tablename__ = 'split_cycles'
+    __table_args__ = (
+        db.Index('ix_split_cycles_user_id_paid', 'user_id', 'paid'),
+    )
     cycle_id = db.Column(db.Integer, db.ForeignKey('washing_cycles.id'), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
     paid = db.Column(db.Boolean(), default=False)
     accepted = db.Column(db.Boolean(), default=False)
 
 
+def split_share_cents(cost, splits_count):
+    """
+    SQL expression of the share of a cycle cost in cents, when the cycle is split between splits_count other users.
+    The share is rounded up to the cent, so the shares always add up to at least the cost.
+    """
+    cents = db.cast(db.func.round(db.func.coalesce(cost, 0) * 100), db.Integer)
+    return (cents + splits_count) // (splits_count + 1)
+
+
+def cycle_splits_count():
+    """ Correlated SQL subquery counting the splits of a cycle. """
+    return db.select(db.func.count(WashingCycleSplit.user_id)) \
+        .where(WashingCycleSplit.cycle_id == WashingCycle.id) \
+        .correlate(WashingCycle) \
+        .scalar_subquery()
+
+
+# Deferred, so only the queries which show the split costs run the subqueries, with undefer_group('splits')
+WashingCycle.splits_count = db.column_property(cycle_splits_count(), deferred=True, group='splits')
+WashingCycle.share_cents = db.column_property(split_share_cents(WashingCycle.cost, cycle_splits_count()),
+                                              deferred=True, group='splits')
+
+# At most one cycle can be running, which also makes looking it up a single index probe
+db.Index('uq_washing_cycles_open_cycle', WashingCycle.end_timestamp.is_(None), unique=True,
+         sqlite_where=WashingCycle.end_timestamp.is_(None), postgresql_where=WashingCycle.end_timestamp.is_(None))
+
+
+class UserBalance(db.Model):
+    """ Ledger row with the unpaid cycle shares of a user, kept up to date by app.ledger. """
+    __tablename__ = 'user_balances'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    unpaid_cost = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    unpaid_cycles = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+
+class MonthlyRollup(db.Model):
+    """ Monthly totals of the cycle shares of a user, kept up to date by app.rollups. """
+    __tablename__ = 'monthly_rollups'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    month = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    cost = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    kwh = db.Column(db.Numeric(20, 4), nullable=False, default=0)
+    cycles = db.Column(db.Integer, nullable=False, default=0)
+    # Cycles costing enough to be compared with the public laundry and their total cost
+    savings_cycles = db.Column(db.Integer, nullable=False, default=0)
+    savings_cost = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+
+
 class WashingMachine(db.Model):
     __tablename__ = 'washing_machine'
     id = db.Column(db.Integer, primary_key=True)
@@ -92,19 +162,59 @@ class WashingMachine(db.Model):
     candy_appliance_id = db.Column(db.String(512), nullable=False)
     candy_api_token = db.Column(db.String(5000), nullable=True)
     candy_api_refresh_token = db.Column(db.String(512), nullable=True)
-    candy_appliance_data = db.Column(db.PickleType, nullable=True)
     global_shutdown = db.Column(db.Boolean(), default=False)
     require_scheduling = db.Column(db.Boolean(), default=False)
 
 
+class CandySnapshot(db.Model):
+    """ Last state reported by the Candy API, kept apart so the machine settings can be read without it. """
+    __tablename__ = 'candy_snapshots'
+    washing_machine_id = db.Column(db.Integer, db.ForeignKey('washing_machine.id'), primary_key=True)
+    data = db.Column(db.JSON, nullable=False)
+    updated_at = db.Column(db.DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+
 class PushSubscription(db.Model):
+    """
+    A browser subscription to web push. It is identified by the SHA-256 digest of its normalised endpoint,
+    so registering it again from the same browser updates the row instead of adding one.
+    """
+    __table_args__ = (
+        db.Index('uq_push_subscription_endpoint_digest', 'endpoint_digest', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True, unique=True)
     subscription_json = db.Column(db.Text, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    endpoint = db.Column(db.Text, nullable=False)
+    endpoint_digest = db.Column(db.String(64), nullable=False)
+    user_agent = db.Column(db.String(512), nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), default=func.now())
+    last_success_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    failure_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PushOutbox(db.Model):
+    """
+    A push notification waiting to be delivered, written in the transaction of the change it announces.
+    A user_id of None sends the notification to every subscription.
+    """
+    __tablename__ = 'push_outbox'
+    __table_args__ = (
+        db.Index('ix_push_outbox_next_attempt_at', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    payload = db.Column(db.JSON, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime(timezone=True), default=func.now())
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=False, default=func.now())
 
 
 class ScheduleEvent(db.Model):
     __tablename__ = 'schedule'
+    __table_args__ = (
+        db.Index('ix_schedule_start_timestamp_end_timestamp', 'start_timestamp', 'end_timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True, unique=True)
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now())
     start_timestamp = db.Column(db.DateTime(timezone=True))
@@ -113,7 +223,8 @@ class ScheduleEvent(db.Model):
     user = db.relationship('User', backref=db.backref('schedule_events', lazy=True))
     notification_task = db.relationship(
         'CeleryTask',
-        primaryjoin='foreign(CeleryTask.ref_id) == ScheduleEvent.id',
+        primaryjoin="and_(foreign(CeleryTask.ref_id) == ScheduleEvent.id, "
+                    "CeleryTask.kind == 'SCHEDULE_NOTIFICATION')",
         backref='schedule',
         lazy=True,
         uselist=False,
@@ -194,6 +305,12 @@ cycle_termination_reminder_notification = Notification(
     icon="cycle-reminder-icon.png",
 )
 
+wash_program_failed_notification = Notification(
+    title="Washing program failed",
+    body="Your washing program failed to start. Please try again!",
+    icon="cycle-done-icon.png"
+)
+
 unpaid_cycles_reminder_notification = NotificationURL(
     title='You have unpaid cycles!',
     body='Please pay your debt to the room owner!',
@@ -228,19 +345,50 @@ class CeleryTask(db.Model):
         DISABLE_GUEST_USER = 6
 
     __tablename__ = 'tasks'
+    __table_args__ = (
+        db.Index('ix_tasks_kind_ref_id', 'kind', 'ref_id'),
+    )
     id = db.Column(db.String(512), primary_key=True)
     kind = db.Column(db.Enum(TaskKinds))
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now())
     ref_id = db.Column(db.Integer, nullable=True)
-
-    def terminate(self, erase: bool = True):
-        from celery.result import AsyncResult
-        print(f'Terminating task {self.id}')
-        AsyncResult(self.id).revoke(terminate=True)
-        if erase:
-            db.session.delete(self)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    payload = db.Column(db.JSON, nullable=True)
+
+    def update_payload(self, **kwargs):
+        # JSON columns do not track in-place changes, so the dict is reassigned
+        self.payload = {**(self.payload or {}), **kwargs}
+
+    def terminate(self, commit: bool = True):
+        """
+        Cancels the task by deleting its row. Pending steps check for their row before doing anything,
+        so nothing has to be revoked on the workers. With commit=False the deletion is left to the caller's
+        transaction.
+        """
+        current_app.logger.info(f'Terminating task {self.id}')
+        db.session.delete(self)
+        if commit:
             db.session.commit()
 
+    def schedule_step(self, task, step: str, *args, countdown: float = 0):
+        """
+        Persists the next step of the flow and schedules it with a countdown instead of sleeping in a worker.
+        The step gets its id before it is sent, so it can never run ahead of the committed state.
+        """
+        step_task_id = uuid.uuid4().hex
+        eta = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=countdown)
+        self.update_payload(step=step, step_task_id=step_task_id, step_eta=eta.isoformat())
+        db.session.commit()
+        task.apply_async((self.id, *args), countdown=countdown, task_id=step_task_id)
+
+    @staticmethod
+    def claim_step(task_id: str, step_task_id: str):
+        """ Returns the task if the step is still the pending one, otherwise the flow was cancelled or moved on. """
+        task = db.session.get(CeleryTask, task_id)
+        if task is None or (task.payload or {}).get('step_task_id') != step_task_id:
+            return None
+        return task
+
     @staticmethod
     def start_release_door_task(username: str):
         from app.tasks import release_door_task
@@ -250,11 +398,12 @@ class CeleryTask(db.Model):
             raise RuntimeError('There is already a release door task running!')
 
         new_task = CeleryTask(
-            id=release_door_task.delay(username).id,
-            kind=CeleryTask.TaskKinds.RELEASE_DOOR
+            id=uuid.uuid4().hex,
+            kind=CeleryTask.TaskKinds.RELEASE_DOOR,
+            payload={'username': username}
         )
         db.session.add(new_task)
-        db.session.commit()
+        new_task.schedule_step(release_door_task, 'relay_on', 'on')
         return new_task
 
     @staticmethod
@@ -264,29 +413,30 @@ class CeleryTask(db.Model):
         timezone_aware_start_timestamp = pytz.timezone(timezone).localize(start_timestamp)
         eta = timezone_aware_start_timestamp - datetime.timedelta(minutes=int(os.getenv('SCHEDULE_REMINDER_DELTA', 5)))
 
+        # The row is committed before the task is sent, because a reminder which is already due runs right away
         new_task = CeleryTask(
-            id=schedule_notification_task.apply_async(
-                (user_id,),
-                eta=eta
-            ).id,
+            id=uuid.uuid4().hex,
             kind=CeleryTask.TaskKinds.SCHEDULE_NOTIFICATION,
             ref_id=event_id
         )
         db.session.add(new_task)
         db.session.commit()
+        schedule_notification_task.apply_async((user_id,), eta=eta, task_id=new_task.id)
         return new_task
 
     @staticmethod
-    def start_cycle_end_notification_task(user_id: int, cycle_id: int, wait_time: int = 10):
-        from app.tasks import cycle_end_notification_task
+    def start_cycle_end_notification_task(user_id: int, cycle_id: int):
+        """ Subscribes the user to the machine state transitions for the duration of the cycle. """
         from app.models import UserSettings
 
         user_settings = UserSettings.query.filter_by(user_id=user_id).first()
 
         new_task = CeleryTask(
-            id=cycle_end_notification_task.delay(user_id, user_settings.terminate_cycle_on_usage, wait_time).id,
+            id=uuid.uuid4().hex,
             kind=CeleryTask.TaskKinds.CYCLE_NOTIFICATION,
-            ref_id=cycle_id
+            ref_id=cycle_id,
+            user_id=user_id,
+            payload={'terminate_cycle': user_settings.terminate_cycle_on_usage, 'finished_count': 0}
         )
         db.session.add(new_task)
         db.session.commit()
@@ -297,20 +447,24 @@ class CeleryTask(db.Model):
         from app.tasks import recalculate_cycles_cost_task
 
         recalculate_cycles_cost_tasks = CeleryTask.query.filter_by(kind=CeleryTask.TaskKinds.RECALCULATE_CYCLES_COST).all()
-        if recalculate_cycles_cost_tasks:
+        if any((task.payload or {}).get('step') != 'done' for task in recalculate_cycles_cost_tasks):
             raise RuntimeError('There is already a recalculate cycles cost task scheduled!')
+        for task in recalculate_cycles_cost_tasks:
+            db.session.delete(task)
 
         new_task = CeleryTask(
-            id=recalculate_cycles_cost_task.delay().id,
+            id=uuid.uuid4().hex,
             kind=CeleryTask.TaskKinds.RECALCULATE_CYCLES_COST
         )
         db.session.add(new_task)
-        db.session.commit()
+        # Giving some time to cancel the task if it was started by mistake
+        new_task.schedule_step(recalculate_cycles_cost_task, 'recalculate', countdown=30 * 60)
         return new_task
 
     @staticmethod
     def start_wash_then_dry_task(user_id, start_program_form):
-        from app.tasks import schedule_program_start_task
+        """ Starts the wash program and subscribes to the machine state transitions to start drying after it. """
+        from app.tasks import start_wash_then_dry_task
         from app.candy import process_start_program_form
 
         wash_then_dry_tasks = CeleryTask.query.filter_by(kind=CeleryTask.TaskKinds.WASH_THEN_DRY).all()
@@ -320,33 +474,39 @@ class CeleryTask(db.Model):
         wash_command, dry_command = process_start_program_form(start_program_form)
 
         new_task = CeleryTask(
-            id=schedule_program_start_task.delay(wash_command, dry_command, user_id).id,
+            id=uuid.uuid4().hex,
             kind=CeleryTask.TaskKinds.WASH_THEN_DRY,
-            ref_id=user_id
+            user_id=user_id,
+            payload={'wash_command': wash_command, 'dry_command': dry_command, 'has_ran': False}
         )
         db.session.add(new_task)
         db.session.commit()
+        start_wash_then_dry_task.delay(new_task.id)
         return new_task
 
     @staticmethod
     def start_disable_guest_after_finish_task(user_id: int):
         from app.tasks import disable_guest_after_finish_task
 
-        disable_user_task = CeleryTask.query.filter_by(kind=CeleryTask.TaskKinds.DISABLE_GUEST_USER, ref_id=user_id).all()
+        disable_user_task = CeleryTask.query.filter_by(kind=CeleryTask.TaskKinds.DISABLE_GUEST_USER, user_id=user_id).all()
         if disable_user_task:
             raise RuntimeError('There is already a disable guest user task scheduled!')
 
         new_task = CeleryTask(
-            id=disable_guest_after_finish_task.delay(user_id).id,
-            kind=CeleryTask.TaskKinds.DISABLE_GUEST_USER
+            id=uuid.uuid4().hex,
+            kind=CeleryTask.TaskKinds.DISABLE_GUEST_USER,
+            user_id=user_id
         )
         db.session.add(new_task)
-        db.session.commit()
+        new_task.schedule_step(disable_guest_after_finish_task, 'disable', countdown=5 * 60)
         return new_task
 
 
 class WashingCyclePayment(db.Model):
     __tablename__ = 'payments'
+    __table_args__ = (
+        db.Index('ix_payments_propagated_timestamp_id', 'propagated', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now())
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
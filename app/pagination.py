@@ -0,0 +1,65 @@
+import json
+import base64
+import decimal
+import datetime
+import dataclasses
+from typing import Optional
+
+from app.db import db
+
+
+@dataclasses.dataclass
+class Page:
+    """ A page of rows together with the cursor of the next page, which is None on the last page. """
+    items: list
+    next_cursor: Optional[str]
+
+
+def encode_cursor(timestamp: datetime.datetime, row_id: int) -> str:
+    """ Encodes the sort key of the last row of a page into an opaque URL-safe cursor. """
+    payload = json.dumps([timestamp.isoformat(), row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    """ Decodes a cursor made by encode_cursor, raises ValueError if it is malformed. """
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return datetime.datetime.fromisoformat(timestamp), int(row_id)
+    except (TypeError, json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+
+def paginate_keyset(query, timestamp_column, id_column, limit: Optional[int], cursor: str = None) -> Page:
+    """
+    Returns the page of the query after the cursor, newest first, or all the rows after it if limit is None.
+    The rows are ordered by (timestamp, id), so each page is a single range scan of an index on these columns,
+    no matter how deep into the history it is.
+    """
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        query = query.filter(db.tuple_(timestamp_column, id_column) < db.tuple_(timestamp, row_id))
+    query = query.order_by(timestamp_column.desc(), id_column.desc())
+    rows = query.limit(limit + 1).all() if limit is not None else query.all()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]._mapping
+        next_cursor = encode_cursor(last[timestamp_column], last[id_column])
+    return Page(rows, next_cursor)
+
+
+def page_json(page: Page) -> dict:
+    """ Returns the page as a JSON object, with the decimals as strings and the timestamps in ISO format. """
+    def value_json(value):
+        if isinstance(value, decimal.Decimal):
+            return str(value)
+        elif isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        return value
+
+    return {
+        'items': [{key: value_json(value) for key, value in row._asdict().items()} for row in page.items],
+        'next_cursor': page.next_cursor
+    }
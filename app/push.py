@@ -0,0 +1,256 @@
+import os
+import json
+import hashlib
+import time
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urlsplit, urlunsplit
+
+from flask import current_app, has_app_context
+from py_vapid import Vapid
+from pywebpush import webpush, WebPushException
+from requests.exceptions import RequestException
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from app.db import db
+from app.models import PushSubscription, PushOutbox, Notification
+from app.clients import ApiClient
+
+# Push services reply with these codes once a subscription has expired or was revoked by the browser
+GONE_STATUS_CODES = (404, 410)
+
+# The signed VAPID tokens are valid for 12 hours and reused until an hour before they expire
+VAPID_TOKEN_TTL = 12 * 60 * 60
+VAPID_TOKEN_REFRESH = 60 * 60
+
+_push_clients: dict[str, ApiClient] = {}
+_push_clients_lock = threading.Lock()
+_vapid_keys: dict[str, Vapid] = {}
+_vapid_headers: dict[tuple[str, str, str], tuple[float, dict]] = {}
+_vapid_lock = threading.Lock()
+
+
+def push_max_workers() -> int:
+    return int(os.getenv('PUSH_MAX_WORKERS', 8))
+
+
+def normalize_endpoint(endpoint: str) -> str:
+    """ Returns the endpoint with surrounding whitespace, the fragment and the case of the scheme and host removed. """
+    url = urlsplit(endpoint.strip())
+    return urlunsplit((url.scheme.lower(), url.netloc.lower(), url.path, url.query, ''))
+
+
+def endpoint_digest(endpoint: str) -> str:
+    return hashlib.sha256(normalize_endpoint(endpoint).encode()).hexdigest()
+
+
+def register_push_subscription(subscription_json: str, user_id: int, user_agent: str = None):
+    """
+    Adds a push subscription or, if its endpoint is already registered, updates its keys, user and user agent,
+    as a single upsert on the endpoint digest. Raises ValueError if the subscription is malformed.
+    """
+    try:
+        endpoint = json.loads(subscription_json)['endpoint']
+        if not isinstance(endpoint, str) or not endpoint.strip():
+            raise ValueError(f'Invalid push subscription endpoint: {endpoint!r}')
+    except (TypeError, KeyError, json.JSONDecodeError) as e:
+        raise ValueError('Invalid push subscription') from e
+
+    dialect = db.session.get_bind().dialect.name
+    statement = (postgresql.insert if dialect == 'postgresql' else sqlite.insert)(PushSubscription).values(
+        subscription_json=subscription_json, user_id=user_id, endpoint=normalize_endpoint(endpoint),
+        endpoint_digest=endpoint_digest(endpoint), user_agent=user_agent and user_agent[:512], failure_count=0
+    )
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[PushSubscription.endpoint_digest],
+        set_={column: statement.excluded[column]
+              for column in ('subscription_json', 'user_id', 'user_agent', 'failure_count')}
+    ))
+
+
+def endpoint_origin(endpoint: str) -> str:
+    url = urlparse(endpoint)
+    return f'{url.scheme}://{url.netloc}'
+
+
+def push_client(endpoint: str) -> ApiClient:
+    """ Returns the client of the push service of the endpoint, so the connections to each origin are reused. """
+    origin = endpoint_origin(endpoint)
+    with _push_clients_lock:
+        if (client := _push_clients.get(origin)) is None:
+            # Push messages are not idempotent, so they are never retried
+            client = _push_clients[origin] = ApiClient('PUSH_SERVICE_ENDPOINT', retry_methods=frozenset(),
+                                                       pool_maxsize=push_max_workers())
+            client.base_url = origin
+        return client
+
+
+def vapid_headers(endpoint: str, private_key: str, claim_email: str) -> dict:
+    """
+    Returns the VAPID authorization headers for the push service of the endpoint. The key is parsed once per
+    process and the headers signed for each origin are reused for most of their validity.
+    """
+    key = (endpoint_origin(endpoint), private_key, claim_email)
+    now = time.time()
+    with _vapid_lock:
+        if (cached := _vapid_headers.get(key)) is not None and cached[0] > now:
+            return cached[1]
+        if (vapid := _vapid_keys.get(private_key)) is None:
+            vapid = _vapid_keys[private_key] = Vapid.from_file(private_key) if os.path.isfile(private_key) \
+                else Vapid.from_string(private_key=private_key)
+        expires_at = int(now) + VAPID_TOKEN_TTL
+        headers = vapid.sign({'sub': f'mailto:{claim_email}', 'aud': key[0], 'exp': expires_at})
+        _vapid_headers[key] = (expires_at - VAPID_TOKEN_REFRESH, headers)
+        return headers
+
+
+def deliver_push(subscription_info: dict, data: str, private_key: str, claim_email: str, logger) -> str:
+    """
+    Sends a push message through a subscription and returns 'sent', 'gone' if the push service no longer knows
+    the subscription or 'failed'. Runs in the worker threads, so it does not touch the application context.
+    """
+    client = push_client(subscription_info['endpoint'])
+    try:
+        webpush(
+            subscription_info=subscription_info,
+            data=data,
+            headers=vapid_headers(subscription_info['endpoint'], private_key, claim_email),
+            timeout=client.timeout,
+            requests_session=client.session
+        )
+        return 'sent'
+    except WebPushException as e:
+        status_code = e.response.status_code if e.response is not None else None
+        if status_code in GONE_STATUS_CODES:
+            return 'gone'
+        logger.error(f'Push service replied with {status_code}: {e}')
+    except RequestException as e:
+        logger.error(f'Error trying to send notification: {e}')
+    return 'failed'
+
+
+def deliver_pushes(jobs: list[tuple[PushSubscription, str]]) -> list[str]:
+    """
+    Sends the serialized messages through their subscriptions concurrently, with at most PUSH_MAX_WORKERS
+    requests at a time, and returns the outcome of each. In their own transaction, the subscriptions which the push
+    service reports as gone are deleted right away and the delivery metadata of the others is updated.
+    """
+    if not jobs:
+        return []
+    private_key = current_app.config['PUSH_PRIVATE_KEY']
+    claim_email = current_app.config['PUSH_CLAIM_EMAIL']
+    logger = current_app.logger
+    deliveries = [(subscription.id, json.loads(subscription.subscription_json), data) for subscription, data in jobs]
+
+    with ThreadPoolExecutor(max_workers=min(len(deliveries), push_max_workers())) as executor:
+        outcomes = list(executor.map(
+            lambda delivery: deliver_push(delivery[1], delivery[2], private_key, claim_email, logger), deliveries
+        ))
+
+    subscription_ids = {outcome: set() for outcome in ('sent', 'gone', 'failed')}
+    for delivery, outcome in zip(deliveries, outcomes):
+        subscription_ids[outcome].add(delivery[0])
+    if subscription_ids['gone']:
+        logger.info(f'Deleting {len(subscription_ids["gone"])} expired push subscriptions.')
+    with db.engine.begin() as connection:
+        if subscription_ids['gone']:
+            connection.execute(db.delete(PushSubscription).where(PushSubscription.id.in_(subscription_ids['gone'])))
+        if subscription_ids['sent']:
+            connection.execute(db.update(PushSubscription).where(PushSubscription.id.in_(subscription_ids['sent']))
+                               .values(last_success_at=db.func.now(), failure_count=0))
+        if subscription_ids['failed']:
+            connection.execute(db.update(PushSubscription).where(PushSubscription.id.in_(subscription_ids['failed']))
+                               .values(failure_count=PushSubscription.failure_count + 1))
+    return outcomes
+
+
+def send_push(subscriptions: list[PushSubscription], notification: Notification) -> list[bool]:
+    """ Sends a notification through the subscriptions and returns whether it was sent through each of them. """
+    data = json.dumps(notification.__dict__())
+    return [outcome == 'sent' for outcome in deliver_pushes([(subscription, data) for subscription in subscriptions])]
+
+
+def queue_push(notification: Notification, user_id: int = None):
+    """
+    Adds a notification for a user, or for everyone if user_id is None, to the outbox. It is delivered by Celery
+    once the current transaction commits, and never if it is rolled back.
+    """
+    db.session.add(PushOutbox(user_id=user_id, payload=notification.__dict__()))
+
+
+def push_outbox_backoff(attempts: int) -> datetime.timedelta:
+    return datetime.timedelta(seconds=float(os.getenv('PUSH_OUTBOX_BACKOFF', 30)) * 2 ** (attempts - 1))
+
+
+def dispatch_push_outbox(batch_size: int = None) -> int:
+    """
+    Delivers a batch of the due notifications of the outbox and returns how many were taken. Delivered notifications
+    are deleted. A notification which could not be sent through any subscription, e.g. while the push service is
+    down, is retried with exponential backoff up to PUSH_OUTBOX_MAX_ATTEMPTS times. One that was sent through some
+    subscriptions is not retried, so nobody gets it twice. The rows are locked, so concurrent dispatchers skip them.
+    """
+    batch_size = batch_size or int(os.getenv('PUSH_OUTBOX_BATCH_SIZE', 100))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    messages = PushOutbox.query.filter(PushOutbox.next_attempt_at <= now) \
+        .order_by(PushOutbox.id).limit(batch_size).with_for_update(skip_locked=True).all()
+    if not messages:
+        db.session.commit()
+        return 0
+
+    user_ids = {message.user_id for message in messages}
+    query = PushSubscription.query
+    if None not in user_ids:
+        query = query.filter(PushSubscription.user_id.in_(user_ids))
+    subscriptions = query.all()
+
+    jobs, job_messages = [], []
+    for message in messages:
+        data = json.dumps(message.payload)
+        for subscription in subscriptions:
+            if message.user_id is None or subscription.user_id == message.user_id:
+                jobs.append((subscription, data))
+                job_messages.append(message.id)
+    outcomes = deliver_pushes(jobs)
+
+    max_attempts = int(os.getenv('PUSH_OUTBOX_MAX_ATTEMPTS', 5))
+    for message in messages:
+        message_outcomes = [outcome for message_id, outcome in zip(job_messages, outcomes) if message_id == message.id]
+        message.attempts += 1
+        if 'failed' not in message_outcomes or 'sent' in message_outcomes:
+            db.session.delete(message)
+        elif message.attempts >= max_attempts:
+            current_app.logger.error(f'Giving up on push notification {message.id} after {message.attempts} attempts.')
+            db.session.delete(message)
+        else:
+            message.next_attempt_at = now + push_outbox_backoff(message.attempts)
+    db.session.commit()
+    return len(messages)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_queued_pushes(session, flush_context):
+    if any(isinstance(instance, PushOutbox) for instance in session.new):
+        session.info['push_queued'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def dispatch_queued_pushes(session):
+    if not session.info.pop('push_queued', False) or not has_app_context():
+        return
+    # Without a broker, e.g. when testing, the notifications wait for the dispatch_push_outbox task
+    if current_app.testing or current_app.debug:
+        return
+    from app.tasks import dispatch_push_outbox_task
+    try:
+        dispatch_push_outbox_task.delay()
+    except Exception as e:
+        # The change is committed already, the scheduled dispatch delivers the notifications once the broker is back
+        current_app.logger.warning(f'Could not start the push outbox dispatch: {e}')
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_queued_pushes(session):
+    session.info.pop('push_queued', None)
@@ -0,0 +1,115 @@
+import decimal
+from itertools import product
+from typing import Iterable
+
+import click
+from flask.cli import AppGroup
+
+from app.db import db
+from app.models import MonthlyRollup, WashingCycle
+from app.statistics import cycle_shares, cents_to_decimal, in_months
+
+# Minimum cost of washing and drying, so the savings calculation would be accurate
+SAVINGS_MIN_COST = 0.30
+
+rollups_cli = AppGroup('rollups', help='Maintain the monthly rollups of user statistics.')
+
+
+def cycle_rollup_keys(cycle: WashingCycle, exclude_user_ids: set = None) -> set[tuple[int, int, int]]:
+    """ Returns the (user, year, month) rollups which depend on a finished cycle. """
+    if cycle.end_timestamp is None:
+        return set()
+    user_ids = {cycle.user_id, *[split.user_id for split in cycle.splits]} - {None} - (exclude_user_ids or set())
+    return {(user_id, cycle.end_timestamp.year, cycle.end_timestamp.month) for user_id in user_ids}
+
+
+def compute_rollups(user_ids: Iterable[int] = None, months: Iterable[tuple[int, int]] = None) -> dict:
+    """
+    Aggregates the cycle shares of the given users and months, or of everything, by user and month.
+    Returns the values of the rollup columns for each (user, year, month) with any cycles.
+    """
+    shares = cycle_shares()
+    year = db.func.extract('year', shares.c.end_timestamp)
+    month = db.func.extract('month', shares.c.end_timestamp)
+    is_savings = shares.c.cost > SAVINGS_MIN_COST
+
+    query = db.session.query(
+        shares.c.user_id, year, month,
+        db.func.count(shares.c.cycle_id),
+        db.func.sum(shares.c.share_cents),
+        db.func.sum(shares.c.kwh_share),
+        db.func.count(db.case((is_savings, shares.c.cycle_id))),
+        db.func.sum(db.case((is_savings, shares.c.cost), else_=0))
+    ).filter(shares.c.end_timestamp.is_not(None), shares.c.user_id.is_not(None))
+    if user_ids is not None:
+        query = query.filter(shares.c.user_id.in_(user_ids))
+    if months is not None:
+        query = query.filter(in_months(shares.c.end_timestamp, months))
+
+    rollups = {}
+    for user_id, row_year, row_month, cycles, cents, kwh, savings_cycles, savings_cost in \
+            query.group_by(shares.c.user_id, year, month).all():
+        rollups[(user_id, int(row_year), int(row_month))] = {
+            'cycles': cycles,
+            'cost': cents_to_decimal(cents),
+            'kwh': decimal.Decimal(kwh or 0).quantize(decimal.Decimal('0.0001')),
+            'savings_cycles': savings_cycles,
+            'savings_cost': decimal.Decimal(savings_cost or 0).quantize(decimal.Decimal('0.01'))
+        }
+    return rollups
+
+
+def refresh_rollups(keys: Iterable[tuple[int, int, int]]):
+    """ Recomputes the given (user, year, month) rollups within the current transaction. """
+    keys = set(keys)
+    if not keys:
+        return
+    user_ids = {user_id for user_id, year, month in keys}
+    months = {(year, month) for user_id, year, month in keys}
+
+    existing = {(rollup.user_id, rollup.year, rollup.month): rollup for rollup in MonthlyRollup.query.filter(
+        MonthlyRollup.user_id.in_(user_ids),
+        db.or_(*[db.and_(MonthlyRollup.year == year, MonthlyRollup.month == month) for year, month in months])
+    ).order_by(MonthlyRollup.user_id, MonthlyRollup.year, MonthlyRollup.month).with_for_update().all()}
+    computed = compute_rollups(user_ids, months)
+
+    for user_id, (year, month) in product(user_ids, months):
+        key = (user_id, year, month)
+        rollup = existing.get(key)
+        if key not in computed:
+            if rollup is not None:
+                db.session.delete(rollup)
+            continue
+        if rollup is None:
+            rollup = MonthlyRollup(user_id=user_id, year=year, month=month)
+            db.session.add(rollup)
+        for column, value in computed[key].items():
+            setattr(rollup, column, value)
+
+
+def refresh_cycles_rollups(after_id: int, up_to_id: int = None):
+    """ Recomputes the rollups which depend on the cycles with ids in the range (after_id, up_to_id]. """
+    shares = cycle_shares()
+    query = db.session.query(
+        shares.c.user_id,
+        db.func.extract('year', shares.c.end_timestamp),
+        db.func.extract('month', shares.c.end_timestamp)
+    ).filter(shares.c.cycle_id > after_id, shares.c.user_id.is_not(None), shares.c.end_timestamp.is_not(None))
+    if up_to_id is not None:
+        query = query.filter(shares.c.cycle_id <= up_to_id)
+    refresh_rollups((user_id, int(year), int(month)) for user_id, year, month in query.distinct())
+
+
+def rebuild_rollups():
+    """ Replaces all rollups with ones computed from the whole history of cycles. """
+    MonthlyRollup.query.delete()
+    for (user_id, year, month), values in compute_rollups().items():
+        db.session.add(MonthlyRollup(user_id=user_id, year=year, month=month, **values))
+
+
+@rollups_cli.command('backfill')
+def backfill_command():
+    """ Computes the rollups of the existing history of cycles. """
+    rebuild_rollups()
+    db.session.commit()
+    click.echo(f'Monthly rollups rebuilt, {MonthlyRollup.query.count()} rows.')
@@ -0,0 +1,117 @@
+import os
+import time
+import threading
+from typing import Optional
+
+from flask import current_app
+from requests.exceptions import RequestException
+
+from app.clients import shelly_client
+
+
+class ShellyDeviceStatus:
+    """ Parsed snapshot of a single Shelly Cloud device status response. """
+
+    def __init__(self, json_data: dict, fetched_at: float):
+        device_status = json_data['data']['device_status']
+        self.total_kwh: float = device_status['meters'][0]['total'] / 60000  # Watt-minute to kWatt-hour
+        self.power: float = device_status['meters'][0]['power']
+        self.relay_ison: bool = device_status['relays'][0]['ison']
+        self.temperature: float = device_status['temperature']
+        self.wifi_rssi: int = device_status['wifi_sta']['rssi']
+        self.fetched_at: float = fetched_at
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+class _StatusFetch:
+    """ A single in-flight request to Shelly Cloud, shared by all callers waiting for it. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.snapshot: Optional[ShellyDeviceStatus] = None
+        self.error: Optional[Exception] = None
+
+
+class ShellyStatusCache:
+    """
+    Per-process cache of the Shelly device status. All telemetry getters are served from one snapshot,
+    which is refreshed when it gets older than the freshness window. Concurrent callers wait on the
+    in-flight request instead of starting their own. Invalidating bumps the generation, so a request which was
+    in flight at that time is not joined by later callers and its result is not cached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot: Optional[ShellyDeviceStatus] = None
+        self._fetch: Optional[_StatusFetch] = None
+        self._generation = 0
+
+    def get(self, max_age: float = None) -> ShellyDeviceStatus:
+        if max_age is None:
+            max_age = float(os.getenv('SHELLY_STATUS_VALIDITY', 5))
+
+        with self._lock:
+            if self._snapshot is not None and self._snapshot.age <= max_age:
+                return self._snapshot
+            if self._fetch is None:
+                fetch = self._fetch = _StatusFetch()
+                generation = self._generation
+                leader = True
+            else:
+                fetch = self._fetch
+                leader = False
+
+        if not leader:
+            fetch.done.wait()
+            if fetch.error is not None:
+                raise fetch.error
+            return fetch.snapshot
+
+        try:
+            fetch.snapshot = ShellyDeviceStatus(fetch_device_status(), time.monotonic())
+            with self._lock:
+                if generation == self._generation:
+                    self._snapshot = fetch.snapshot
+            return fetch.snapshot
+        except Exception as e:
+            fetch.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._fetch is fetch:
+                    self._fetch = None
+            fetch.done.set()
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._snapshot = None
+            self._fetch = None
+
+
+device_status_cache = ShellyStatusCache()
+
+
+def fetch_device_status() -> dict:
+    """ Queries Shelly Cloud API for the full device status. """
+    response = shelly_client.get(
+        '/device/status',
+        params={
+            'auth_key': os.getenv('SHELLY_CLOUD_AUTH_KEY'),
+            'id': os.getenv('SHELLY_DEVICE_ID')
+        }
+    )
+
+    if response.status_code != 200:
+        current_app.logger.error('Failed to get device status from Shelly Cloud API')
+        raise RequestException('Failed to get device status from Shelly Cloud API')
+
+    return response.json()
+
+
+def get_device_status(max_age: float = None) -> ShellyDeviceStatus:
+    """ Returns a device status snapshot, which is at most max_age seconds old. """
+    return device_status_cache.get(max_age)
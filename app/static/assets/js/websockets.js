@@ -21,4 +21,51 @@ export function getCandy() {
         console.log("Connected to candy info websocket");
     });
     return candyInfoWS;
-}
\ No newline at end of file
+}
+
+const TELEMETRY_PROTOCOL_VERSION = 1;
+let serverClockOffset = 0;
+
+export function subscribeWasherInfo(onState, urlArgs = "") {
+    // Applies the snapshot and delta messages of the telemetry protocol to a local copy of the state
+    let state = {};
+    let expectedSeq = null;
+
+    const connect = () => {
+        const washingMachineInfoWS = getWS(urlArgs);
+        expectedSeq = null;
+        washingMachineInfoWS.onmessage = (event) => {
+            const message = JSON.parse(event.data);
+            if (message.v !== TELEMETRY_PROTOCOL_VERSION) {
+                console.warn("Unsupported telemetry protocol version " + message.v);
+                return;
+            }
+            if (message.type === "snapshot") {
+                state = message.data;
+                serverClockOffset = message.ts - Date.now();
+            } else if (message.seq !== expectedSeq) {
+                // A delta was lost, reconnect to receive a fresh snapshot
+                washingMachineInfoWS.close();
+                return;
+            } else {
+                Object.assign(state, message.data);
+                (message.removed || []).forEach((key) => delete state[key]);
+            }
+            expectedSeq = message.seq + 1;
+            onState(state);
+        };
+        washingMachineInfoWS.onclose = () => setTimeout(connect, 5000);
+    };
+    connect();
+}
+
+export function formatRunningTime(cycleStart) {
+    if (!cycleStart) {
+        return "00:00:00";
+    }
+    const elapsed = Math.max(0, Math.floor((Date.now() + serverClockOffset - Date.parse(cycleStart)) / 1000));
+    const hours = String(Math.floor(elapsed / 3600)).padStart(2, "0");
+    const minutes = String(Math.floor(elapsed % 3600 / 60)).padStart(2, "0");
+    const seconds = String(elapsed % 60).padStart(2, "0");
+    return hours + ":" + minutes + ":" + seconds;
+}
@@ -1,207 +1,369 @@
+import os
+import time
+import pickle
 import decimal
 import datetime
+import functools
+import threading
+from itertools import chain
+from typing import Callable, Optional
 
-from sqlalchemy import or_, and_
+import redis
+from flask import current_app, has_app_context
+from sqlalchemy import or_, and_, event, inspect
+from sqlalchemy.orm import Session
 
 from app.db import db
-from app.models import User, roles_users
-from app.models import WashingCycle, WashingCycleSplit, WashingMachine
+from app.cache import get_redis
+from app.machine import get_machine_config
+from app.models import User, Role, UserBalance, MonthlyRollup, WashingCyclePayment, roles_users
+from app.models import WashingCycle, WashingCycleSplit, WashingMachine, split_share_cents, cycle_splits_count
+
+STATISTICS_CACHE_PREFIX = 'laundrymaster:statistics'
+STATISTICS_VERSION_KEY = 'laundrymaster:statistics:version'
+STATISTICS_COUNTER_KEYS = {'hits': 'laundrymaster:statistics:hits', 'misses': 'laundrymaster:statistics:misses'}
+STATISTICS_MODELS = (WashingCycle, WashingCycleSplit, WashingCyclePayment)
+# The statistics list the users with these attributes, e.g. logging in does not change them
+STATISTICS_USER_ATTRIBUTES = ('username', 'email', 'first_name', 'active', 'roles')
+
+
+class StatisticsCache:
+    """
+    Cache of statistics results. Every key contains the version of the data, which is bumped after each commit
+    writing cycles, splits, payments, users or the price per kWh, so stale results are never read again and just expire.
+    Results are kept in Redis, or in process memory when testing, debugging or if Redis is unavailable. The hit and
+    miss counters are kept next to the version, so they add up the lookups of every worker.
+    """
+
+    def __init__(self):
+        self._local_counters = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+        self._local: dict[str, tuple[float, object]] = {}
+        self._local_version = 0
+
+    @property
+    def ttl(self) -> int:
+        return int(os.getenv('STATISTICS_CACHE_TTL', 3600))
+
+    @property
+    def counters(self) -> dict:
+        if (redis_client := self._redis()) is not None:
+            try:
+                values = redis_client.mget(list(STATISTICS_COUNTER_KEYS.values()))
+                return {name: int(value or 0) for name, value in zip(STATISTICS_COUNTER_KEYS, values)}
+            except redis.RedisError as e:
+                current_app.logger.warning(f'Failed to read the statistics cache counters. Error: {e}')
+        with self._lock:
+            return dict(self._local_counters)
+
+    def _count(self, name: str):
+        if (redis_client := self._redis()) is not None:
+            try:
+                redis_client.incr(STATISTICS_COUNTER_KEYS[name])
+                return
+            except redis.RedisError:
+                pass
+        with self._lock:
+            self._local_counters[name] += 1
+
+    def _redis(self) -> Optional[redis.Redis]:
+        if current_app.testing or current_app.debug:
+            return None
+        return get_redis()
+
+    def version(self) -> int:
+        if (redis_client := self._redis()) is not None:
+            try:
+                return int(redis_client.get(STATISTICS_VERSION_KEY) or 0)
+            except redis.RedisError as e:
+                current_app.logger.warning(f'Statistics cache falls back to process memory. Error: {e}')
+        return self._local_version
+
+    def bump(self):
+        """ Invalidates all cached results. """
+        with self._lock:
+            self._local_version += 1
+            self._local.clear()
+        if (redis_client := self._redis()) is not None:
+            try:
+                redis_client.incr(STATISTICS_VERSION_KEY)
+            except redis.RedisError as e:
+                current_app.logger.warning(f'Failed to bump the statistics cache version. Error: {e}')
+
+    def _get(self, key: str) -> tuple[bool, object]:
+        if (redis_client := self._redis()) is not None:
+            try:
+                cached = redis_client.get(key)
+                return cached is not None, pickle.loads(cached) if cached is not None else None
+            except redis.RedisError:
+                pass
+        with self._lock:
+            expires, value = self._local.get(key, (0, None))
+        return expires > time.monotonic(), value
+
+    def _set(self, key: str, value: object):
+        if (redis_client := self._redis()) is not None:
+            try:
+                redis_client.set(key, pickle.dumps(value), ex=self.ttl)
+                return
+            except redis.RedisError:
+                pass
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.ttl, value)
+
+    def get_or_compute(self, key: str, compute: Callable):
+        versioned_key = f'{STATISTICS_CACHE_PREFIX}:{self.version()}:{key}'
+        found, value = self._get(versioned_key)
+        if found:
+            self._count('hits')
+            return value
+        self._count('misses')
+        value = compute()
+        self._set(versioned_key, value)
+        return value
+
+
+def get_statistics_cache() -> StatisticsCache:
+    """ Returns the statistics cache of the current app, creating it on first use. """
+    if 'statistics_cache' not in current_app.extensions:
+        current_app.extensions['statistics_cache'] = StatisticsCache()
+    return current_app.extensions['statistics_cache']
+
+
+def cached_statistics(func):
+    """ Caches the results of a statistics function by its name, the current day, the user and the arguments. """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key_args = [arg.id if isinstance(arg, User) else arg for arg in args]
+        key_kwargs = sorted((name, value.id if isinstance(value, User) else value) for name, value in kwargs.items())
+        key = f'{func.__name__}:{datetime.date.today().isoformat()}:{key_args!r}:{key_kwargs!r}'
+        return get_statistics_cache().get_or_compute(key, lambda: func(*args, **kwargs))
+    return wrapper
+
+
+@event.listens_for(Session, 'after_flush')
+def track_statistics_writes(session, flush_context):
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, STATISTICS_MODELS) or \
+                (isinstance(instance, WashingMachine) and inspect(instance).attrs.costperkwh.history.has_changes()) or \
+                (isinstance(instance, User) and (instance not in session.dirty or any(
+                    inspect(instance).attrs[name].history.has_changes() for name in STATISTICS_USER_ATTRIBUTES))):
+            session.info['statistics_changed'] = True
+            return
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def track_statistics_bulk_writes(orm_execute_state):
+    mapper = orm_execute_state.bind_mapper
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and mapper is not None and \
+            issubclass(mapper.class_, STATISTICS_MODELS + (User,)):
+        orm_execute_state.session.info['statistics_changed'] = True
+    elif getattr(orm_execute_state.statement, 'table', None) is roles_users:
+        orm_execute_state.session.info['statistics_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_statistics_cache(session):
+    if session.info.pop('statistics_changed', False) and has_app_context():
+        get_statistics_cache().bump()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_statistics_writes(session):
+    session.info.pop('statistics_changed', None)
+
+
+def get_monthly_rollup(user: User, month: datetime.date = None):
+    """ Returns the rollup of the user for the month, by default the current one. """
+    month = month or datetime.datetime.now()
+    return db.session.get(MonthlyRollup, (user.id, month.year, month.month))
 
 
 def calculate_charges(user: User):
     """ Calculate the monthly charges for a user. """
-    charges: list[WashingCycle] = WashingCycle.query.filter(
-        WashingCycle.end_timestamp.is_not(None),
-        or_(
-            WashingCycle.user_id == user.id,
-            WashingCycle.splits.any(user_id=user.id)
-        ),
-        db.func.extract('month', WashingCycle.end_timestamp) == datetime.datetime.now().month
-    ).all()
-
-    result = 0
-    for charge in charges:
-        if split_users_count := len(charge.splits):
-            charge.split_cost = round(charge.cost / (split_users_count + 1), 2)
-            if charge.split_cost * (split_users_count + 1) < charge.cost:
-                charge.split_cost = round(charge.split_cost + decimal.Decimal(0.01), 2)
-            result += charge.split_cost
-        else:
-            result += charge.cost
-
-    return result
+    rollup = get_monthly_rollup(user)
+    return rollup.cost if rollup is not None else 0
 
 
+@cached_statistics
 def calculate_energy_usage(user: User = None):
-    """ Calculate the monthly usage of electricity for a user. """
+    """ Calculate the monthly usage of electricity for a user or at all. """
     if user is None:
-        usage: list[WashingCycle] = WashingCycle.query.filter(
-            WashingCycle.end_timestamp.is_not(None),
-            db.func.extract('month', WashingCycle.end_timestamp) == datetime.datetime.now().month
-        ).all()
-    else:
-        usage: list[WashingCycle] = WashingCycle.query.filter(
-            WashingCycle.end_timestamp.is_not(None),
-            or_(
-                WashingCycle.user_id == user.id,
-                WashingCycle.splits.any(user_id=user.id)
-            ),
-            db.func.extract('month', WashingCycle.end_timestamp) == datetime.datetime.now().month
-        ).all()
-
-    result = 0
-    for use in usage:
-        if split_user_count := len(use.splits):
-            result += round((use.endkwh - use.startkwh) / (split_user_count + 1), 4)
-        result += use.endkwh - use.startkwh
-
-    return result
+        now = datetime.datetime.now()
+        return db.session.query(db.func.sum(MonthlyRollup.kwh)).filter(
+            MonthlyRollup.year == now.year,
+            MonthlyRollup.month == now.month
+        ).scalar() or 0
+
+    rollup = get_monthly_rollup(user)
+    return rollup.kwh if rollup is not None else 0
 
 
 def calculate_unpaid_cycles_cost(user: User = None):
-    """ Calculate the unpaid cycles for a user or at all. """
-    if len(WashingCycle.query.all()) == 0:
+    """
+    Calculate the unpaid cycles for a user or at all. The cost of a user is read from their ledger balance.
+    The total at all is the unpaid share of the cycle owners, excluding the cycles of inactive users and the room owner.
+    """
+    if user is not None:
+        balance = db.session.get(UserBalance, user.id)
+        return balance.unpaid_cost if balance is not None else 0
+
+    has_unpaid = db.or_(db.exists().where(WashingCycle.paid.is_(False)),
+                        db.exists().where(WashingCycleSplit.paid.is_(False)))
+    if not db.session.query(has_unpaid).scalar():
         return 0
-    if user is None:
-        unpaid: list[WashingCycle] = WashingCycle.query.filter(
-            WashingCycle.end_timestamp.is_not(None),
-            WashingCycle.paid.is_(False),
-            WashingCycle.user.has(active=True)
-        )
-        room_owner = db.session.query(roles_users).filter_by(role_id=3).first()
-        if room_owner is not None:
-            unpaid = unpaid.filter(WashingCycle.user_id != room_owner.user_id)
-        unpaid = unpaid.all()
-    else:
-        unpaid: list[WashingCycle] = WashingCycle.query.filter(
-            WashingCycle.end_timestamp.is_not(None),
-            or_(
-                and_(
-                    WashingCycle.user_id == user.id,
-                    WashingCycle.paid.is_(False),
-                ),
-                WashingCycle.splits.any(user_id=user.id, paid=False)
-            )
-        ).all()
-
-    result = 0
-    for unpaid_cycle in unpaid:
-        if split_users_count := len(unpaid_cycle.splits):
-            unpaid_cycle.split_cost = round(unpaid_cycle.cost / (split_users_count + 1), 2)
-            if unpaid_cycle.split_cost * (split_users_count + 1) < unpaid_cycle.cost:
-                unpaid_cycle.split_cost = round(unpaid_cycle.split_cost + decimal.Decimal(0.01), 2)
-            result += unpaid_cycle.split_cost
-        else:
-            result += unpaid_cycle.cost
-
-    return result
+
+    room_owners = db.select(roles_users.c.user_id) \
+        .join(Role, Role.id == roles_users.c.role_id) \
+        .where(Role.name == 'room_owner')
+    cents = db.session.query(db.func.sum(split_share_cents(WashingCycle.cost, cycle_splits_count()))).filter(
+        WashingCycle.end_timestamp.is_not(None),
+        WashingCycle.paid.is_(False),
+        WashingCycle.user.has(active=True),
+        WashingCycle.user_id.not_in(room_owners)
+    ).scalar()
+    return cents_to_decimal(cents)
+
+
+def calculate_unpaid_cycles_cost_by_user(user_ids: list[int] = None) -> dict[int, decimal.Decimal]:
+    """ Returns the unpaid cycles cost of all users or the given ones from the ledger. """
+    query = db.session.query(UserBalance.user_id, UserBalance.unpaid_cost)
+    if user_ids is not None:
+        query = query.filter(UserBalance.user_id.in_(user_ids))
+    return dict(query.all())
 
 
 def calculate_savings(user: User):
     """ Calculate the savings from having personal washing machine. """
-    cycles: list[WashingCycle] = WashingCycle.query.filter(
-        WashingCycle.end_timestamp.is_not(None),
-        or_(
-            WashingCycle.user_id == user.id,
-            WashingCycle.splits.any(user_id=user.id)
-        ),
-        WashingCycle.cost > 0.30,  # minimum cost of washing and drying, so the calculation would be accurate
-        db.func.extract('month', WashingCycle.end_timestamp) == datetime.datetime.now().month
-    ).all()
-
-    washing_machine = WashingMachine.query.first()
-    if not washing_machine:
+    rollup = get_monthly_rollup(user)
+    if rollup is None:
         return 0
+    return rollup.savings_cycles * get_machine_config().public_wash_cost - rollup.savings_cost
+
 
-    public_wash_cost = washing_machine.public_wash_cost
+def shift_month(month_start: datetime.datetime, months: int) -> datetime.datetime:
+    index = month_start.year * 12 + month_start.month - 1 + months
+    return datetime.datetime(year=index // 12, month=index % 12 + 1, day=1)
 
-    result = 0
-    for cycle in cycles:
-        result += public_wash_cost - cycle.cost
 
-    return result
+def in_months(column, months) -> db.ColumnElement:
+    """ Sargable criteria matching timestamps within any of the (year, month) months, as half-open ranges. """
+    month_starts = [datetime.datetime(year=year, month=month, day=1) for year, month in months]
+    return or_(*[and_(column >= month_start, column < shift_month(month_start, 1)) for month_start in month_starts])
 
 
-def calculate_monthly_statistics(user: User, months: int = 6) -> dict:
-    """ Calculate the monthly statistics for a user. """
+@cached_statistics
+def calculate_monthly_statistics(user: User, months: int = 6, end: datetime.date = None,
+                                 start: datetime.date = None) -> dict:
+    """
+    Calculate the monthly statistics for a user. Covers the months from start to end if start is given, otherwise
+    the last months ending with end, which defaults to the current month.
+    """
+    end = end or datetime.datetime.now()
+    last_month = datetime.datetime(year=end.year, month=end.month, day=1)
+    if start is not None:
+        months = (last_month.year - start.year) * 12 + last_month.month - start.month + 1
     if months <= 0:
-        return {"labels": [], "data": [0] * months}
+        return {"labels": [], "data": []}
+    first_month = shift_month(last_month, -(months - 1))
+
+    month_index = MonthlyRollup.year * 12 + MonthlyRollup.month
+    monthly_cost = dict(((rollup_year, rollup_month), cost) for rollup_year, rollup_month, cost in db.session.query(
+        MonthlyRollup.year, MonthlyRollup.month, MonthlyRollup.cost
+    ).filter(
+        MonthlyRollup.user_id == user.id,
+        month_index.between(first_month.year * 12 + first_month.month, last_month.year * 12 + last_month.month)
+    ).all())
 
     stat_labels: list[str] = []
     stat_data: list[str] = []
-    year: int = datetime.datetime.now().year
-    month: int = datetime.datetime.now().month
-
     for i in range(months):
-        # print("Month " + str(month) + " Year " + str(year))
-        cycles = WashingCycle.query.filter(
-            WashingCycle.end_timestamp.is_not(None),
-            or_(
-                WashingCycle.user_id == user.id,
-                WashingCycle.splits.any(user_id=user.id)
-            ),
-            db.func.extract('month', WashingCycle.end_timestamp) == month,
-            db.func.extract('year', WashingCycle.end_timestamp) == year,
-        ).all()
-
-        total_cost = 0
-
-        for cycle in cycles:
-            if split_users_count := len(cycle.splits):
-                cycle.split_cost = round(cycle.cost / (split_users_count + 1), 2)
-                if cycle.split_cost * (split_users_count + 1) < cycle.cost:
-                    cycle.split_cost = round(cycle.split_cost + decimal.Decimal(0.01), 2)
-                total_cost += cycle.split_cost
-            else:
-                total_cost += cycle.cost
-
-        stat_labels.append(datetime.date(year=year, month=month, day=1).strftime("%B")[0:3])
-        stat_data.append(str(total_cost))
-
-        if month == 1:
-            month = 12
-            year -= 1
-        else:
-            month -= 1
-    stat_labels.reverse()
-    stat_data.reverse()
+        month_start = shift_month(first_month, i)
+        cost = monthly_cost.get((month_start.year, month_start.month))
+        stat_labels.append(month_start.strftime("%B")[0:3])
+        stat_data.append(str(decimal.Decimal(cost).quantize(decimal.Decimal('0.01'))) if cost else '0')
     return {"labels": stat_labels, "data": stat_data}
 
 
+def cycle_shares():
+    """
+    Subquery with a row for every user taking part in a cycle, i.e. its owner and each user it is split with,
+    holding whether that user has paid, their share of the cost in cents and their share of the energy in kWh.
+    """
+    splits_count = cycle_splits_count()
+    kwh_share = (WashingCycle.endkwh - WashingCycle.startkwh) / (splits_count + 1)
+    owners = db.select(
+        WashingCycle.id.label('cycle_id'),
+        WashingCycle.user_id.label('user_id'),
+        WashingCycle.paid.label('paid'),
+        split_share_cents(WashingCycle.cost, splits_count).label('share_cents'),
+        kwh_share.label('kwh_share'),
+        WashingCycle.cost.label('cost'),
+        WashingCycle.end_timestamp.label('end_timestamp')
+    )
+    split_users = db.select(
+        WashingCycle.id,
+        WashingCycleSplit.user_id,
+        WashingCycleSplit.paid,
+        split_share_cents(WashingCycle.cost, splits_count),
+        kwh_share,
+        WashingCycle.cost,
+        WashingCycle.end_timestamp
+    ).join(WashingCycleSplit, WashingCycleSplit.cycle_id == WashingCycle.id)
+    return db.union_all(owners, split_users).subquery('cycle_shares')
+
+
+def aggregate_cycle_shares(shares, *criteria) -> dict[int, tuple[int, decimal.Decimal]]:
+    """
+    Aggregates the cycle shares matching the criteria by user in a single query.
+    Returns the number of cycles and the total cost for each user with any cycles.
+    """
+    rows = db.session.query(
+        shares.c.user_id,
+        db.func.count(shares.c.cycle_id),
+        db.func.sum(shares.c.share_cents)
+    ).filter(*criteria).group_by(shares.c.user_id).all()
+    return {user_id: (count, cents_to_decimal(cents)) for user_id, count, cents in rows}
+
+
+def cents_to_decimal(cents) -> decimal.Decimal:
+    return (decimal.Decimal(cents or 0) / 100).quantize(decimal.Decimal('0.01'))
+
+
+@cached_statistics
 def admin_users_usage_statistics(months: int = 12) -> dict:
     """ Calculates the times each user has used the washing machine. """
     users = User.query.filter_by(active=True).all()
     users_usage_stats = {'labels': [user.first_name for user in users], 'datasets': []}
 
+    now = datetime.datetime.now()
+    last_months = now - datetime.timedelta(days=months * 30)
+    last_days = now - datetime.timedelta(days=30)
+    usage = {user_id: (total, recent) for user_id, total, recent in db.session.query(
+        WashingCycle.user_id,
+        db.func.count(db.case((WashingCycle.start_timestamp >= last_months, WashingCycle.id))),
+        db.func.count(db.case((WashingCycle.start_timestamp >= last_days, WashingCycle.id)))
+    ).filter(
+        WashingCycle.start_timestamp >= min(last_months, last_days)
+    ).group_by(WashingCycle.user_id).all()}
+
     users_usage_stats['datasets'].append({
             'label': f'Cycles by user for the last {months} months',
             'fill': True,
-            'data': [],
+            'data': [usage.get(user.id, (0, 0))[0] for user in users],
             'backgroundColor': '#5f74d7',
     })
-    for user in users:
-        cycles = WashingCycle.query.filter(
-            WashingCycle.user_id == user.id,
-            WashingCycle.start_timestamp >= datetime.datetime.now() - datetime.timedelta(days=months * 30)
-        ).all()
-        users_usage_stats['datasets'][0]['data'].append(len(cycles))
-
     users_usage_stats['datasets'].append({
             'label': f'Cycles by user for the last 30 days',
             'fill': True,
-            'data': [],
+            'data': [usage.get(user.id, (0, 0))[1] for user in users],
             'backgroundColor': '#7fc2d1',
     })
-    for user in users:
-        cycles = WashingCycle.query.filter(
-            WashingCycle.user_id == user.id,
-            WashingCycle.start_timestamp >= datetime.datetime.now() - datetime.timedelta(days=30)
-        ).all()
-        users_usage_stats['datasets'][1]['data'].append(len(cycles))
 
     return users_usage_stats
 
 
+@cached_statistics
 def users_unpaid_cycles_cost_statistics() -> dict:
     """ Calculates the unpaid cycles cost for each user. """
 
@@ -220,12 +382,13 @@ def users_unpaid_cycles_cost_statistics() -> dict:
         return pastel_color
 
     users = User.query.filter_by(active=True).all()
+    unpaid = calculate_unpaid_cycles_cost_by_user()
     users_unpaid_stats = {'labels': [user.first_name for user in users], 'datasets': []}
 
     users_unpaid_stats['datasets'].append({
         'label': 'Unpaid cycles cost by user',
         'fill': True,
-        'data': [float(calculate_unpaid_cycles_cost(user)) for user in users],
+        'data': [float(unpaid.get(user.id, 0)) for user in users],
         'backgroundColor': [generate_color_by_user(user) for user in users],
     })
 
@@ -1,5 +1,4 @@
 import os
-import time
 import logging
 import datetime
 
@@ -7,14 +6,14 @@ from flask import Flask
 from celery import Celery, Task, shared_task, current_app, current_task
 from celery.schedules import crontab
 from celery.signals import task_prerun
+from requests.exceptions import RequestException
 
 from app.db import db
 from app.models import User, WashingMachine, Notification, CeleryTask
 from app.models import (schedule_reminder_notification, cycle_paused_notification, cycle_ended_notification,
-                        cycle_termination_reminder_notification)
-from app.functions import (send_push_to_user, stop_cycle, update_energy_consumption, get_realtime_current_usage,
-                           trigger_relay, recalculate_cycles_cost)
-from app.candy import CandyWashingMachine, CandyMachineState, StartProgramForm, send_command
+                        cycle_termination_reminder_notification, wash_program_failed_notification)
+from app.functions import send_push_to_user, stop_cycle, trigger_relay, recalculate_cycles_cost
+from app.candy import CandyMachineState, send_command, get_last_machine_state
 
 
 def celery_init_app(app: Flask) -> Celery:
@@ -41,9 +40,9 @@ def celery_init_app(app: Flask) -> Celery:
             "task": "send_notification_to_debtors",
             "schedule": crontab(minute="0", hour="12", day_of_week="*/2")
         },
-        "Truncate push subscriptions every 10 days": {
-            "task": "truncate_push_subscriptions",
-            "schedule": crontab(minute="0", hour="2", day_of_month="*/10")
+        "Dispatch the push notification outbox every minute": {
+            "task": "dispatch_push_outbox",
+            "schedule": crontab()
         },
     }
 
@@ -58,126 +57,35 @@ def on_task_init(*args, **kwargs):
         db.engine.dispose()
 
 
-@shared_task(ignore_result=False)
-def cycle_end_notification_task_old(user_id: int, terminate_cycle: bool):
-    """ Legacy task for notification of cycle end. Watches the energy consumption and decides based on usage. """
-    def wait_usage_over_threshold():
-        current_app.logger.info('Watching energy consumption and waiting it to get over threshold...')
-        while True:
-            usage = get_realtime_current_usage()
-            if usage > int(os.getenv('WASHING_MACHINE_WATT_THRESHOLD')):
-                break
-            time.sleep(int(os.getenv("CYCLE_CHECK_INTERVAL", 60)) / 2)
-        current_app.logger.info('Usage is over threshold!')
-
-    def watch_usage():
-        current_app.logger.info('Watching energy consumption and waiting it to get under threshold...')
-        counter = 0
-        while True:
-            usage = get_realtime_current_usage()
-            if usage < int(os.getenv('WASHING_MACHINE_WATT_THRESHOLD')):
-                # Usage is under threshold, start cycle end detection
-                while counter < 10:
-                    current_app.logger.info('Usage under threshold, checking if it stays under...')
-                    usage = get_realtime_current_usage()
-                    if usage > int(os.getenv('WASHING_MACHINE_WATT_THRESHOLD')):
-                        # Usage has gone over threshold, cycle hasn't ended
-                        current_app.logger.info('Usage went over threshold, cycle has not ended yet.')
-                        counter = 0
-                        break
-                    counter += 1
-                    time.sleep(int(os.getenv("CYCLE_CHECK_INTERVAL", 60)) / 2)
-                if counter == 10:
-                    # Usage has been under threshold for 5 minutes and hadn't gone over, cycle has probably ended
-                    break
-            time.sleep(int(os.getenv("CYCLE_CHECK_INTERVAL", 60)))
-
-        current_app.logger.info('Usage is under threshold for enough time and cycle should be completed!')
-
-        # Cycle has ended, send push notification
-        send_push_to_user(
-            user=user,
-            notification=cycle_ended_notification
-        )
-
-    print("Starting task...")
-    # Give a time window of 10 minutes to start a washing cycle
-    time.sleep(10 * 60)
-    current_app.logger.info("Grace period for starting the program ended.")
-
-    # When using celery we must provide the bare minimum of required data,
-    # so we fetch the user by the id provided
-    user = User.query.filter_by(id=user_id).first()
-
-    # Wait until usage is over threshold
-    wait_usage_over_threshold()
-
-    # Usage is over threshold, monitor it until it falls under threshold
-    watch_usage()
-
-    if terminate_cycle:
-        # Terminate cycle if enabled in settings
-        stop_cycle(user)
-        print("Sending reminder to user...")
-        send_push_to_user(
-            user=user,
-            notification=cycle_termination_reminder_notification
-        )
-    else:
-        # Otherwise, remind the user that the cycle must be terminated if the washing has ended!
-        current_app.logger.info("User doesn't want automatic cycle termination, reminding them to terminate it.")
-        i = 0
-        while i < 10:
-            time.sleep(5 * 60)
-            if get_realtime_current_usage() > int(os.getenv('WASHING_MACHINE_WATT_THRESHOLD')):
-                # Usage is over threshold again, start detection all over again
-                current_app.logger.warning('Usage went over threshold again, starting detection all over again.')
-                watch_usage()
-                i = 0
-                continue
-
-            print("Sending reminder to user...")
-            send_push_to_user(
-                user=user,
-                notification=cycle_termination_reminder_notification
-            )
-            i += 1
-
-    print("Ending task....")
-
-
-@shared_task(ignore_result=True)
-def release_door_task(user_username: str):
-    """ Task to release the door of the washing machine. """
-    current_app.logger.info(f"Starting task to release the door for {user_username}...")
-
-    current_app.logger.info("Sending request to turn on the relay through Shelly Cloud API...")
-    counter = 0
-    while trigger_relay('on') != 200:
-        current_app.logger.error("Request to turn on the relay through Shelly Cloud API FAILED! Retrying...")
-        if counter == 10:
-            current_app.logger.warning("Tried to turn on the relay 10 times. Failed :(")
+@shared_task(bind=True, ignore_result=True, max_retries=10)
+def release_door_task(self, task_id: str, mode: str):
+    """ Step of the release door flow, which turns the relay on and schedules turning it off 30 seconds later. """
+    task = CeleryTask.claim_step(task_id, self.request.id)
+    if task is None:
+        current_app.logger.info(f'Release door task {task_id} was cancelled, skipping relay {mode}.')
+        return
+
+    current_app.logger.info(f"Sending request to turn {mode} the relay through Shelly Cloud API...")
+    try:
+        status_code = trigger_relay(mode)
+    except RequestException as e:
+        current_app.logger.error(f'Shelly Cloud API request failed! {e}')
+        status_code = None
+
+    if status_code != 200:
+        if self.request.retries >= self.max_retries:
+            current_app.logger.warning(f"Tried to turn {mode} the relay {self.max_retries} times. Failed :(")
+            db.session.delete(task)
+            db.session.commit()
             return
-        time.sleep(2)
-        counter += 1
-
-    current_app.logger.info("Washing machine should be on. Waiting some time...")
-    time.sleep(30)
-
-    current_app.logger.info("Sending request to turn off the relay through Shelly Cloud API...")
-    counter = 0
-    while trigger_relay('off') != 200:
-        current_app.logger.error("Request to turn off the relay through Shelly Cloud API FAILED! Trying again...")
-        if counter == 10:
-            current_app.logger.warning("Tried to turn off the relay 10 times. Failed :(")
-            return
-        time.sleep(2)
-        counter += 1
+        current_app.logger.error(f"Request to turn {mode} the relay through Shelly Cloud API FAILED! Retrying...")
+        raise self.retry(countdown=2)
 
-    current_app.logger.info("Task to release the door ended.")
-    # After successfully finishing the task, delete it from the database
-    task = CeleryTask.query.filter_by(id=current_task.request.id).first()
-    if task:
+    if mode == 'on':
+        current_app.logger.info("Washing machine should be on. Turning the relay off in 30 seconds...")
+        task.schedule_step(release_door_task, 'relay_off', 'off', countdown=30)
+    else:
+        current_app.logger.info(f"Task to release the door for {task.payload.get('username')} ended.")
         db.session.delete(task)
         db.session.commit()
 
@@ -185,6 +93,9 @@ def release_door_task(user_username: str):
 @shared_task(ignore_result=True)
 def schedule_notification_task(user_id: int):
     """ Task to send a push notification to the user about their scheduled washing. """
+    if db.session.get(CeleryTask, current_task.request.id) is None:
+        current_app.logger.info('Schedule notification was cancelled, skipping.')
+        return
     user = User.query.filter_by(id=user_id).first()
     if user:
         current_app.logger.info(f'Reminding {user.username} about their scheduled washing...')
@@ -195,105 +106,83 @@ def schedule_notification_task(user_id: int):
         current_app.logger.warning(f'User with id {user_id} not found!')
 
 
-@shared_task(ignore_result=False)
-def cycle_end_notification_task(user_id: int, terminate_cycle: bool, wait_time: int = 10):
-    """ Task to send a push notification to the user about the end of their washing cycle."""
-    current_app.logger.info("Starting task...")
-    user = User.query.filter_by(id=user_id).first()
-    # Give a time window of 10 minutes to start a washing cycle
-    time.sleep(wait_time * 60)
-    current_app.logger.info("Grace period for starting the program ended.")
-
-    washing_machine = CandyWashingMachine()
-    while (washing_machine.machine_state != CandyMachineState.FINISHED1 and
-           washing_machine.machine_state != CandyMachineState.FINISHED2):
-        while (washing_machine.machine_state != CandyMachineState.FINISHED1 and
-               washing_machine.machine_state != CandyMachineState.FINISHED2):
-
-            if washing_machine.machine_state == CandyMachineState.PAUSED:
-                current_app.logger.info("Machine is paused, notifying user...")
-                send_push_to_user(
-                    user=user,
-                    notification=cycle_paused_notification
-                )
-                time.sleep(60)
-            elif washing_machine.machine_state == CandyMachineState.IDLE:
-                current_app.logger.info("Machine is idle, waiting for it to start...")
-                time.sleep(60)
-            elif washing_machine.machine_state == CandyMachineState.RUNNING:
-                current_app.logger.info("Machine is running, waiting for it to finish...")
-                time.sleep(5 * 60)
-            else:
-                current_app.logger.warning(
-                    f"Non-captured state: {washing_machine.machine_state.code} - {washing_machine.machine_state.label}")
-                time.sleep(60)
-            washing_machine.update()
-
+@shared_task(ignore_result=True)
+def machine_transition_task(subscription_id: str, previous_code: int, state_code: int):
+    """ Task to handle a state transition of the washing machine for a single watcher subscription. """
+    subscription = db.session.get(CeleryTask, subscription_id)
+    if subscription is None:
+        current_app.logger.info(f'Subscription {subscription_id} no longer exists, skipping transition.')
+        return
+
+    previous_state = CandyMachineState.from_code(previous_code)
+    state = CandyMachineState.from_code(state_code)
+    user = User.query.filter_by(id=subscription.user_id).first()
+
+    if subscription.kind == CeleryTask.TaskKinds.CYCLE_NOTIFICATION:
+        handle_cycle_transition(subscription, user, previous_state, state)
+    elif subscription.kind == CeleryTask.TaskKinds.WASH_THEN_DRY:
+        handle_wash_then_dry_transition(subscription, user, previous_state, state)
+
+
+def handle_cycle_transition(subscription: CeleryTask, user: User, previous_state: CandyMachineState,
+                            state: CandyMachineState):
+    """ Notifies the user about their cycle and terminates it automatically if enabled in their settings. """
+    if state == CandyMachineState.PAUSED:
+        current_app.logger.info("Machine is paused, notifying user...")
+        send_push_to_user(user=user, notification=cycle_paused_notification)
+    elif state.finished and not previous_state.finished:
         current_app.logger.info("Program cycle has ended! Notifying user...")
-        send_push_to_user(
-            user=user,
-            notification=cycle_ended_notification
-        )
+        send_push_to_user(user=user, notification=cycle_ended_notification)
 
-        if terminate_cycle:
+        if (subscription.payload or {}).get('terminate_cycle'):
             # Terminate cycle if enabled in settings
             current_app.logger.info("Automatic termination of cycle...")
-            stop_cycle(user)
-            break
+            try:
+                with current_app.flask_app.test_request_context():
+                    stop_cycle(user)
+            except ChildProcessError as e:
+                current_app.logger.error(f'Automatic termination of cycle failed. {e}')
         else:
-            # Otherwise, watch for other program starts and notify user until cycle is terminated!
-            current_app.logger.info("User doesn't want automatic cycle termination. Waiting for user to terminate...")
-            time.sleep(10 * 60)
-
-            current_app.logger.info("User was notified but didn't terminate the cycle, reminding them...")
-            new_program_started = False
-            for _ in range(10):
-                washing_machine.update()
-                if (washing_machine.machine_state != CandyMachineState.FINISHED1 and
-                        washing_machine.machine_state != CandyMachineState.FINISHED2):
-                    # User was notified but another program has started, start all over again
-                    new_program_started = True
-                    break
-                current_app.logger.info("Sending reminder to user...")
-                send_push_to_user(
-                    user=user,
-                    notification=cycle_termination_reminder_notification
-                )
-                time.sleep(5 * 60)
-            if not new_program_started:
-                break
-
-    current_app.logger.info("Ending task....")
-
-
-@shared_task()
-def recalculate_cycles_cost_task():
-    """ Task to recalculate the cost of cycles. """
-    current_app.logger.info("Task to recalculate cycles will start in 30 minutes...")
-    # Giving some time to cancel the task if it was started by mistake
-    time.sleep(30 * 60)
-
-    current_app.logger.info(f"Starting task to recalculate cycles cost at {datetime.datetime.now} ...")
-    recalculate_cycles_cost()
-    current_app.logger.info(f"Task to recalculate cycles cost ended at {datetime.datetime.now}.")
+            # Otherwise, remind the user that the cycle must be terminated
+            current_app.logger.info("User doesn't want automatic cycle termination, scheduling reminders.")
+            finished_count = (subscription.payload or {}).get('finished_count', 0) + 1
+            subscription.update_payload(finished_count=finished_count)
+            db.session.commit()
+            cycle_termination_reminder_task.apply_async((subscription.id, finished_count, 0), countdown=10 * 60)
 
 
-@shared_task(name='send_notification_to_debtors', ignore_result=True)
-def send_notification_to_debtors_task():
-    """ Scheduled task to send a push notification to all debtors, reminding them to pay up. """
-    from app.functions import notify_debtors
-    current_app.logger.info("Will send notifications to all debtors...")
-    notify_debtors()
-    current_app.logger.info("All debtors were notified. Exiting...")
+@shared_task(ignore_result=True)
+def cycle_termination_reminder_task(subscription_id: str, finished_count: int, reminders_sent: int):
+    """ Task to remind the user to terminate their cycle after the program has ended. """
+    subscription = db.session.get(CeleryTask, subscription_id)
+    if subscription is None or (subscription.payload or {}).get('finished_count') != finished_count:
+        # The cycle was terminated or another program has ended since, which has its own reminders
+        return
+    if not get_last_machine_state().finished:
+        current_app.logger.info("Another program has started, reminders will continue after it ends.")
+        return
+
+    current_app.logger.info("Sending reminder to user...")
+    user = User.query.filter_by(id=subscription.user_id).first()
+    send_push_to_user(user=user, notification=cycle_termination_reminder_notification)
+
+    if reminders_sent + 1 < 10:
+        cycle_termination_reminder_task.apply_async(
+            (subscription_id, finished_count, reminders_sent + 1),
+            countdown=5 * 60
+        )
 
 
-@shared_task()
-def schedule_program_start_task(wash_command, dry_command, user_id: int):
-    """ Task to start programs on the washing machine through the Candy API. """
-    user = User.query.filter_by(id=user_id).first()
+@shared_task(ignore_result=True)
+def start_wash_then_dry_task(subscription_id: str):
+    """ Task to start the wash program of a wash and dry request through the Candy API. """
+    subscription = db.session.get(CeleryTask, subscription_id)
+    if subscription is None:
+        return
+    user = User.query.filter_by(id=subscription.user_id).first()
 
     current_app.logger.info("Starting wash program...")
-    send_command(wash_command)
+    send_command(subscription.payload['wash_command'])
     send_push_to_user(user, Notification(
         title="Washing program started",
         body="Your washing program has started.",
@@ -301,75 +190,99 @@ def schedule_program_start_task(wash_command, dry_command, user_id: int):
     ))
 
     # allow some time for the command to propagate to the machine
-    time.sleep(5 * 60)
-
-    washing_machine = CandyWashingMachine()
-    has_ran = False
-    while (washing_machine.machine_state != CandyMachineState.FINISHED1 and
-           washing_machine.machine_state != CandyMachineState.FINISHED2):
-
-        if washing_machine.machine_state == CandyMachineState.PAUSED:
-            current_app.logger.info("Machine is paused, notifying user...")
-            send_push_to_user(
-                user=user,
-                notification=cycle_paused_notification
-            )
-            time.sleep(60)
-        elif washing_machine.machine_state == CandyMachineState.IDLE:
-            current_app.logger.info("Machine is idle, waiting for it to start...")
-            time.sleep(60)
-        elif washing_machine.machine_state == CandyMachineState.RUNNING:
-            has_ran = True
-            current_app.logger.info("Machine is running, waiting for it to finish...")
-            time.sleep(5 * 60)
+    wash_then_dry_check_task.apply_async((subscription_id,), countdown=10 * 60)
+
+
+@shared_task(ignore_result=True)
+def wash_then_dry_check_task(subscription_id: str):
+    """ Task to check whether the wash program of a wash and dry request has actually started. """
+    subscription = db.session.get(CeleryTask, subscription_id)
+    if subscription is None or subscription.payload.get('has_ran'):
+        return
+
+    current_app.logger.warning("Wash program didn't start, cancelling the wash and dry request...")
+    user = User.query.filter_by(id=subscription.user_id).first()
+    db.session.delete(subscription)
+    db.session.commit()
+    send_push_to_user(user, wash_program_failed_notification)
+
+
+def handle_wash_then_dry_transition(subscription: CeleryTask, user: User, previous_state: CandyMachineState,
+                                    state: CandyMachineState):
+    """ Starts the drying program once the wash program of a wash and dry request has ended. """
+    if state == CandyMachineState.RUNNING:
+        subscription.update_payload(has_ran=True)
+        db.session.commit()
+    elif state == CandyMachineState.PAUSED:
+        current_app.logger.info("Machine is paused, notifying user...")
+        send_push_to_user(user=user, notification=cycle_paused_notification)
+    elif state.finished and not previous_state.finished:
+        if subscription.payload.get('has_ran'):
+            current_app.logger.info("Wash program has ended! Starting drying program...")
+            send_command(subscription.payload['dry_command'])
+            current_app.logger.info("Drying program command has been sent, ending...")
+            send_push_to_user(user, Notification(
+                title="Drying program started",
+                body="Your drying program has started.",
+                icon='cycle-done-icon.png'
+            ))
         else:
-            current_app.logger.warning(
-                f"Non-captured state: {washing_machine.machine_state.code} - {washing_machine.machine_state.label}")
-            time.sleep(60)
-        washing_machine.update()
-
-    if not has_ran:
-        current_app.logger.warning("Wash program didn't start, ending task...")
-        send_push_to_user(user, Notification(
-            title="Washing program failed",
-            body="Your washing program failed to start. Please try again!",
-            icon='cycle-done-icon.png'
-        ))
-    else:
-        current_app.logger.info("Wash program has ended! Starting drying program...")
-        send_command(dry_command)
-        current_app.logger.info("Drying program command has been sent, ending...")
-        send_push_to_user(user, Notification(
-            title="Drying program started",
-            body="Your drying program has started.",
-            icon='cycle-done-icon.png'
-        ))
-
-    # After successfully finishing the task, delete it from the database
-    task = CeleryTask.query.filter_by(id=current_task.request.id).first()
-    if task:
-        db.session.delete(task)
+            current_app.logger.warning("Wash program didn't start, cancelling the wash and dry request...")
+            send_push_to_user(user, wash_program_failed_notification)
+
+        db.session.delete(subscription)
         db.session.commit()
 
 
-@shared_task()
-def disable_guest_after_finish_task(user_id: int):
-    """ Task to disable guest user after they finish with the washing machine. """
-    current_app.logger.info(f'Disabling guest user {user.username}.')
-    user = User.query.filter_by(id=user_id).first()
-    time.sleep(5 * 60)
-    user.active = False
+@shared_task(bind=True, ignore_result=True)
+def recalculate_cycles_cost_task(self, task_id: str):
+    """ Task to recalculate the cost of cycles, scheduled after a grace period to cancel it. """
+    task = CeleryTask.claim_step(task_id, self.request.id)
+    if task is None:
+        current_app.logger.info('Recalculation of cycles cost was cancelled, skipping.')
+        return
+
+    current_app.logger.info(f"Starting task to recalculate cycles cost at {datetime.datetime.now()} ...")
+    recalculate_cycles_cost(task)
+    # The finished row is kept as the report of the last recalculation
+    task.update_payload(step='done', finished_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
     db.session.commit()
-    current_app.logger.info('Guest user disabled.')
+    current_app.logger.info(f"Task to recalculate cycles cost ended at {datetime.datetime.now()}.")
 
 
-@shared_task(name='truncate_push_subscriptions', ignore_result=True)
-def truncate_push_subscriptions_task():
-    """ Scheduled task to truncate the push subscriptions. """
-    from app.models import PushSubscription, WashingCycle
-    current_app.logger.info("Deleting all push subscription entries...")
-    if WashingCycle.query.filter_by(end_timestamp=None):
-        current_app.logger.warning("There are still active cycles, skipping truncation of push subscriptions.")
-    else:
-        PushSubscription.query.delete()
-        current_app.logger.info("Push subscriptions deleted!. Exiting...")
+@shared_task(name='send_notification_to_debtors', ignore_result=True)
+def send_notification_to_debtors_task():
+    """ Scheduled task to send a push notification to all debtors, reminding them to pay up. """
+    from app.functions import notify_debtors
+    current_app.logger.info("Will send notifications to all debtors...")
+    notify_debtors()
+    current_app.logger.info("All debtors were notified. Exiting...")
+
+
+@shared_task(name='dispatch_push_outbox', ignore_result=True)
+def dispatch_push_outbox_task():
+    """
+    Task to deliver the notifications of the outbox, started after each commit that queues one. The scheduled run
+    picks up the retries and anything queued while the broker was unavailable.
+    """
+    from app.push import dispatch_push_outbox
+    batch_size = int(os.getenv('PUSH_OUTBOX_BATCH_SIZE', 100))
+    while dispatch_push_outbox(batch_size) == batch_size:
+        pass
+
+
+@shared_task(bind=True, ignore_result=True)
+def disable_guest_after_finish_task(self, task_id: str):
+    """ Task to disable guest user after they finish with the washing machine. """
+    task = CeleryTask.claim_step(task_id, self.request.id)
+    if task is None:
+        current_app.logger.info('Disabling of guest user was cancelled, skipping.')
+        return
+
+    user = User.query.filter_by(id=task.user_id).first()
+    if user:
+        current_app.logger.info(f'Disabling guest user {user.username}.')
+        user.active = False
+        current_app.logger.info('Guest user disabled.')
+    db.session.delete(task)
+    db.session.commit()
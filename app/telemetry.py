@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import datetime
+from typing import Optional
+
+import redis
+from flask import Flask, current_app
+from requests.exceptions import RequestException
+
+from app.db import db
+from app.cache import get_redis
+from app.functions import get_washer_info
+from app.candy import CandyWashingMachine
+from app.watcher import MachineWatcher
+
+TELEMETRY_CHANNEL = 'laundrymaster:telemetry'
+TELEMETRY_LAST_KEY = 'laundrymaster:telemetry:last'
+TELEMETRY_PROTOCOL_VERSION = 1
+
+
+class TelemetryPoller:
+    """
+    Samples the Shelly relay and the Candy washing machine on a schedule and publishes the merged state to a
+    Redis channel, so any number of WebSocket viewers cost a single upstream poll. Every Candy sample is also fed
+    to the machine watcher, which dispatches the state transition handlers.
+    """
+
+    def __init__(self, redis_client: redis.Redis, interval: float = None, candy_interval: float = None):
+        self.redis = redis_client
+        self.interval = interval or float(os.getenv('TELEMETRY_INTERVAL', 1))
+        self.candy_interval = candy_interval or float(os.getenv('TELEMETRY_CANDY_INTERVAL', 60))
+        self.last_candy_poll: Optional[float] = None
+        self.last_candy: Optional[dict] = None
+        self.candy_machine: Optional[CandyWashingMachine] = None
+        self.watcher = MachineWatcher()
+
+    def sample_washer(self) -> dict:
+        try:
+            return get_washer_info(cycle_start=True)
+        except RequestException as e:
+            current_app.logger.error(f'Telemetry poller failed to sample Shelly. Error: {e}')
+            return get_washer_info(shelly=False, cycle_start=True)
+
+    def sample_candy(self) -> Optional[dict]:
+        if self.last_candy_poll is not None and time.monotonic() - self.last_candy_poll < self.candy_interval:
+            return None
+        self.last_candy_poll = time.monotonic()
+        try:
+            if self.candy_machine is None:
+                self.candy_machine = CandyWashingMachine()
+            else:
+                self.candy_machine.update()
+            self.watcher.observe(self.candy_machine.machine_state)
+            return self.candy_machine.asdict()
+        except (RuntimeError, RequestException) as e:
+            current_app.logger.error(f'Telemetry poller failed to sample Candy. Error: {e}')
+            return None
+
+    def poll_once(self) -> dict:
+        state = {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'washer': self.sample_washer()
+        }
+        if (candy := self.sample_candy()) is not None:
+            self.last_candy = candy
+        # Every state carries the last Candy sample, so a new viewer gets it with the first message
+        if self.last_candy is not None:
+            state['candy'] = self.last_candy
+        # Do not keep a transaction open between polls
+        db.session.remove()
+
+        message = json.dumps(state)
+        self.redis.set(TELEMETRY_LAST_KEY, message)
+        self.redis.publish(TELEMETRY_CHANNEL, message)
+        return state
+
+    def run(self):
+        current_app.logger.info(f'Telemetry poller started with interval of {self.interval} seconds.')
+        while True:
+            started = time.monotonic()
+            try:
+                self.poll_once()
+            except redis.RedisError as e:
+                current_app.logger.error(f'Telemetry poller failed to publish. Error: {e}')
+            except Exception:
+                # The poller also drives the machine watcher, so a single bad tick must not stop it
+                current_app.logger.exception('Telemetry poller failed to poll.')
+                db.session.remove()
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+
+class TelemetryDeltaEncoder:
+    """
+    Encodes the telemetry states sent to a single WebSocket. The first message is a full snapshot, after which only
+    the changed fields are sent. Every message carries a sequence number, so clients can detect a lost delta, and a
+    snapshot is repeated as a keyframe every keyframe_interval seconds.
+    """
+
+    def __init__(self, keyframe_interval: float = None):
+        self.keyframe_interval = keyframe_interval or float(os.getenv('TELEMETRY_KEYFRAME_INTERVAL', 30))
+        self.seq = 0
+        self.last_state: Optional[dict] = None
+        self.last_keyframe: Optional[float] = None
+
+    def encode(self, state: dict) -> Optional[str]:
+        """ Returns the message to send for the new state or None if nothing has changed. """
+        now = time.monotonic()
+        if self.last_state is None or now - self.last_keyframe >= self.keyframe_interval:
+            message = {
+                'v': TELEMETRY_PROTOCOL_VERSION,
+                'type': 'snapshot',
+                'seq': self.seq,
+                'ts': round(time.time() * 1000),
+                'data': state
+            }
+            self.last_keyframe = now
+        else:
+            changed = {key: value for key, value in state.items()
+                       if key not in self.last_state or self.last_state[key] != value}
+            removed = [key for key in self.last_state if key not in state]
+            if not changed and not removed:
+                return None
+            message = {'v': TELEMETRY_PROTOCOL_VERSION, 'type': 'delta', 'seq': self.seq, 'data': changed}
+            if removed:
+                message['removed'] = removed
+
+        self.seq += 1
+        self.last_state = dict(state)
+        return json.dumps(message, separators=(',', ':'))
+
+
+def run_telemetry_poller(app: Flask):
+    """ Runs the telemetry poller forever in the context of the app. """
+    with app.app_context():
+        TelemetryPoller(get_redis()).run()
+
+
+def subscribe_telemetry():
+    """ Yields every published telemetry state, starting with the last one if there is any. """
+    redis_client = get_redis()
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(TELEMETRY_CHANNEL)
+    try:
+        if last := redis_client.get(TELEMETRY_LAST_KEY):
+            yield json.loads(last)
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                yield json.loads(message['data'])
+    finally:
+        pubsub.close()
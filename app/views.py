@@ -4,6 +4,7 @@ from flask_security import login_required, current_user, hash_password, roles_re
 from app.candy import StartProgramForm, CandyWashingMachine
 from app.forms import *
 from app.db import limiter
+from app.machine import get_machine_config
 
 from app.functions import *
 from app.statistics import *
@@ -36,8 +37,7 @@ def handle_cycle_buttons():
                 flash(f'Error! {e}', category='toast-error')
             return redirect(request.path)
 
-    washing_machine_model = WashingMachine.query.first()
-    if washing_machine_model.global_shutdown:
+    if get_machine_config().global_shutdown:
         return render_template('error.html', code='global_shutdown')
 
 
@@ -97,17 +97,16 @@ def index():
         if not any([checkbox.data for checkbox in unpaid_cycles_form.checkboxes]):
             flash('Nothing to update', category='toast-warning')
             return redirect(request.path)
-        paid_amount = 0
-        for checkbox in unpaid_cycles_form.checkboxes:
-            if checkbox.data:
-                idx = int(checkbox.id.split('-')[1])
-                if mark_cycle_paid(current_user, unpaid_cycles[idx].id, True):
-                    if hasattr(unpaid_cycles[idx], 'split_cost'):
-                        paid_amount += unpaid_cycles[idx].split_cost
-                    else:
-                        paid_amount += unpaid_cycles[idx].cost
-        flash('Selected cycles marked as paid', category='toast-success')
-        record_payment(current_user, paid_amount)
+        payment = mark_cycles_paid(current_user, [
+            unpaid_cycles[int(checkbox.id.split('-')[1])].id
+            for checkbox in unpaid_cycles_form.checkboxes if checkbox.data
+        ])
+        for cycle_id, outcome in payment.outcomes.items():
+            if outcome != 'paid':
+                flash(f'Cycle #{cycle_id} couldn\'t be marked as paid! {PAYMENT_OUTCOME_MESSAGES[outcome]}',
+                      category='toast-error')
+        if 'paid' in payment.outcomes.values():
+            flash('Selected cycles marked as paid', category='toast-success')
         return redirect(request.path)
 
     expected_end = None
@@ -154,14 +153,21 @@ def usage_view(cycle_id=None):
                 flash(f'{error} about {field}', category='toast-error')
 
     select_form = UsageViewShowCountForm(items=request.args.get('items') or '10')
+    if select_form.items.data not in [str(value) for value, _ in select_form.items.choices]:
+        select_form.items.data = '10'
     if select_form.items.data == 'all':
         limit = None
     else:
-        limit = select_form.items.data
+        limit = max(int(select_form.items.data), 1)
+    try:
+        usages = get_usage_page(current_user, limit, request.args.get('cursor'))
+    except ValueError:
+        flash('Invalid page', category='toast-error')
+        return redirect(request.path)
 
     split_request_cycle = None
     if cycle_id is not None:
-        cycle = WashingCycle.query.filter_by(id=cycle_id).first()
+        cycle = WashingCycle.query.filter_by(id=cycle_id).options(undefer_group('splits')).first()
         split = WashingCycleSplit.query.filter_by(cycle_id=cycle_id, user_id=current_user.id).first()
         if cycle is None:
             flash('Cycle not found', category='toast-error')
@@ -174,17 +180,14 @@ def usage_view(cycle_id=None):
             return redirect('/usage')
         else:
             split_request_cycle = cycle
-            split_users_count = len(cycle.splits)
-            cycle.split_cost = round(cycle.cost / (split_users_count + 1), 2)
-            if cycle.split_cost * (split_users_count + 1) < cycle.cost:
-                cycle.split_cost = round(cycle.split_cost + decimal.Decimal(0.01), 2)
 
     return render_template(
         'usage.html',
         is_usage=True,
         cycle_data=update_cycle(current_user),
         select_form=select_form,
-        usages=get_usage_list(current_user, limit),
+        usages=usages.items,
+        next_cursor=usages.next_cursor,
         split_cycle_form=split_cycle_form,
         mark_paid_form=mark_paid_form,
         split_request_cycle=split_request_cycle
@@ -209,7 +212,11 @@ def split_cycle_actions(cycle_id, action=None):
             db.session.commit()
             flash('Cycle split accepted', category='toast-success')
         elif action == 'reject':
+            participant_ids = cycle_participant_ids(cycle)
+            rollup_keys = cycle_rollup_keys(cycle)
             db.session.delete(split)
+            refresh_balances(participant_ids)
+            refresh_rollups(rollup_keys)
             db.session.commit()
             flash('Cycle split rejected', category='toast-success')
         else:
@@ -380,17 +387,17 @@ def washing_machine():
             return redirect(request.path), 403
         if washing_machine_notes_form.notes.data != washing_machine_obj.notes:
             washing_machine_obj.notes = washing_machine_notes_form.notes.data
-            db.session.commit()
-            current_app.logger.info(f'User {current_user.username} updated washing machine notes')
-            flash('Notes updated successfully!', category='toast-success')
             if washing_machine_obj.notes:
-                send_push_to_all(
+                queue_push_to_all(
                     Notification(
                         title=f'{current_user.first_name} updated washing machine notes!',
                         body=f'Body: {washing_machine_obj.notes}',
                         icon='icon-android-homescreen.png'
                     )
                 )
+            db.session.commit()
+            current_app.logger.info(f'User {current_user.username} updated washing machine notes')
+            flash('Notes updated successfully!', category='toast-success')
         else:
             flash('Nothing to update.', category='toast-warning')
         return redirect(request.path)
@@ -415,8 +422,6 @@ def washing_machine():
 @login_required
 @roles_required('room_owner')
 def payouts():
-    payment_records = WashingCyclePayment.query.filter_by(propagated=False).all()
-
     if request.args.get('mark_propagated'):
         if request.args.get('mark_propagated') == 'all':
             WashingCyclePayment.query.filter_by(propagated=False).update({'propagated': True})
@@ -435,9 +440,16 @@ def payouts():
                 flash('Invalid record ID', category='toast-error')
         return redirect(request.path)
 
+    try:
+        payment_records = get_payments_page(cursor=request.args.get('cursor'))
+    except ValueError:
+        flash('Invalid page', category='toast-error')
+        return redirect(request.path)
+
     return render_template(
         'payouts.html',
         is_payouts=True,
         cycle_data=update_cycle(current_user),
-        payment_records=payment_records
+        payment_records=payment_records.items,
+        next_cursor=payment_records.next_cursor
     )
@@ -0,0 +1,54 @@
+import datetime
+from typing import Optional
+
+from flask import current_app
+from sqlalchemy import or_
+
+from app.models import CeleryTask
+from app.candy import CandyMachineState
+
+WATCHED_KINDS = (CeleryTask.TaskKinds.CYCLE_NOTIFICATION, CeleryTask.TaskKinds.WASH_THEN_DRY)
+# Time given to the user to start a program after starting a cycle, the machine is not watched for them until then
+CYCLE_START_GRACE = datetime.timedelta(minutes=10)
+
+
+class MachineWatcher:
+    """
+    Detects state transitions of the Candy washing machine from consecutive samples and dispatches a short handler
+    task for every registered subscription (cycle end notifications, automatic stop, drying after washing).
+    """
+
+    def __init__(self, initial_state: Optional[CandyMachineState] = None):
+        self.last_state: Optional[CandyMachineState] = initial_state
+        # Transitions not dispatched to every subscription yet, with the ids of the subscriptions which got them
+        self.pending: list[tuple[CandyMachineState, CandyMachineState, set[str]]] = []
+
+    def observe(self, state: CandyMachineState) -> bool:
+        """
+        Records a new sample of the machine state and returns whether it was a transition. If dispatching fails,
+        the transition is kept and dispatched to the remaining subscriptions with the next sample.
+        """
+        previous_state, self.last_state = self.last_state, state
+        transition = previous_state is not None and previous_state != state
+        if transition:
+            current_app.logger.info(f'Machine state changed from {previous_state.label} to {state.label}.')
+            self.pending.append((previous_state, state, set()))
+
+        while self.pending:
+            self.dispatch(*self.pending[0])
+            self.pending.pop(0)
+        return transition
+
+    @staticmethod
+    def dispatch(previous_state: CandyMachineState, state: CandyMachineState, dispatched_ids: set[str]):
+        from app.tasks import machine_transition_task
+
+        grace_start = datetime.datetime.now(datetime.timezone.utc) - CYCLE_START_GRACE
+        subscriptions = CeleryTask.query.filter(CeleryTask.kind.in_(WATCHED_KINDS), or_(
+            CeleryTask.kind != CeleryTask.TaskKinds.CYCLE_NOTIFICATION,
+            CeleryTask.timestamp <= grace_start
+        )).all()
+        for subscription in subscriptions:
+            if subscription.id not in dispatched_ids:
+                machine_transition_task.delay(subscription.id, previous_state.code, state.code)
+                dispatched_ids.add(subscription.id)
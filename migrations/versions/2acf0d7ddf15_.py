@@ -0,0 +1,30 @@
+"""Add user and payload to tasks for watcher subscriptions
+
+Revision ID: 2acf0d7ddf15
+Revises: 5ecae332bd85
+Create Date: 2024-04-06 11:20:41.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2acf0d7ddf15'
+down_revision = '5ecae332bd85'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('tasks', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('user_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('payload', sa.JSON(), nullable=True))
+        batch_op.create_foreign_key('tasks_user_id_fkey', 'users', ['user_id'], ['id'])
+
+
+def downgrade():
+    with op.batch_alter_table('tasks', schema=None) as batch_op:
+        batch_op.drop_constraint('tasks_user_id_fkey', type_='foreignkey')
+        batch_op.drop_column('payload')
+        batch_op.drop_column('user_id')
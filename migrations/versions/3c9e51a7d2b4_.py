@@ -0,0 +1,61 @@
+"""Add user balances ledger
+
+Revision ID: 3c9e51a7d2b4
+Revises: 2acf0d7ddf15
+Create Date: 2024-04-09 19:02:13.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e51a7d2b4'
+down_revision = '2acf0d7ddf15'
+branch_labels = None
+depends_on = None
+
+
+washing_cycles = sa.table('washing_cycles', sa.column('id', sa.Integer()), sa.column('user_id', sa.Integer()),
+                          sa.column('cost', sa.Numeric(10, 2)), sa.column('paid', sa.Boolean()),
+                          sa.column('end_timestamp', sa.DateTime(timezone=True)))
+split_cycles = sa.table('split_cycles', sa.column('cycle_id', sa.Integer()), sa.column('user_id', sa.Integer()),
+                        sa.column('paid', sa.Boolean()))
+
+
+def upgrade():
+    user_balances = op.create_table('user_balances',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('unpaid_cost', sa.Numeric(precision=10, scale=2), nullable=False),
+    sa.Column('unpaid_cycles', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+    # Fill the ledger with the unpaid shares of the finished cycles, computed as in app.statistics.cycle_shares
+    splits_count = sa.select(sa.func.count(split_cycles.c.user_id)) \
+        .where(split_cycles.c.cycle_id == washing_cycles.c.id) \
+        .correlate(washing_cycles) \
+        .scalar_subquery()
+    cents = sa.cast(sa.func.round(sa.func.coalesce(washing_cycles.c.cost, 0) * 100), sa.Integer)
+    share_cents = (cents + splits_count) // (splits_count + 1)
+    owners = sa.select(washing_cycles.c.user_id.label('user_id'), share_cents.label('share_cents')).where(
+        washing_cycles.c.end_timestamp.is_not(None), washing_cycles.c.paid.is_(False)
+    )
+    split_users = sa.select(split_cycles.c.user_id, share_cents) \
+        .select_from(washing_cycles) \
+        .join(split_cycles, split_cycles.c.cycle_id == washing_cycles.c.id) \
+        .where(washing_cycles.c.end_timestamp.is_not(None), split_cycles.c.paid.is_(False))
+    shares = sa.union_all(owners, split_users).subquery('cycle_shares')
+    op.execute(user_balances.insert().from_select(
+        ['user_id', 'unpaid_cost', 'unpaid_cycles', 'updated_at'],
+        sa.select(shares.c.user_id, sa.func.sum(shares.c.share_cents) / sa.literal_column('100.0'),
+                  sa.func.count(), sa.func.now())
+        .where(shares.c.user_id.is_not(None))
+        .group_by(shares.c.user_id)
+    ))
+
+
+def downgrade():
+    op.drop_table('user_balances')
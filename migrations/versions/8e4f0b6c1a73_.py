@@ -0,0 +1,35 @@
+"""Add monthly rollups of user statistics
+
+Revision ID: 8e4f0b6c1a73
+Revises: 3c9e51a7d2b4
+Create Date: 2024-04-11 21:44:05.771392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4f0b6c1a73'
+down_revision = '3c9e51a7d2b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('monthly_rollups',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('year', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('month', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('cost', sa.Numeric(precision=10, scale=2), nullable=False),
+    sa.Column('kwh', sa.Numeric(precision=20, scale=4), nullable=False),
+    sa.Column('cycles', sa.Integer(), nullable=False),
+    sa.Column('savings_cycles', sa.Integer(), nullable=False),
+    sa.Column('savings_cost', sa.Numeric(precision=10, scale=2), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'year', 'month')
+    )
+
+
+def downgrade():
+    op.drop_table('monthly_rollups')
@@ -0,0 +1,32 @@
+"""Add indexes for the keyset pagination of cycles and payments
+
+Revision ID: a9c4e6f1b382
+Revises: f3b8e2a5d147
+Create Date: 2024-04-15 20:13:44.871902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9c4e6f1b382'
+down_revision = 'f3b8e2a5d147'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('washing_cycles', schema=None) as batch_op:
+        batch_op.create_index('ix_washing_cycles_start_timestamp_id', ['start_timestamp', 'id'], unique=False)
+
+    with op.batch_alter_table('payments', schema=None) as batch_op:
+        batch_op.create_index('ix_payments_propagated_timestamp_id', ['propagated', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('payments', schema=None) as batch_op:
+        batch_op.drop_index('ix_payments_propagated_timestamp_id')
+
+    with op.batch_alter_table('washing_cycles', schema=None) as batch_op:
+        batch_op.drop_index('ix_washing_cycles_start_timestamp_id')
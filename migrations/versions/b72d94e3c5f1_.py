@@ -0,0 +1,54 @@
+"""Add indexes for cycle, split, schedule, task and push subscription queries
+
+Revision ID: b72d94e3c5f1
+Revises: 8e4f0b6c1a73
+Create Date: 2024-04-13 16:27:52.390846
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b72d94e3c5f1'
+down_revision = '8e4f0b6c1a73'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('washing_cycles', schema=None) as batch_op:
+        batch_op.create_index('ix_washing_cycles_end_timestamp', ['end_timestamp'], unique=False)
+        batch_op.create_index('ix_washing_cycles_user_id_paid_end_timestamp', ['user_id', 'paid', 'end_timestamp'],
+                              unique=False)
+
+    with op.batch_alter_table('split_cycles', schema=None) as batch_op:
+        batch_op.create_index('ix_split_cycles_user_id_paid', ['user_id', 'paid'], unique=False)
+
+    with op.batch_alter_table('schedule', schema=None) as batch_op:
+        batch_op.create_index('ix_schedule_start_timestamp_end_timestamp', ['start_timestamp', 'end_timestamp'],
+                              unique=False)
+
+    with op.batch_alter_table('tasks', schema=None) as batch_op:
+        batch_op.create_index('ix_tasks_kind_ref_id', ['kind', 'ref_id'], unique=False)
+
+    with op.batch_alter_table('push_subscription', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_push_subscription_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('push_subscription', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_push_subscription_user_id'))
+
+    with op.batch_alter_table('tasks', schema=None) as batch_op:
+        batch_op.drop_index('ix_tasks_kind_ref_id')
+
+    with op.batch_alter_table('schedule', schema=None) as batch_op:
+        batch_op.drop_index('ix_schedule_start_timestamp_end_timestamp')
+
+    with op.batch_alter_table('split_cycles', schema=None) as batch_op:
+        batch_op.drop_index('ix_split_cycles_user_id_paid')
+
+    with op.batch_alter_table('washing_cycles', schema=None) as batch_op:
+        batch_op.drop_index('ix_washing_cycles_user_id_paid_end_timestamp')
+        batch_op.drop_index('ix_washing_cycles_end_timestamp')
@@ -0,0 +1,38 @@
+"""Add the push_outbox table for notifications delivered by Celery
+
+Revision ID: c5e8a2d4f917
+Revises: a9c4e6f1b382
+Create Date: 2024-04-17 19:26:03.218734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8a2d4f917'
+down_revision = 'a9c4e6f1b382'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('push_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('payload', sa.JSON(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('next_attempt_at', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('push_outbox', schema=None) as batch_op:
+        batch_op.create_index('ix_push_outbox_next_attempt_at', ['next_attempt_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('push_outbox', schema=None) as batch_op:
+        batch_op.drop_index('ix_push_outbox_next_attempt_at')
+
+    op.drop_table('push_outbox')
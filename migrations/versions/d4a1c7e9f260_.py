@@ -0,0 +1,27 @@
+"""Allow at most one running washing cycle
+
+Revision ID: d4a1c7e9f260
+Revises: b72d94e3c5f1
+Create Date: 2024-04-14 11:05:37.218410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a1c7e9f260'
+down_revision = 'b72d94e3c5f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fails if more than one cycle is running, which has to be stopped first
+    op.create_index('uq_washing_cycles_open_cycle', 'washing_cycles', [sa.text('(end_timestamp IS NULL)')],
+                    unique=True, sqlite_where=sa.text('end_timestamp IS NULL'),
+                    postgresql_where=sa.text('end_timestamp IS NULL'))
+
+
+def downgrade():
+    op.drop_index('uq_washing_cycles_open_cycle', table_name='washing_cycles')
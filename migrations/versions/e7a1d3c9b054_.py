@@ -0,0 +1,77 @@
+"""Identify push subscriptions by the digest of their endpoint and keep delivery metadata
+
+Revision ID: e7a1d3c9b054
+Revises: c5e8a2d4f917
+Create Date: 2024-04-18 21:04:37.550192
+
+"""
+import json
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a1d3c9b054'
+down_revision = 'c5e8a2d4f917'
+branch_labels = None
+depends_on = None
+
+
+push_subscription = sa.table('push_subscription', sa.column('id', sa.Integer()),
+                             sa.column('subscription_json', sa.Text()), sa.column('endpoint', sa.Text()),
+                             sa.column('endpoint_digest', sa.String(64)))
+
+
+def normalize_endpoint(endpoint: str) -> str:
+    url = urlsplit(endpoint.strip())
+    return urlunsplit((url.scheme.lower(), url.netloc.lower(), url.path, url.query, ''))
+
+
+def upgrade():
+    with op.batch_alter_table('push_subscription', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('endpoint', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('endpoint_digest', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('user_agent', sa.String(length=512), nullable=True))
+        batch_op.add_column(sa.Column('created_at', sa.DateTime(timezone=True), nullable=True))
+        batch_op.add_column(sa.Column('last_success_at', sa.DateTime(timezone=True), nullable=True))
+        batch_op.add_column(sa.Column('failure_count', sa.Integer(), nullable=False, server_default='0'))
+
+    # Keep the newest subscription of each endpoint and drop the ones which cannot be delivered to
+    connection = op.get_bind()
+    digests, stale_ids = set(), []
+    for subscription_id, subscription_json in connection.execute(
+            sa.select(push_subscription.c.id, push_subscription.c.subscription_json)
+            .order_by(push_subscription.c.id.desc())):
+        try:
+            endpoint = normalize_endpoint(json.loads(subscription_json)['endpoint'])
+        except (TypeError, KeyError, AttributeError, ValueError):
+            stale_ids.append(subscription_id)
+            continue
+        digest = hashlib.sha256(endpoint.encode()).hexdigest()
+        if digest in digests:
+            stale_ids.append(subscription_id)
+            continue
+        digests.add(digest)
+        connection.execute(push_subscription.update().where(push_subscription.c.id == subscription_id)
+                           .values(endpoint=endpoint, endpoint_digest=digest))
+    if stale_ids:
+        connection.execute(push_subscription.delete().where(push_subscription.c.id.in_(stale_ids)))
+
+    with op.batch_alter_table('push_subscription', schema=None) as batch_op:
+        batch_op.alter_column('endpoint', existing_type=sa.Text(), nullable=False)
+        batch_op.alter_column('endpoint_digest', existing_type=sa.String(length=64), nullable=False)
+        batch_op.create_index('uq_push_subscription_endpoint_digest', ['endpoint_digest'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('push_subscription', schema=None) as batch_op:
+        batch_op.drop_index('uq_push_subscription_endpoint_digest')
+        batch_op.drop_column('failure_count')
+        batch_op.drop_column('last_success_at')
+        batch_op.drop_column('created_at')
+        batch_op.drop_column('user_agent')
+        batch_op.drop_column('endpoint_digest')
+        batch_op.drop_column('endpoint')
@@ -0,0 +1,61 @@
+"""Move the Candy appliance data from a pickled column to the candy_snapshots table
+
+Revision ID: f3b8e2a5d147
+Revises: d4a1c7e9f260
+Create Date: 2024-04-14 18:52:10.604127
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8e2a5d147'
+down_revision = 'd4a1c7e9f260'
+branch_labels = None
+depends_on = None
+
+
+washing_machine = sa.table('washing_machine', sa.column('id', sa.Integer()),
+                           sa.column('candy_appliance_data', sa.PickleType()))
+
+
+def upgrade():
+    candy_snapshots = op.create_table('candy_snapshots',
+    sa.Column('washing_machine_id', sa.Integer(), nullable=False),
+    sa.Column('data', sa.JSON(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['washing_machine_id'], ['washing_machine.id'], ),
+    sa.PrimaryKeyConstraint('washing_machine_id')
+    )
+
+    connection = op.get_bind()
+    snapshots = []
+    for washing_machine_id, data in connection.execute(
+            sa.select(washing_machine.c.id, washing_machine.c.candy_appliance_data)
+            .where(washing_machine.c.candy_appliance_data.is_not(None))):
+        data.pop('last_updated', None)
+        snapshots.append({'washing_machine_id': washing_machine_id, 'data': data,
+                          'updated_at': datetime.datetime.now(datetime.timezone.utc)})
+    if snapshots:
+        op.bulk_insert(candy_snapshots, snapshots)
+
+    with op.batch_alter_table('washing_machine', schema=None) as batch_op:
+        batch_op.drop_column('candy_appliance_data')
+
+
+def downgrade():
+    with op.batch_alter_table('washing_machine', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('candy_appliance_data', sa.PickleType(), nullable=True))
+
+    connection = op.get_bind()
+    candy_snapshots = sa.table('candy_snapshots', sa.column('washing_machine_id', sa.Integer()),
+                               sa.column('data', sa.JSON()))
+    for washing_machine_id, data in connection.execute(
+            sa.select(candy_snapshots.c.washing_machine_id, candy_snapshots.c.data)).all():
+        connection.execute(washing_machine.update().where(washing_machine.c.id == washing_machine_id)
+                           .values(candy_appliance_data=data))
+
+    op.drop_table('candy_snapshots')
@@ -0,0 +1,10 @@
+from app import create_app
+from app.telemetry import run_telemetry_poller
+from dotenv import load_dotenv
+
+load_dotenv()
+
+flask_app = create_app()
+
+if __name__ == '__main__':
+    run_telemetry_poller(flask_app)
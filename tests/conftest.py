@@ -1,10 +1,15 @@
 import os
 import pytest
+import datetime
 import tempfile
+from contextlib import contextmanager
+
+from sqlalchemy import event
 from sqlalchemy.sql import text
 
 from app import create_app
 from app.db import db
+from app.models import WashingCycle
 
 with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
     _data_sql = f.read().decode('utf8')
@@ -42,6 +47,32 @@ def app():
     # os.unlink(db_path)
 
 
+@contextmanager
+def count_queries():
+    """ Counts the SQL statements executed inside the block. """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def add_cycles(count: int, user_id: int = 1, start: datetime.datetime = datetime.datetime(2024, 3, 1)):
+    """ Adds count finished cycles, each pair of them started at the same time. """
+    db.session.execute(db.insert(WashingCycle), [
+        {'user_id': user_id, 'startkwh': 0, 'endkwh': 1, 'cost': 0.20, 'paid': False,
+         'start_timestamp': start - datetime.timedelta(hours=i // 2),
+         'end_timestamp': start - datetime.timedelta(hours=i // 2) + datetime.timedelta(minutes=90)}
+        for i in range(count)
+    ])
+    db.session.commit()
+
+
 @pytest.fixture
 def client(app):
     return app.test_client()
@@ -10,6 +10,7 @@ from app.api import *
 from app.models import User
 
 from tests.test_auth import login
+from tests.conftest import add_cycles
 
 os.environ['FLASK_API_SECRET_KEY'] = 'test_key'
 
@@ -141,3 +142,28 @@ def test_trigger_push_by_id_unauthorized(mock_send_push_to_all, client, app):
 
         assert response.status_code == 403
         assert not mock_send_push_to_all.called
+
+
+def test_export_washing_cycles(client, app):
+    """ Testing the streamed export of cycles as CSV, Excel CSV and NDJSON with filters. """
+    with app.app_context():
+        add_cycles(4, start=datetime.datetime(2024, 3, 2, 10))
+        add_cycles(2, user_id=2, start=datetime.datetime(2024, 1, 5, 10))
+    login(client, app, 'georgi', 'password')
+
+    response = client.get('/api/export_washing_cycles.csv')
+    assert response.is_streamed
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0] == 'id,user,date,used_kwh,cost'
+    assert lines[1] == '2,1,2024-03-02,1.0000,0.20'
+    assert len(lines) == 7
+
+    response = client.get('/api/export_washing_cycles.csv?excel=true&count=1')
+    assert response.get_data(as_text=True) == '\ufeffid;user;date;used_kwh;cost\r\n2;1;2024-03-02;1,0000;0,20\r\n'
+
+    response = client.get('/api/export_washing_cycles.ndjson?user_id=2&start=2024-01-01&end=2024-01-05')
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert rows == [{'id': 6, 'user': 2, 'date': '2024-01-05', 'used_kwh': '1.0000', 'cost': '0.20'},
+                    {'id': 5, 'user': 2, 'date': '2024-01-05', 'used_kwh': '1.0000', 'cost': '0.20'}]
+
+    assert client.get('/api/export_washing_cycles.csv?start=yesterday').status_code == 400
@@ -0,0 +1,110 @@
+import json
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests.exceptions import RequestException
+
+from app.clients import ApiClient
+from app.shelly import fetch_device_status
+from app.functions import trigger_relay
+
+
+class FakeShellyHandler(BaseHTTPRequestHandler):
+    requests_seen = []
+    failures_left = 0
+
+    def do_GET(self):
+        FakeShellyHandler.requests_seen.append(self.path)
+        if self.path.startswith('/slow'):
+            threading.Event().wait(1)
+        if FakeShellyHandler.failures_left > 0:
+            FakeShellyHandler.failures_left -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'data': {'device_status': {
+            'meters': [{'total': 60000, 'power': 5}],
+            'relays': [{'ison': False}],
+            'temperature': 30,
+            'wifi_sta': {'rssi': -50}
+        }}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_server():
+    FakeShellyHandler.requests_seen = []
+    FakeShellyHandler.failures_left = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeShellyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_client_uses_pluggable_base_url(fake_server, app, monkeypatch):
+    """ Testing that the Shelly client can be pointed at a local fake server. """
+    monkeypatch.setenv('SHELLY_CLOUD_ENDPOINT', fake_server)
+    with app.app_context():
+        data = fetch_device_status()
+
+    assert data['data']['device_status']['meters'][0]['power'] == 5
+    assert FakeShellyHandler.requests_seen[0].startswith('/device/status')
+
+
+def test_client_retries_with_backoff(fake_server, monkeypatch):
+    """ Testing that failing responses are retried a bounded number of times. """
+    monkeypatch.setenv('HTTP_RETRY_BACKOFF', '0')
+    client = ApiClient('UNUSED_ENDPOINT')
+    client.base_url = fake_server
+    FakeShellyHandler.failures_left = 2
+
+    response = client.get('/device/status')
+
+    assert response.status_code == 200
+    assert len(FakeShellyHandler.requests_seen) == 3
+
+
+def test_relay_control_not_retried(fake_server, app, monkeypatch):
+    """ Testing that a failed relay request returns right away, leaving the retries to the release door task. """
+    monkeypatch.setenv('SHELLY_CLOUD_ENDPOINT', fake_server)
+    FakeShellyHandler.failures_left = 1
+    with app.app_context():
+        assert trigger_relay('on') == 503
+
+    assert FakeShellyHandler.requests_seen == ['/device/relay/control']
+
+
+def test_client_read_timeout(fake_server, monkeypatch):
+    """ Testing that a slow response raises a timeout instead of blocking forever. """
+    monkeypatch.setenv('HTTP_READ_TIMEOUT', '0.2')
+    monkeypatch.setenv('HTTP_MAX_RETRIES', '0')
+    client = ApiClient('UNUSED_ENDPOINT')
+    client.base_url = fake_server
+
+    with pytest.raises(RequestException):
+        client.get('/slow')
+
+
+def test_client_reuses_session(fake_server):
+    """ Testing that the pooled session is kept alive between requests. """
+    client = ApiClient('UNUSED_ENDPOINT')
+    client.base_url = fake_server
+
+    session = client.session
+    client.get('/device/status')
+    client.get('/device/status')
+
+    assert client.session is session
@@ -10,6 +10,7 @@ from app.db import db
 from app.functions import *
 from app.models import User, WashingCycle, WashingCycleSplit, ScheduleEvent
 from app.forms import SplitCycleForm
+from tests.conftest import count_queries
 
 
 @patch('app.functions.get_energy_consumption')
@@ -187,9 +188,9 @@ def test_update_cycle_washing_machine_busy(app):
         assert result['user'] == active_user.first_name
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.flash')
-def test_split_cycle(mock_flash, mock_send_push, app):
+def test_split_cycle(mock_flash, mock_queue_push, app):
     """ Testing the split cycle function when all conditions are satisfied. """
     with app.test_request_context():
         current_user = User.query.filter_by(username='ivan').first()
@@ -211,14 +212,14 @@ def test_split_cycle(mock_flash, mock_send_push, app):
 
         assert len(cycle.splits) > 0
         assert cycle.splits[0].user_id == other_user.id
-        assert mock_send_push.called
-        assert other_user in mock_send_push.call_args[0]
+        assert mock_queue_push.called
+        assert other_user in mock_queue_push.call_args[0]
         mock_flash.assert_called_with('Cycle split successfully, users need to confirm to complete!', category='toast-success')
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.flash')
-def test_split_cycle_not_owned_by_user(mock_flash, mock_send_push, app):
+def test_split_cycle_not_owned_by_user(mock_flash, mock_queue_push, app):
     """Testing the split cycle function when the cycle is not owned by the current user. """
     with app.test_request_context():
         current_user = User.query.filter_by(username='ivan').first()
@@ -238,13 +239,13 @@ def test_split_cycle_not_owned_by_user(mock_flash, mock_send_push, app):
         split_cycle(current_user, split_form)
 
         assert len(cycle.splits) == 0
-        assert mock_send_push.called is False
+        assert mock_queue_push.called is False
         mock_flash.assert_called_with('You can only split your own cycles', category='toast-error')
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.flash')
-def test_split_cycle_already_paid(mock_flash, mock_send_push, app):
+def test_split_cycle_already_paid(mock_flash, mock_queue_push, app):
     """Testing the split cycle function when the cycle is not owned by the current user. """
     with app.test_request_context():
         current_user = User.query.filter_by(username='ivan').first()
@@ -264,14 +265,14 @@ def test_split_cycle_already_paid(mock_flash, mock_send_push, app):
         split_cycle(current_user, split_form)
 
         assert len(cycle.splits) == 0
-        assert mock_send_push.called is False
+        assert mock_queue_push.called is False
         mock_flash.assert_called_with('You cannot split paid cycles', category='toast-error')
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.redirect')
 @patch('app.functions.flash')
-def test_split_cycle_already_paid_split(mock_flash, mock_redirect, mock_send_push, app):
+def test_split_cycle_already_paid_split(mock_flash, mock_redirect, mock_queue_push, app):
     """ Testing the split cycle function when a split is already paid. """
     with app.test_request_context('/'):
         current_user = User.query.filter_by(username='ivan').first()
@@ -292,16 +293,16 @@ def test_split_cycle_already_paid_split(mock_flash, mock_redirect, mock_send_pus
         split_cycle(current_user, split_form)
 
         assert len(cycle.splits) == 1
-        assert mock_send_push.called is False
+        assert mock_queue_push.called is False
         assert mock_redirect.called
         mock_flash.assert_called_with('You cannot split cycles that have paid splits', category='toast-error')
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.CeleryTask')
 @patch('app.functions.redirect')
 @patch('app.functions.flash')
-def test_schedule_update_event(mock_flash, mock_redirect, mock_celery_task, mock_send_push, app):
+def test_schedule_update_event(mock_flash, mock_redirect, mock_celery_task, mock_queue_push, app):
     """ Testing the update schedule event function in normal conditions. """
     with app.test_request_context('/'):
         current_user = User.query.filter_by(username='ivan').first()
@@ -332,14 +333,14 @@ def test_schedule_update_event(mock_flash, mock_redirect, mock_celery_task, mock
         assert event.start_timestamp == new_start_timestamp
         assert event.end_timestamp == new_end_timestamp
         assert mock_celery_task.start_schedule_notification_task.called
-        assert mock_send_push.call_count == 1
+        assert mock_queue_push.call_count == 1
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.CeleryTask')
 @patch('app.functions.redirect')
 @patch('app.functions.flash')
-def test_schedule_update_event_invalid_id(mock_flash, mock_redirect, mock_celery_task, mock_send_push, app):
+def test_schedule_update_event_invalid_id(mock_flash, mock_redirect, mock_celery_task, mock_queue_push, app):
     """ Testing the update schedule event function with invalid event id. """
     with app.test_request_context('/'):
         current_user = User.query.filter_by(username='ivan').first()
@@ -359,14 +360,14 @@ def test_schedule_update_event_invalid_id(mock_flash, mock_redirect, mock_celery
         mock_flash.assert_called_with('Event not found', category='toast-error')
         assert mock_redirect.called
         assert not mock_celery_task.start_schedule_notification_task.called
-        assert mock_send_push.call_count == 0
+        assert mock_queue_push.call_count == 0
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.CeleryTask')
 @patch('app.functions.redirect')
 @patch('app.functions.flash')
-def test_schedule_update_event_wrong_user(mock_flash, mock_redirect, mock_celery_task, mock_send_push, app):
+def test_schedule_update_event_wrong_user(mock_flash, mock_redirect, mock_celery_task, mock_queue_push, app):
     """ Testing the update schedule event function with wrong user. """
     with app.test_request_context('/'):
         current_user = User.query.filter_by(username='ivan').first()
@@ -398,14 +399,14 @@ def test_schedule_update_event_wrong_user(mock_flash, mock_redirect, mock_celery
         mock_flash.assert_called_with('You can only edit your own events', category='toast-error')
         assert mock_redirect.called
         assert not mock_celery_task.start_schedule_notification_task.called
-        assert mock_send_push.call_count == 0
+        assert mock_queue_push.call_count == 0
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.CeleryTask')
 @patch('app.functions.redirect')
 @patch('app.functions.flash')
-def test_schedule_update_event_past(mock_flash, mock_redirect, mock_celery_task, mock_send_push, app):
+def test_schedule_update_event_past(mock_flash, mock_redirect, mock_celery_task, mock_queue_push, app):
     """ Testing the update schedule event function with wrong user. """
     with app.test_request_context('/'):
         current_user = User.query.filter_by(username='ivan').first()
@@ -436,11 +437,11 @@ def test_schedule_update_event_past(mock_flash, mock_redirect, mock_celery_task,
         mock_flash.assert_called_with('You cannot edit past events', category='toast-error')
         assert mock_redirect.called
         assert not mock_celery_task.start_schedule_notification_task.called
-        assert mock_send_push.call_count == 0
+        assert mock_queue_push.call_count == 0
 
 
-@patch('app.functions.send_push_to_user')
-def test_schedule_delete_event(mock_send_push, app):
+@patch('app.functions.queue_push_to_user')
+def test_schedule_delete_event(mock_queue_push, app):
     """ Testing the delete schedule event function in normal conditions. """
     with app.test_request_context('/'):
         current_user = User.query.filter_by(username='ivan').first()
@@ -459,13 +460,13 @@ def test_schedule_delete_event(mock_send_push, app):
             assert mock_notification_task.terminate.called
 
         assert ScheduleEvent.query.filter_by(id=event.id).first() is None
-        assert mock_send_push.call_count == 1
+        assert mock_queue_push.call_count == 1
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.redirect')
 @patch('app.functions.flash')
-def test_schedule_delete_event_invalid_id(mock_flash, mock_redirect, mock_send_push, app):
+def test_schedule_delete_event_invalid_id(mock_flash, mock_redirect, mock_queue_push, app):
     """ Testing the delete schedule event function with invalid event id. """
     with app.test_request_context('/'):
         current_user = User.query.filter_by(username='ivan').first()
@@ -477,13 +478,13 @@ def test_schedule_delete_event_invalid_id(mock_flash, mock_redirect, mock_send_p
         assert ScheduleEvent.query.filter_by(id=event_id).first() is None
         mock_flash.assert_called_with('Event not found', category='toast-error')
         assert mock_redirect.called
-        assert mock_send_push.call_count == 0
+        assert mock_queue_push.call_count == 0
 
 
-@patch('app.functions.send_push_to_user')
+@patch('app.functions.queue_push_to_user')
 @patch('app.functions.redirect')
 @patch('app.functions.flash')
-def test_schedule_delete_event_wrong_user(mock_flash, mock_redirect, mock_send_push, app):
+def test_schedule_delete_event_wrong_user(mock_flash, mock_redirect, mock_queue_push, app):
     """ Testing the delete schedule event function in normal conditions. """
     with app.test_request_context('/'):
         current_user = User.query.filter_by(username='ivan').first()
@@ -505,7 +506,7 @@ def test_schedule_delete_event_wrong_user(mock_flash, mock_redirect, mock_send_p
         assert ScheduleEvent.query.filter_by(id=event.id).first() is not None
         mock_flash.assert_called_with('You can only delete your own events', category='toast-error')
         assert mock_redirect.called
-        assert mock_send_push.call_count == 0
+        assert mock_queue_push.call_count == 0
 
 
 @patch('app.functions.flash')
@@ -611,3 +612,167 @@ def test_mark_cycle_paid_split_not_accepted(mock_flash, app):
         mark_cycle_paid(current_user, cycle_id)
 
         mock_flash.assert_called_with(f'Cycle #{cycle_id} not found', category='toast-error')
+
+
+SHELLY_DEVICE_STATUS = {'data': {'device_status': {
+    'meters': [{'total': 120000, 'power': 1850.5}],
+    'relays': [{'ison': True}],
+    'temperature': 41.2,
+    'wifi_sta': {'rssi': -61}
+}}}
+
+
+@patch('app.shelly.fetch_device_status')
+def test_shelly_getters_share_snapshot(mock_fetch_device_status, app):
+    """ Testing that all Shelly telemetry getters are served from a single device status request. """
+    with app.test_request_context():
+        mock_fetch_device_status.return_value = SHELLY_DEVICE_STATUS
+        device_status_cache.invalidate()
+
+        assert get_energy_consumption() == 2
+        assert get_realtime_current_usage() == 1850.5
+        assert get_relays_state() is True
+        assert get_relay_temperature() == 41.2
+        assert get_relay_wifi_rssi() == -61
+        washer_info = get_washer_info()
+        assert washer_info['current_usage'] == 1850.5
+        assert washer_info['relay_wifi_rssi'] == -61
+
+        assert mock_fetch_device_status.call_count == 1
+
+
+@patch('app.shelly.fetch_device_status')
+def test_shelly_concurrent_callers_wait_for_fetch(mock_fetch_device_status, app):
+    """ Testing that concurrent callers wait on the in-flight Shelly request instead of starting new ones. """
+    import threading
+    from app.shelly import ShellyStatusCache
+
+    release = threading.Event()
+
+    def slow_fetch():
+        release.wait(5)
+        return SHELLY_DEVICE_STATUS
+
+    mock_fetch_device_status.side_effect = slow_fetch
+    cache = ShellyStatusCache()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get().power)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [1850.5] * 5
+    assert mock_fetch_device_status.call_count == 1
+
+
+@patch('app.shelly.fetch_device_status')
+def test_shelly_invalidate_discards_in_flight_fetch(mock_fetch_device_status, app):
+    """ Testing that a Shelly request which was in flight when the cache was invalidated is not cached. """
+    import threading
+    from app.shelly import ShellyStatusCache
+
+    started, release = threading.Event(), threading.Event()
+    stale_status = {'data': {'device_status': {**SHELLY_DEVICE_STATUS['data']['device_status'],
+                                               'relays': [{'ison': False}]}}}
+
+    def slow_fetch():
+        started.set()
+        release.wait(5)
+        return stale_status
+
+    mock_fetch_device_status.side_effect = slow_fetch
+    cache = ShellyStatusCache()
+    thread = threading.Thread(target=cache.get)
+    thread.start()
+    started.wait(5)
+    cache.invalidate()
+    release.set()
+    thread.join()
+
+    mock_fetch_device_status.side_effect = None
+    mock_fetch_device_status.return_value = SHELLY_DEVICE_STATUS
+    assert cache.get().relay_ison is True
+    assert mock_fetch_device_status.call_count == 2
+
+
+def test_recalculate_cycles_cost_in_chunks(app):
+    """ Testing that unpaid finished cycles are repriced in keyset chunks with progress on the task. """
+    with app.app_context():
+        now = datetime.datetime.now()
+        for i in range(5):
+            db.session.add(WashingCycle(user_id=1, startkwh=0, endkwh=i + 1, cost=0, start_timestamp=now,
+                                        end_timestamp=now, paid=False))
+        db.session.add(WashingCycle(user_id=1, startkwh=0, endkwh=1, cost=0, start_timestamp=now,
+                                    end_timestamp=now, paid=True))
+        db.session.add(WashingCycle(user_id=1, startkwh=0, endkwh=None, cost=None, start_timestamp=now))
+        task = CeleryTask(id='recalculate', kind=CeleryTask.TaskKinds.RECALCULATE_CYCLES_COST, payload={})
+        db.session.add(task)
+        db.session.commit()
+
+        assert recalculate_cycles_cost(task, chunk_size=2) == 5
+
+        costs = [float(cycle.cost) for cycle in WashingCycle.query.filter_by(paid=False).order_by(WashingCycle.id)
+                 if cycle.end_timestamp is not None]
+        assert costs == [0.2, 0.4, 0.6, 0.8, 1.0]
+        assert float(WashingCycle.query.filter_by(paid=True).first().cost) == 0
+        assert task.payload['rows_total'] == 5
+        assert task.payload['rows_updated'] == 5
+
+
+def test_usage_page_query_count(app, client):
+    """ Testing that the usage page runs the same number of queries for any number of listed cycles. """
+    from sqlalchemy import event
+    from tests.test_auth import login
+
+    with app.app_context():
+        now = datetime.datetime.now()
+        for i in range(30):
+            cycle = WashingCycle(user_id=2 if i % 3 else 1, startkwh=0, endkwh=1, cost=0.20, paid=False,
+                                 start_timestamp=now - datetime.timedelta(hours=i + 1),
+                                 end_timestamp=now - datetime.timedelta(hours=i))
+            db.session.add(cycle)
+            db.session.flush()
+            if i % 3:
+                db.session.add(WashingCycleSplit(cycle_id=cycle.id, user_id=1))
+        db.session.commit()
+    login(client, app, 'ivan', 'password')
+    # Warm up the machine configuration cache
+    client.get('/usage')
+
+    query_counts = {}
+    for items in ('10', 'all'):
+        statements = []
+        with app.app_context():
+            listener = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            response = client.get(f'/usage?items={items}')
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        assert response.status_code == 200
+        query_counts[items] = len(statements)
+
+    assert query_counts['10'] == query_counts['all']
+
+
+def test_split_shares_loaded_on_demand(app):
+    """ Testing that loading cycles skips the split subqueries unless the listing asks for the split costs. """
+    with app.app_context():
+        cycle = WashingCycle(user_id=2, startkwh=0, endkwh=1, cost=0.25, paid=False,
+                             start_timestamp=datetime.datetime(2024, 3, 1, 10),
+                             end_timestamp=datetime.datetime(2024, 3, 1, 11))
+        db.session.add(cycle)
+        db.session.flush()
+        db.session.add(WashingCycleSplit(cycle_id=cycle.id, user_id=1))
+        cycle_id = cycle.id
+        db.session.commit()
+        db.session.expunge_all()
+
+        with count_queries() as statements:
+            WashingCycle.query.filter_by(id=cycle_id).first()
+        assert 'split_cycles' not in statements[0]
+
+        unpaid_cycles = get_unpaid_list(db.session.get(User, 1))
+        with count_queries() as statements:
+            assert [str(cycle.split_cost) for cycle in unpaid_cycles] == ['0.13']
+        assert statements == []
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.db import db
+from app.models import WashingCycle, WashingCycleSplit, ScheduleEvent, CeleryTask, PushSubscription, WashingCyclePayment
+from app.statistics import in_months
+
+POSTGRES_URL = os.getenv('TEST_POSTGRES_URL')
+
+
+def indexed_queries() -> list[tuple]:
+    """ The hot filters of the statistics, ledger, schedule, tasks and listings with the index each should use. """
+    return [
+        (db.select(WashingCycle.id).where(in_months(WashingCycle.end_timestamp, [(2024, 3)])),
+         'ix_washing_cycles_end_timestamp'),
+        (db.select(WashingCycle.id).where(WashingCycle.user_id == 1, WashingCycle.paid.is_(False),
+                                          WashingCycle.end_timestamp.is_not(None)),
+         'ix_washing_cycles_user_id_paid_end_timestamp'),
+        (db.select(WashingCycleSplit.cycle_id).where(WashingCycleSplit.user_id == 1,
+                                                     WashingCycleSplit.paid.is_(False)),
+         'ix_split_cycles_user_id_paid'),
+        (db.select(ScheduleEvent.id).where(in_months(ScheduleEvent.start_timestamp, [(2024, 3)])),
+         'ix_schedule_start_timestamp_end_timestamp'),
+        (db.select(CeleryTask.id).where(CeleryTask.kind == CeleryTask.TaskKinds.CYCLE_NOTIFICATION,
+                                        CeleryTask.ref_id == 1),
+         'ix_tasks_kind_ref_id'),
+        (db.select(PushSubscription.id).where(PushSubscription.user_id == 1),
+         'ix_push_subscription_user_id'),
+        (db.select(PushSubscription.id).where(PushSubscription.endpoint_digest == '0' * 64),
+         'uq_push_subscription_endpoint_digest'),
+        (db.select(WashingCycle.id)
+         .where(db.tuple_(WashingCycle.start_timestamp, WashingCycle.id) < db.tuple_('2024-03-01', 100))
+         .order_by(WashingCycle.start_timestamp.desc(), WashingCycle.id.desc()).limit(100),
+         'ix_washing_cycles_start_timestamp_id'),
+        (db.select(WashingCyclePayment.id).where(WashingCyclePayment.propagated.is_(False))
+         .order_by(WashingCyclePayment.timestamp.desc(), WashingCyclePayment.id.desc()).limit(50),
+         'ix_payments_propagated_timestamp_id'),
+    ]
+
+
+def compile_query(query, dialect) -> str:
+    return str(query.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+
+@pytest.mark.parametrize('query, index', indexed_queries())
+def test_sqlite_query_uses_index(app, query, index):
+    """ Testing that SQLite plans the filters as index searches. """
+    with app.app_context():
+        plan = db.session.execute(text(f'EXPLAIN QUERY PLAN {compile_query(query, sqlite.dialect())}')).all()
+
+    assert any(index in row[-1] for row in plan), plan
+
+
+@pytest.mark.skipif(POSTGRES_URL is None, reason='TEST_POSTGRES_URL is not set')
+@pytest.mark.parametrize('query, index', indexed_queries())
+def test_postgres_query_uses_index(app, query, index):
+    """ Testing that Postgres plans the filters as index scans, with sequential scans discouraged on the tiny tables. """
+    engine = create_engine(POSTGRES_URL)
+    with app.app_context():
+        db.metadata.create_all(engine)
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SET enable_seqscan = off'))
+            plan = connection.execute(text(f'EXPLAIN {compile_query(query, postgresql.dialect())}')).scalars().all()
+    finally:
+        with app.app_context():
+            db.metadata.drop_all(engine)
+        engine.dispose()
+
+    assert any(index in line for line in plan), plan
@@ -0,0 +1,145 @@
+import decimal
+import datetime
+from unittest.mock import patch
+
+import pytest
+
+from app.db import db
+from app.models import User, UserBalance, WashingCycle, WashingCycleSplit, WashingCyclePayment, CeleryTask
+from app.forms import SplitCycleForm
+from app.functions import split_cycle, mark_cycle_paid, mark_cycles_paid, stop_cycle
+from app.ledger import refresh_balances, diff_balances
+from app.statistics import calculate_unpaid_cycles_cost
+from tests.test_auth import login
+
+
+def add_finished_cycle(user_id: int, cost: float) -> WashingCycle:
+    cycle = WashingCycle(user_id=user_id, startkwh=0, endkwh=cost * 5, cost=cost,
+                         start_timestamp=datetime.datetime.now() - datetime.timedelta(hours=2),
+                         end_timestamp=datetime.datetime.now(), paid=False)
+    db.session.add(cycle)
+    refresh_balances({user_id})
+    db.session.commit()
+    return cycle
+
+
+@patch('app.functions.queue_push_to_user')
+@patch('app.functions.flash')
+def test_ledger_follows_splits_and_payments(mock_flash, mock_queue_push, app):
+    """ Testing that the balances are updated when a cycle is split and marked as paid. """
+    with app.test_request_context():
+        ivan = db.session.get(User, 1)
+        andrei = db.session.get(User, 2)
+        cycle = add_finished_cycle(ivan.id, 1.01)
+        assert calculate_unpaid_cycles_cost(ivan) == decimal.Decimal('1.01')
+
+        split_form = SplitCycleForm()
+        split_form.cycle_id.data = cycle.id
+        split_form.other_users.data = [andrei.id]
+        split_cycle(ivan, split_form)
+
+        assert calculate_unpaid_cycles_cost(ivan) == decimal.Decimal('0.51')
+        assert calculate_unpaid_cycles_cost(andrei) == decimal.Decimal('0.51')
+
+        WashingCycleSplit.query.filter_by(cycle_id=cycle.id, user_id=andrei.id).first().accepted = True
+        db.session.commit()
+        assert mark_cycle_paid(andrei, cycle.id, mass_marking=True)
+
+        assert calculate_unpaid_cycles_cost(andrei) == 0
+        assert db.session.get(UserBalance, andrei.id).unpaid_cycles == 0
+        assert calculate_unpaid_cycles_cost(ivan) == decimal.Decimal('0.51')
+        assert diff_balances() == {}
+
+
+def test_ledger_verify_command(app, runner):
+    """ Testing that the verify command reports and fixes a drifted ledger. """
+    with app.app_context():
+        add_finished_cycle(1, 0.40)
+        db.session.get(UserBalance, 1).unpaid_cost = 5
+        db.session.commit()
+
+    result = runner.invoke(args=['ledger', 'verify'])
+    assert result.exit_code == 1
+    assert 'User 1: ledger 5.00, expected 0.40' in result.output
+
+    result = runner.invoke(args=['ledger', 'verify', '--fix'])
+    assert 'Ledger rebuilt, 1 balances fixed.' in result.output
+
+    result = runner.invoke(args=['ledger', 'verify'])
+    assert result.exit_code == 0
+    assert 'Ledger is consistent.' in result.output
+
+
+@patch('app.functions.queue_push_to_user')
+def test_mark_cycles_paid_in_one_transaction(mock_queue_push, app):
+    """ Testing that a batch of cycles and split shares is paid with one commit and one payment record. """
+    with app.test_request_context():
+        ivan = db.session.get(User, 1)
+        own_cycle = add_finished_cycle(ivan.id, 0.40)
+        paid_cycle = add_finished_cycle(ivan.id, 0.30)
+        paid_cycle.paid = True
+        split_cycle_paid = add_finished_cycle(2, 1.01)
+        pending_cycle = add_finished_cycle(2, 0.50)
+        other_cycle = add_finished_cycle(3, 0.60)
+        db.session.add_all([
+            WashingCycleSplit(cycle_id=split_cycle_paid.id, user_id=ivan.id, accepted=True),
+            WashingCycleSplit(cycle_id=pending_cycle.id, user_id=ivan.id, accepted=False)
+        ])
+        refresh_balances({1, 2})
+        db.session.commit()
+        cycle_ids = [own_cycle.id, paid_cycle.id, split_cycle_paid.id, pending_cycle.id, other_cycle.id, 999]
+
+        with patch.object(db.session, 'commit', wraps=db.session.commit) as mock_commit:
+            payment = mark_cycles_paid(db.session.get(User, 1), cycle_ids)
+
+        assert mock_commit.call_count == 1
+        assert list(payment.outcomes.values()) == [
+            'paid', 'already_paid', 'paid', 'split_pending', 'not_owner', 'not_found'
+        ]
+        assert payment.amount == decimal.Decimal('0.91')
+        assert [(record.user_id, record.amount) for record in WashingCyclePayment.query.all()] == \
+            [(1, decimal.Decimal('0.91'))]
+        assert WashingCycleSplit.query.filter_by(cycle_id=split_cycle_paid.id, user_id=1).first().paid
+        assert db.session.get(WashingCycle, own_cycle.id).paid
+        assert calculate_unpaid_cycles_cost(db.session.get(User, 1)) == decimal.Decimal('0.25')
+        assert diff_balances() == {}
+        assert mock_queue_push.called
+
+
+@patch('app.functions.queue_push_to_user')
+def test_mark_paid_api(mock_queue_push, app, client):
+    """ Testing the JSON batch payment endpoint. """
+    with app.app_context():
+        cycle_id = add_finished_cycle(1, 0.40).id
+    login(client, app, 'ivan', 'password')
+
+    response = client.post('/api/mark_paid', json={'cycle_ids': [cycle_id, cycle_id]})
+
+    assert response.get_json() == {'outcomes': [{'cycle_id': cycle_id, 'outcome': 'paid'}], 'amount': '0.40'}
+    assert client.post('/api/mark_paid', json={'cycle_ids': [cycle_id]}).get_json()['amount'] == '0.00'
+    assert client.post('/api/mark_paid', json={'cycle_ids': 'all'}).status_code == 400
+
+
+@patch('app.functions.refresh_balances', side_effect=RuntimeError('Ledger unavailable'))
+@patch('app.functions.update_energy_consumption', return_value=14)
+@patch('app.functions.trigger_relay', return_value=200)
+@patch('app.functions.flash')
+def test_stop_cycle_is_atomic_with_ledger(mock_flash, mock_trigger_relay, mock_update_consumption,
+                                          mock_refresh_balances, app):
+    """ Testing that a cycle is not ended, nor its tasks cancelled, if its ledger cannot be updated. """
+    with app.test_request_context():
+        ivan = db.session.get(User, 1)
+        cycle = WashingCycle(user_id=ivan.id, startkwh=12, start_timestamp=datetime.datetime.now())
+        db.session.add(cycle)
+        db.session.commit()
+        task = CeleryTask(id='cycle-task', kind=CeleryTask.TaskKinds.CYCLE_NOTIFICATION, ref_id=cycle.id,
+                          user_id=ivan.id)
+        db.session.add(task)
+        db.session.commit()
+        cycle_id = cycle.id
+
+        with pytest.raises(ChildProcessError):
+            stop_cycle(ivan)
+
+        assert db.session.get(WashingCycle, cycle_id).end_timestamp is None
+        assert db.session.get(CeleryTask, 'cycle-task') is not None
@@ -0,0 +1,170 @@
+import decimal
+import datetime
+from unittest.mock import patch, MagicMock
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from app.db import db
+from app.models import User, WashingMachine, WashingCycle, CandySnapshot
+from app.candy import CandyWashingMachine, CandyMachineState, get_last_machine_state
+from app.machine import get_machine_config, get_machine_config_cache, get_active_cycle, MACHINE_CONFIG_CHANNEL
+from app.functions import update_cycle, get_remaining_minutes
+from app.views import handle_cycle_buttons
+from tests.conftest import count_queries
+
+
+def test_machine_config_is_cached(app):
+    """ Testing that the configuration is read once and the per-request shutdown check takes no queries. """
+    with app.app_context():
+        config = get_machine_config()
+        assert config.costperkwh == decimal.Decimal('0.20')
+        assert not config.global_shutdown
+
+    with app.test_request_context('/'):
+        with count_queries() as statements:
+            assert handle_cycle_buttons() is None
+        assert statements == []
+
+
+def test_machine_config_invalidation(app):
+    """ Testing that committing a configuration change is broadcast, while other machine writes are not. """
+    redis_client = MagicMock()
+    with app.app_context(), patch.object(get_machine_config_cache(), '_redis', return_value=redis_client):
+        get_machine_config()
+
+        db.session.execute(db.update(WashingMachine).values(currentkwh=42))
+        db.session.get(WashingMachine, 1).notes = 'Clean the filter'
+        db.session.commit()
+        assert not redis_client.publish.called
+
+        db.session.get(WashingMachine, 1).global_shutdown = True
+        db.session.commit()
+        redis_client.publish.assert_called_once_with(MACHINE_CONFIG_CHANNEL, 'invalidate')
+        assert get_machine_config().global_shutdown
+
+
+def test_machine_config_bulk_update_invalidation(app):
+    """ Testing that bulk updates of the configuration are broadcast, while bulk updates of other columns are not. """
+    redis_client = MagicMock()
+    with app.app_context(), patch.object(get_machine_config_cache(), '_redis', return_value=redis_client):
+        get_machine_config()
+
+        db.session.execute(db.update(WashingMachine), [{'id': 1, 'currentkwh': 43}])
+        db.session.commit()
+        assert not redis_client.publish.called
+
+        db.session.execute(db.update(WashingMachine).values(global_shutdown=True))
+        db.session.commit()
+        assert get_machine_config().global_shutdown
+
+        WashingMachine.query.update({WashingMachine.require_scheduling: True})
+        db.session.commit()
+        assert get_machine_config().require_scheduling
+
+        db.session.execute(db.update(WashingMachine), [{'id': 1, 'global_shutdown': False}])
+        db.session.commit()
+        assert not get_machine_config().global_shutdown
+        assert redis_client.publish.call_count == 3
+
+
+def test_machine_config_message_from_other_process(app):
+    """ Testing that an invalidation message drops the cached configuration. """
+    with app.app_context():
+        cache = get_machine_config_cache()
+        get_machine_config()
+        with db.engine.begin() as connection:
+            connection.execute(db.update(WashingMachine).values(require_scheduling=True))
+
+        cache.handle_message({'type': 'message', 'channel': MACHINE_CONFIG_CHANNEL, 'data': b'invalidate'})
+
+        assert get_machine_config().require_scheduling
+
+
+def test_single_running_cycle(app):
+    """ Testing that the database rejects a second running cycle. """
+    with app.app_context():
+        db.session.add(WashingCycle(user_id=1, startkwh=0, start_timestamp=datetime.datetime.now()))
+        db.session.commit()
+
+        db.session.add(WashingCycle(user_id=2, startkwh=0, start_timestamp=datetime.datetime.now()))
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+        # Finished cycles are not limited
+        db.session.add(WashingCycle(user_id=2, startkwh=0, endkwh=1, cost=0.20, start_timestamp=datetime.datetime.now(),
+                                    end_timestamp=datetime.datetime.now()))
+        db.session.commit()
+
+
+def test_active_cycle_is_cached(app):
+    """ Testing that the running cycle is read from the cache until a cycle is started or stopped. """
+    with app.app_context():
+        ivan = db.session.get(User, 1)
+        andrei = db.session.get(User, 2)
+        assert update_cycle(ivan) == {'state': 'available', 'id': None}
+
+        cycle = WashingCycle(user_id=andrei.id, startkwh=0, start_timestamp=datetime.datetime.now())
+        db.session.add(cycle)
+        db.session.commit()
+        assert get_active_cycle().id == cycle.id
+        # Reload the users expired by the commit
+        db.session.refresh(ivan)
+        db.session.refresh(andrei)
+
+        with count_queries() as statements:
+            assert update_cycle(ivan) == {'state': 'unavailable', 'id': None, 'user': 'Andrei'}
+            assert update_cycle(andrei) == {'state': 'running', 'id': cycle.id}
+        assert statements == []
+
+        cycle.endkwh = 1
+        cycle.end_timestamp = datetime.datetime.now()
+        db.session.commit()
+        assert get_active_cycle() is None
+
+
+def appliance_data(remaining_seconds: int) -> dict:
+    return {'appliance': {'current_status': 'ok', 'current_status_parameters': {
+        'MachMd': '2', 'PrPh': '2', 'Pr': '5', 'Temp': '40', 'SpinSp': '8', 'RemTime': str(remaining_seconds),
+        'WiFiStatus': '1'
+    }}}
+
+
+@patch.object(CandyWashingMachine, '_instance_initialized', None)
+@patch.object(CandyWashingMachine, '_instance', None)
+@patch('app.candy.fetch_appliance_data')
+def test_candy_snapshot_written_on_change(mock_fetch_appliance_data, app):
+    """ Testing that the Candy snapshot is stored only when the reported state changes. """
+    with app.app_context():
+        mock_fetch_appliance_data.return_value = appliance_data(1800)
+        machine = CandyWashingMachine()
+        assert get_remaining_minutes() == 30
+        assert get_last_machine_state() == CandyMachineState.RUNNING
+
+        machine.last_updated = None
+        with count_queries() as statements:
+            machine.update()
+        assert statements == []
+
+        mock_fetch_appliance_data.return_value = appliance_data(1200)
+        machine.last_updated = None
+        machine.update()
+        assert get_remaining_minutes() == 20
+        assert 'last_updated' not in db.session.get(CandySnapshot, 1).data
+
+
+def test_machine_config_reloaded_after_resubscribing(app):
+    """ Testing that the cached configuration is dropped when the invalidation listener has to subscribe again. """
+    redis_client = MagicMock()
+    with app.app_context(), patch.object(get_machine_config_cache(), '_redis', return_value=redis_client):
+        assert not get_machine_config().global_shutdown
+        listener = redis_client.pubsub.return_value.run_in_thread.return_value
+
+        # The listener dies and misses the invalidation of this change
+        listener.is_alive.return_value = False
+        with db.engine.begin() as connection:
+            connection.execute(db.update(WashingMachine).values(global_shutdown=True))
+
+        assert get_machine_config().global_shutdown
+        assert redis_client.pubsub.return_value.run_in_thread.call_count == 2
@@ -0,0 +1,116 @@
+import os
+import time
+import decimal
+import datetime
+
+import pytest
+
+from app.db import db
+from app.models import User, WashingCycle, WashingCycleSplit, WashingCyclePayment
+from app.functions import get_usage_page, get_cycles_page, get_payments_page
+from app.pagination import encode_cursor, decode_cursor
+from tests.test_auth import login
+from tests.conftest import count_queries, add_cycles
+
+
+def test_cursor_round_trip():
+    """ Testing that cursors decode to the encoded sort key and malformed ones are rejected. """
+    timestamp = datetime.datetime(2024, 3, 1, 12, 30, tzinfo=datetime.timezone.utc)
+    assert decode_cursor(encode_cursor(timestamp, 42)) == (timestamp, 42)
+    for cursor in ('', 'not a cursor', encode_cursor(timestamp, 42)[:-3]):
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
+
+
+def test_usage_pages(app):
+    """ Testing that walking the pages lists every cycle of the user once, including ties and split cycles. """
+    with app.app_context():
+        add_cycles(25)
+        add_cycles(5, user_id=2)
+        split_cycle = WashingCycle.query.filter_by(user_id=2).first()
+        db.session.add(WashingCycleSplit(cycle_id=split_cycle.id, user_id=1))
+        db.session.commit()
+        user = db.session.get(User, 1)
+
+        seen, cursor = [], None
+        while True:
+            page = get_usage_page(user, limit=10, cursor=cursor)
+            seen.extend(row.id for row in page.items)
+            if not (cursor := page.next_cursor):
+                break
+
+        assert len(seen) == len(set(seen)) == 26
+        assert split_cycle.id in seen
+        split_row = next(row for row in get_usage_page(user, limit=None).items if row.id == split_cycle.id)
+        assert split_row.split_accepted is False and split_row.share_cents == 10
+
+
+def test_payments_page(app):
+    """ Testing that the payouts list only the payments which are not propagated. """
+    with app.app_context():
+        db.session.add_all([
+            WashingCyclePayment(user_id=1, amount=decimal.Decimal('1.20'), propagated=False),
+            WashingCyclePayment(user_id=3, amount=decimal.Decimal('0.50'), propagated=True)
+        ])
+        db.session.commit()
+
+        page = get_payments_page()
+
+        assert [(row.username, row.amount) for row in page.items] == [('ivan', decimal.Decimal('1.20'))]
+        assert page.next_cursor is None
+
+
+def test_cycles_api(app, client):
+    """ Testing the JSON listing of all cycles for the admin. """
+    with app.app_context():
+        add_cycles(3)
+    login(client, app, 'georgi', 'password')
+
+    first = client.get('/api/cycles?limit=2').get_json()
+    second = client.get(f'/api/cycles?limit=2&cursor={first["next_cursor"]}').get_json()
+
+    # Cycles started at the same time are ordered by their id
+    assert [row['id'] for row in first['items']] == [2, 1]
+    assert first['items'][0]['username'] == 'ivan' and first['items'][0]['cost'] == '0.20'
+    assert [row['id'] for row in second['items']] == [3] and second['next_cursor'] is None
+    assert client.get('/api/cycles?cursor=invalid').status_code == 400
+    assert client.get('/admin/cycles').status_code == 200
+
+
+def test_usage_view_page_size(app, client):
+    """ Testing that the usage view falls back to 10 cycles for a page size which is not one of the choices. """
+    with app.app_context():
+        add_cycles(12)
+    login(client, app, 'ivan', 'password')
+
+    def rows(items):
+        response = client.get(f'/usage?items={items}')
+        assert response.status_code == 200
+        return response.get_data(as_text=True).count('<tr')
+
+    assert rows('all') == rows('10') + 2
+    for items in ('abc', '0', '-5', '7'):
+        assert rows(items) == rows('10')
+
+
+@pytest.mark.skipif(not os.getenv('RUN_BENCHMARKS'), reason='RUN_BENCHMARKS is not set')
+def test_cycles_page_benchmark(app):
+    """ Benchmark showing that a page deep into 100k cycles takes as long as the first one. """
+    with app.app_context():
+        add_cycles(100_000)
+
+        def timed_page(cursor=None):
+            started = time.perf_counter()
+            with count_queries() as statements:
+                page = get_cycles_page(cursor=cursor)
+            return page, time.perf_counter() - started, len(statements)
+
+        first_page, first_time, first_queries = timed_page()
+        last_cycle = db.session.query(WashingCycle.start_timestamp, WashingCycle.id) \
+            .order_by(WashingCycle.start_timestamp, WashingCycle.id).offset(150).first()
+        deep_page, deep_time, deep_queries = timed_page(encode_cursor(*last_cycle))
+
+        print(f'First page: {first_time * 1000:.1f} ms, page near the end: {deep_time * 1000:.1f} ms')
+        assert len(first_page.items) == len(deep_page.items) == 100
+        assert first_queries == deep_queries == 1
+        assert deep_time < max(first_time * 5, 0.05)
@@ -0,0 +1,169 @@
+import json
+import datetime
+import threading
+from unittest.mock import patch, MagicMock
+
+from kombu.exceptions import OperationalError
+from pywebpush import WebPushException
+
+from app.db import db
+from app.models import PushSubscription, PushOutbox, Notification, WashingCycle
+from app.functions import send_push_to_all
+from app import push
+from app.push import send_push, queue_push, dispatch_push_outbox, register_push_subscription, endpoint_digest
+from tests.test_auth import login
+
+PRIVATE_KEY = 'NNxeRtRiQ_CcyPmIntk2QbQ7Apnav8JbYPq3R7xrMrw'
+
+
+def add_subscription(user_id: int, endpoint: str) -> int:
+    register_push_subscription(json.dumps({'endpoint': endpoint, 'keys': {'p256dh': 'key', 'auth': 'auth'}}), user_id)
+    db.session.commit()
+    return db.session.query(PushSubscription.id).filter_by(endpoint_digest=endpoint_digest(endpoint)).scalar()
+
+
+@patch('app.push.webpush')
+def test_send_push_concurrently_and_prune(mock_webpush, app):
+    """ Testing that the pushes are sent concurrently and the subscriptions gone from the push service are deleted. """
+    barrier = threading.Barrier(3, timeout=5)
+    sessions = {}
+
+    def webpush(subscription_info, requests_session, **kwargs):
+        endpoint = subscription_info['endpoint']
+        sessions[endpoint] = requests_session
+        # All three pushes have to be in flight at the same time to pass the barrier
+        barrier.wait()
+        if endpoint.endswith('gone'):
+            raise WebPushException('Push failed: 410 Gone', response=MagicMock(status_code=410))
+        if endpoint.endswith('error'):
+            raise WebPushException('Push failed: 500', response=MagicMock(status_code=500))
+        return MagicMock(ok=True)
+
+    mock_webpush.side_effect = webpush
+    app.config.update(PUSH_PRIVATE_KEY=PRIVATE_KEY, PUSH_CLAIM_EMAIL='admin@example.com')
+    with app.app_context():
+        sent_id = add_subscription(1, 'https://fcm.googleapis.com/fcm/send/sent')
+        gone_id = add_subscription(2, 'https://fcm.googleapis.com/fcm/send/gone')
+        error_id = add_subscription(3, 'https://updates.push.services.mozilla.com/wpush/v2/error')
+
+        results = send_push_to_all(Notification(title='Test', body='Test', icon='icon.png'))
+
+        assert results == [True, False, False]
+        assert {subscription_id for subscription_id, in db.session.query(PushSubscription.id)} == {sent_id, error_id}
+        db.session.expire_all()
+        sent, error = db.session.get(PushSubscription, sent_id), db.session.get(PushSubscription, error_id)
+        assert sent.last_success_at is not None and sent.failure_count == 0
+        assert error.last_success_at is None and error.failure_count == 1
+        assert mock_webpush.call_args.kwargs['data'] == json.dumps(
+            {'title': 'Test', 'body': 'Test', 'icon': 'icon.png', 'url': '/'}
+        )
+
+    # The connections are pooled per push service origin
+    assert sessions['https://fcm.googleapis.com/fcm/send/sent'] is sessions['https://fcm.googleapis.com/fcm/send/gone']
+    assert sessions['https://fcm.googleapis.com/fcm/send/sent'] is not \
+        sessions['https://updates.push.services.mozilla.com/wpush/v2/error']
+
+
+@patch('app.push.webpush')
+def test_push_outbox(mock_webpush, app):
+    """ Testing that queued notifications are kept only if committed and are retried while the push service fails. """
+    app.config.update(PUSH_PRIVATE_KEY=PRIVATE_KEY, PUSH_CLAIM_EMAIL='admin@example.com')
+    with app.app_context():
+        add_subscription(1, 'https://fcm.googleapis.com/fcm/send/ivan')
+        add_subscription(2, 'https://fcm.googleapis.com/fcm/send/andrei')
+
+        queue_push(Notification(title='Rolled back', body='Test', icon='icon.png'), 1)
+        db.session.rollback()
+        queue_push(Notification(title='Ivan', body='Test', icon='icon.png'), 1)
+        queue_push(Notification(title='Everyone', body='Test', icon='icon.png'))
+        db.session.commit()
+        assert PushOutbox.query.count() == 2
+
+        mock_webpush.side_effect = WebPushException('Push failed: 503', response=MagicMock(status_code=503))
+        assert dispatch_push_outbox() == 2
+        assert [message.attempts for message in PushOutbox.query.order_by(PushOutbox.id)] == [1, 1]
+        # The retries are not due yet
+        assert dispatch_push_outbox() == 0
+
+        db.session.execute(db.update(PushOutbox).values(next_attempt_at=datetime.datetime(2024, 1, 1)))
+        db.session.commit()
+        mock_webpush.reset_mock(side_effect=True)
+        assert dispatch_push_outbox() == 2
+
+        assert PushOutbox.query.count() == 0
+        sent = sorted((call.kwargs['subscription_info']['endpoint'].rsplit('/', 1)[-1],
+                       json.loads(call.kwargs['data'])['title']) for call in mock_webpush.call_args_list)
+        assert sent == [('andrei', 'Everyone'), ('ivan', 'Everyone'), ('ivan', 'Ivan')]
+
+
+@patch('app.push.webpush')
+def test_vapid_headers_cached_per_origin(mock_webpush, app):
+    """ Testing that the VAPID key is parsed once and the signed headers are reused for each push service origin. """
+    app.config.update(PUSH_PRIVATE_KEY=PRIVATE_KEY, PUSH_CLAIM_EMAIL='admin@example.com')
+    with app.app_context(), patch.object(push.Vapid, 'from_string', wraps=push.Vapid.from_string) as mock_from_string, \
+            patch.dict(push._vapid_keys, clear=True), patch.dict(push._vapid_headers, clear=True):
+        subscriptions = [db.session.get(PushSubscription, add_subscription(1, endpoint)) for endpoint in (
+            'https://fcm.googleapis.com/fcm/send/first', 'https://fcm.googleapis.com/fcm/send/second',
+            'https://updates.push.services.mozilla.com/wpush/v2/third'
+        )]
+
+        send_push(subscriptions, Notification(title='First', body='Test', icon='icon.png'))
+        send_push(subscriptions, Notification(title='Second', body='Test', icon='icon.png'))
+
+    assert mock_from_string.call_count == 1
+    headers = {call.kwargs['subscription_info']['endpoint']: call.kwargs['headers']['Authorization']
+               for call in mock_webpush.call_args_list}
+    assert len(set(headers.values())) == 2
+    assert headers['https://fcm.googleapis.com/fcm/send/first'] == headers['https://fcm.googleapis.com/fcm/send/second']
+    assert all('vapid_private_key' not in call.kwargs for call in mock_webpush.call_args_list)
+
+
+def test_push_subscription_upsert(app, client):
+    """ Testing that registering an endpoint again updates its subscription instead of adding another one. """
+    login(client, app, 'ivan', 'password')
+    subscription = {'endpoint': 'https://fcm.googleapis.com/fcm/send/device', 'keys': {'p256dh': 'old', 'auth': 'a'}}
+    assert client.post('/api/push_subscriptions', json={
+        'subscription_json': json.dumps(subscription), 'user_id': 1
+    }, headers={'User-Agent': 'Firefox'}).status_code == 200
+
+    # The same endpoint with renewed keys, as the browser may send it after the user logs in as someone else
+    subscription = {'endpoint': 'HTTPS://FCM.googleapis.com/fcm/send/device ', 'keys': {'p256dh': 'new', 'auth': 'a'}}
+    assert client.post('/api/push_subscriptions', json={
+        'subscription_json': json.dumps(subscription), 'user_id': 2
+    }, headers={'User-Agent': 'Chrome'}).status_code == 200
+
+    with app.app_context():
+        subscriptions = PushSubscription.query.all()
+        assert len(subscriptions) == 1
+        assert subscriptions[0].endpoint == 'https://fcm.googleapis.com/fcm/send/device'
+        assert (subscriptions[0].user_id, subscriptions[0].user_agent) == (2, 'Chrome')
+        assert json.loads(subscriptions[0].subscription_json)['keys']['p256dh'] == 'new'
+
+    assert client.post('/api/push_subscriptions', json={
+        'subscription_json': '{"keys": {}}', 'user_id': 1
+    }).status_code == 400
+
+
+@patch('app.tasks.dispatch_push_outbox_task.delay', side_effect=OperationalError('Broker unavailable'))
+def test_queued_push_without_broker(mock_delay, app, client):
+    """ Testing that a handler which queues a push succeeds when the dispatch cannot be started. """
+    with app.app_context():
+        cycle = WashingCycle(user_id=1, startkwh=0, endkwh=2, cost=0.40, paid=False,
+                             start_timestamp=datetime.datetime.now() - datetime.timedelta(hours=2),
+                             end_timestamp=datetime.datetime.now())
+        db.session.add(cycle)
+        db.session.commit()
+        cycle_id = cycle.id
+    login(client, app, 'ivan', 'password')
+
+    app.config['TESTING'] = False
+    try:
+        response = client.post('/api/mark_paid', json={'cycle_ids': [cycle_id]})
+    finally:
+        app.config['TESTING'] = True
+
+    assert response.status_code == 200
+    assert mock_delay.called
+    with app.app_context():
+        assert db.session.get(WashingCycle, cycle_id).paid
+        assert PushOutbox.query.count() == 1
@@ -0,0 +1,267 @@
+import pytest
+import decimal
+import datetime
+
+from app.db import db
+from app.models import User, Role, WashingCycle, WashingCycleSplit, WashingMachine, roles_users
+from app.ledger import refresh_all_balances
+from app.rollups import rebuild_rollups, refresh_rollups, cycle_rollup_keys
+from app.statistics import (calculate_monthly_statistics, calculate_charges, calculate_energy_usage, calculate_savings,
+                            admin_users_usage_statistics, users_unpaid_cycles_cost_statistics,
+                            calculate_unpaid_cycles_cost, calculate_unpaid_cycles_cost_by_user, shift_month,
+                            get_statistics_cache)
+from tests.conftest import count_queries
+
+
+def add_cycle(user_id: int, cost: float, end_timestamp: datetime.datetime, split_user_ids: tuple = ()):
+    cycle = WashingCycle(user_id=user_id, startkwh=0, endkwh=cost * 5, cost=cost,
+                         start_timestamp=end_timestamp - datetime.timedelta(hours=2),
+                         end_timestamp=end_timestamp, paid=False)
+    db.session.add(cycle)
+    db.session.flush()
+    for split_user_id in split_user_ids:
+        db.session.add(WashingCycleSplit(cycle_id=cycle.id, user_id=split_user_id))
+    return cycle
+
+
+def test_monthly_statistics(app):
+    """ Testing that the monthly statistics sum the user shares of cycles by month. """
+    with app.app_context():
+        add_cycle(1, 0.46, datetime.datetime(2024, 3, 10))
+        add_cycle(1, 1.00, datetime.datetime(2024, 3, 31, 23, 59), split_user_ids=(2, 3))
+        add_cycle(2, 0.50, datetime.datetime(2024, 1, 5), split_user_ids=(1,))
+        add_cycle(2, 0.80, datetime.datetime(2024, 2, 5))
+        add_cycle(1, 9.99, datetime.datetime(2024, 4, 1))
+        add_cycle(1, 9.99, datetime.datetime(2023, 9, 30))
+        rebuild_rollups()
+        db.session.commit()
+        user = db.session.get(User, 1)
+
+        statistics = calculate_monthly_statistics(user, months=6, end=datetime.date(2024, 3, 15))
+
+        assert statistics == {
+            'labels': ['Oct', 'Nov', 'Dec', 'Jan', 'Feb', 'Mar'],
+            'data': ['0', '0', '0', '0.25', '0', '0.80']
+        }
+
+
+def test_monthly_statistics_date_range(app):
+    """ Testing that the monthly statistics can cover an arbitrary range of months. """
+    with app.app_context():
+        add_cycle(1, 0.46, datetime.datetime(2023, 12, 10))
+        add_cycle(1, 1.00, datetime.datetime(2024, 2, 1))
+        rebuild_rollups()
+        db.session.commit()
+        user = db.session.get(User, 1)
+
+        statistics = calculate_monthly_statistics(user, start=datetime.date(2023, 11, 20),
+                                                  end=datetime.date(2024, 2, 2))
+
+        assert statistics['labels'] == ['Nov', 'Dec', 'Jan', 'Feb']
+        assert statistics['data'] == ['0', '0.46', '0', '1.00']
+        assert calculate_monthly_statistics(user, months=0) == {'labels': [], 'data': []}
+
+
+def test_monthly_statistics_query_count(app):
+    """ Testing that the monthly statistics take a single query regardless of the history. """
+    with app.app_context():
+        for day in range(1, 29):
+            add_cycle(1, 0.50, datetime.datetime(2024, 3, day), split_user_ids=(2,))
+        rebuild_rollups()
+        db.session.commit()
+        user = db.session.get(User, 1)
+
+        with count_queries() as statements:
+            statistics = calculate_monthly_statistics(user, months=24, end=datetime.date(2024, 3, 1))
+
+        assert len(statements) == 1
+        assert statistics['data'][-1] == '7.00'
+
+
+def test_current_month_statistics(app):
+    """ Testing the charges, energy usage and savings of the current month, which are read from the rollups. """
+    with app.app_context():
+        now = datetime.datetime.now()
+        add_cycle(1, 1.00, now)
+        cycle = add_cycle(1, 0.50, now, split_user_ids=(2,))
+        add_cycle(1, 0.20, now)
+        add_cycle(1, 5.00, shift_month(now, -1))
+        refresh_rollups(cycle_rollup_keys(cycle))
+        db.session.commit()
+        user = db.session.get(User, 1)
+
+        with count_queries() as statements:
+            charges = calculate_charges(user)
+            energy_usage = calculate_energy_usage(user)
+        assert len(statements) == 2
+
+        assert charges == decimal.Decimal('1.45')
+        assert energy_usage == decimal.Decimal('7.2500')
+        assert calculate_energy_usage() == decimal.Decimal('8.5000')
+        # Cycles of at least 0.30 are compared with the public wash cost of 10.00
+        assert calculate_savings(user) == decimal.Decimal('18.50')
+        assert calculate_charges(db.session.get(User, 2)) == decimal.Decimal('0.25')
+
+
+def add_users(count: int):
+    """ Adds count active users with a paid, an unpaid and a split cycle each. """
+    now = datetime.datetime.now()
+    first_id = 100
+    db.session.execute(db.insert(User), [
+        {'id': first_id + i, 'email': f'user{i}@test.com', 'username': f'user{i}', 'password': 'x',
+         'first_name': f'User{i}', 'active': True, 'fs_uniquifier': f'uniquifier{i}'}
+        for i in range(count)
+    ])
+    for i in range(count):
+        add_cycle(first_id + i, 0.40, now - datetime.timedelta(days=40))
+        paid_cycle = add_cycle(first_id + i, 0.60, now - datetime.timedelta(days=2))
+        paid_cycle.paid = True
+        add_cycle(1, 1.00, now - datetime.timedelta(days=1), split_user_ids=(first_id + i,))
+    refresh_all_balances()
+    db.session.commit()
+
+
+def test_admin_statistics(app):
+    """ Testing the usage and unpaid cost by user of the admin dashboard. """
+    with app.app_context():
+        add_users(2)
+
+        usage = admin_users_usage_statistics()
+        unpaid = users_unpaid_cycles_cost_statistics()
+
+        assert usage['labels'] == ['Ivan', 'Andrei', 'Georgi', 'User0', 'User1']
+        assert usage['datasets'][0]['data'] == [2, 0, 0, 2, 2]
+        assert usage['datasets'][1]['data'] == [2, 0, 0, 1, 1]
+        assert unpaid['datasets'][0]['data'] == [1.0, 0.0, 0.0, 0.9, 0.9]
+
+
+@pytest.mark.parametrize('users_count', [10, 100, 1000])
+def test_admin_statistics_query_count(app, users_count):
+    """ Benchmark of the queries made by the admin dashboard statistics, which must not grow with the users. """
+    with app.app_context():
+        add_users(users_count)
+
+        with count_queries() as statements:
+            admin_users_usage_statistics()
+            users_unpaid_cycles_cost_statistics()
+
+        assert len(statements) == 4
+
+
+def test_unpaid_cycles_cost(app):
+    """ Testing the unpaid cost at all, by user and for all users at once. """
+    with app.app_context():
+        now = datetime.datetime.now()
+        add_cycle(1, 1.00, now, split_user_ids=(3,))
+        add_cycle(2, 2.00, now)  # room owner
+        paid_cycle = add_cycle(3, 0.75, now, split_user_ids=(1, 2))
+        paid_cycle.paid = True
+        refresh_all_balances()
+        db.session.commit()
+
+        assert calculate_unpaid_cycles_cost() == decimal.Decimal('0.50')
+        assert calculate_unpaid_cycles_cost(db.session.get(User, 1)) == decimal.Decimal('0.75')
+        assert calculate_unpaid_cycles_cost_by_user([1, 2, 3]) == {
+            1: decimal.Decimal('0.75'), 2: decimal.Decimal('2.25'), 3: decimal.Decimal('0.50')
+        }
+
+
+def test_unpaid_cycles_cost_without_debts(app):
+    """ Testing that the unpaid cost returns early when nothing is unpaid. """
+    with app.app_context():
+        with count_queries() as statements:
+            assert calculate_unpaid_cycles_cost() == 0
+        assert len(statements) == 1
+
+
+def test_statistics_cache_invalidation(app):
+    """ Testing that cached statistics are served until cycles or the price per kWh are written. """
+    with app.app_context():
+        cache = get_statistics_cache()
+        user = db.session.get(User, 1)
+        calculate_monthly_statistics(user)
+        calculate_monthly_statistics(user)
+        assert cache.counters == {'hits': 1, 'misses': 1}
+
+        add_cycle(1, 0.46, datetime.datetime.now())
+        rebuild_rollups()
+        db.session.commit()
+        assert calculate_monthly_statistics(user)['data'][-1] == '0.46'
+        assert cache.counters == {'hits': 1, 'misses': 2}
+
+        # Writes unrelated to the statistics keep the cache
+        db.session.get(WashingMachine, 1).public_wash_cost = 12
+        db.session.commit()
+        calculate_monthly_statistics(user)
+        assert cache.counters == {'hits': 2, 'misses': 2}
+
+        db.session.get(WashingMachine, 1).costperkwh = 0.30
+        db.session.commit()
+        calculate_monthly_statistics(user)
+        assert cache.counters == {'hits': 2, 'misses': 3}
+
+
+def test_statistics_cache_invalidated_by_users(app):
+    """ Testing that the user listings of the admin statistics are recomputed after users or their roles change. """
+    with app.app_context():
+        cache = get_statistics_cache()
+        admin_users_usage_statistics()
+        user = db.session.get(User, 1)
+
+        user.last_login = datetime.datetime.now()
+        db.session.commit()
+        admin_users_usage_statistics()
+        assert cache.counters == {'hits': 1, 'misses': 1}
+
+        user.first_name = 'Ivo'
+        db.session.commit()
+        assert 'Ivo' in admin_users_usage_statistics()['labels']
+        assert cache.counters == {'hits': 1, 'misses': 2}
+
+        user.roles.append(Role.query.filter_by(name='admin').first())
+        db.session.commit()
+        admin_users_usage_statistics()
+        db.session.execute(roles_users.delete().where(roles_users.c.user_id == 1))
+        db.session.commit()
+        admin_users_usage_statistics()
+        assert cache.counters == {'hits': 1, 'misses': 4}
+
+
+class FakeRedis:
+    """ The commands of Redis used by the statistics cache, kept in a dict shared by all clients. """
+
+    def __init__(self, data: dict):
+        self.data = data
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+
+def test_statistics_cache_counters_shared(app, client):
+    """ Testing that the hit and miss counters of every worker are added up in Redis and shown to the admin. """
+    from unittest.mock import patch
+    from app.statistics import StatisticsCache
+    from tests.test_auth import login
+
+    data = {}
+    workers = [StatisticsCache(), StatisticsCache()]
+    with app.app_context(), patch.object(StatisticsCache, '_redis', lambda self: FakeRedis(data)):
+        workers[0].get_or_compute('key', lambda: 1)
+        workers[1].get_or_compute('key', lambda: 1)
+        workers[1].get_or_compute('other', lambda: 2)
+
+        assert workers[0].counters == workers[1].counters == {'hits': 1, 'misses': 2}
+
+        app.extensions['statistics_cache'] = workers[0]
+        login(client, app, 'georgi', 'password')
+        assert client.get('/api/statistics/cache').get_json() == {'hits': 1, 'misses': 2, 'version': 0}
@@ -0,0 +1,108 @@
+import datetime
+from unittest.mock import patch
+
+from app.db import db
+from app.models import User, CeleryTask, WashingCycle
+from app.functions import stop_cycle
+from app.tasks import (release_door_task, disable_guest_after_finish_task, recalculate_cycles_cost_task,
+                       schedule_notification_task)
+
+
+@patch.object(release_door_task, 'apply_async')
+@patch('app.tasks.trigger_relay', return_value=200)
+def test_release_door_chains_steps(mock_trigger_relay, mock_apply_async, app):
+    """ Testing that the release door flow schedules turning the relay off instead of sleeping. """
+    with app.app_context():
+        task = CeleryTask.start_release_door_task('ivan')
+        task_id = task.id
+        on_step_id = task.payload['step_task_id']
+        mock_apply_async.assert_called_once_with((task_id, 'on'), countdown=0, task_id=on_step_id)
+
+    release_door_task.apply((task_id, 'on'), task_id=on_step_id)
+
+    with app.app_context():
+        task = db.session.get(CeleryTask, task_id)
+        assert task.payload['step'] == 'relay_off'
+        off_step_id = task.payload['step_task_id']
+        mock_apply_async.assert_called_with((task_id, 'off'), countdown=30, task_id=off_step_id)
+
+    release_door_task.apply((task_id, 'off'), task_id=off_step_id)
+
+    mock_trigger_relay.assert_any_call('on')
+    mock_trigger_relay.assert_called_with('off')
+    with app.app_context():
+        assert db.session.get(CeleryTask, task_id) is None
+
+
+@patch.object(recalculate_cycles_cost_task, 'apply_async')
+@patch('app.tasks.recalculate_cycles_cost')
+def test_cancelled_recalculation_is_skipped(mock_recalculate, mock_apply_async, app):
+    """ Testing that deleting the pending step cancels the recalculation without revoking it. """
+    with app.app_context():
+        task = CeleryTask.start_recalculate_cycles_cost_task()
+        task_id, step_id = task.id, task.payload['step_task_id']
+        assert mock_apply_async.call_args[1]['countdown'] == 30 * 60
+        task.terminate()
+
+    recalculate_cycles_cost_task.apply((task_id,), task_id=step_id)
+
+    assert not mock_recalculate.called
+
+
+@patch.object(disable_guest_after_finish_task, 'apply_async')
+def test_disable_guest_after_grace_period(mock_apply_async, app):
+    """ Testing that the guest user is disabled by the scheduled step. """
+    with app.app_context():
+        task = CeleryTask.start_disable_guest_after_finish_task(1)
+        task_id, step_id = task.id, task.payload['step_task_id']
+        assert mock_apply_async.call_args[1]['countdown'] == 5 * 60
+
+    # A stale step from an earlier schedule must not act
+    disable_guest_after_finish_task.apply((task_id,), task_id='stale')
+    with app.app_context():
+        assert db.session.get(User, 1).active
+
+    disable_guest_after_finish_task.apply((task_id,), task_id=step_id)
+    with app.app_context():
+        assert not db.session.get(User, 1).active
+        assert db.session.get(CeleryTask, task_id) is None
+
+
+@patch('app.tasks.send_push_to_user', return_value=[True])
+@patch.object(schedule_notification_task, 'apply_async')
+def test_due_schedule_notification_is_sent(mock_apply_async, mock_send_push, app):
+    """ Testing that a reminder which is already due finds its task row when it runs right away. """
+    def run_now(args, eta, task_id):
+        # The worker does not see uncommitted rows
+        with db.engine.connect() as connection:
+            assert connection.execute(db.select(CeleryTask.id).where(CeleryTask.id == task_id)).scalar() == task_id
+        schedule_notification_task.apply(args, task_id=task_id)
+
+    mock_apply_async.side_effect = run_now
+    with app.app_context():
+        task = CeleryTask.start_schedule_notification_task(1, 1, datetime.datetime.now(), 'UTC')
+
+        assert mock_apply_async.call_args[1]['task_id'] == task.id
+        assert mock_send_push.call_count == 1
+
+
+@patch.object(disable_guest_after_finish_task, 'apply_async')
+@patch('app.functions.update_energy_consumption', return_value=14)
+@patch('app.functions.trigger_relay', return_value=200)
+@patch('app.functions.flash')
+def test_stop_cycle_keeps_guest_task(mock_flash, mock_trigger_relay, mock_update_consumption, mock_apply_async, app):
+    """ Testing that stopping a cycle cancels its own tasks, but not the guest task of the user with the same id. """
+    with app.test_request_context():
+        ivan = db.session.get(User, 1)
+        cycle = WashingCycle(user_id=ivan.id, startkwh=12, start_timestamp=datetime.datetime.now())
+        db.session.add(cycle)
+        db.session.commit()
+        guest_task_id = CeleryTask.start_disable_guest_after_finish_task(cycle.id).id
+        db.session.add(CeleryTask(id='cycle-task', kind=CeleryTask.TaskKinds.CYCLE_NOTIFICATION, ref_id=cycle.id,
+                                  user_id=ivan.id))
+        db.session.commit()
+
+        stop_cycle(ivan)
+
+        assert db.session.get(CeleryTask, guest_task_id) is not None
+        assert db.session.get(CeleryTask, 'cycle-task') is None
@@ -0,0 +1,101 @@
+import json
+from unittest.mock import Mock, patch
+
+from requests.exceptions import RequestException
+
+from app.telemetry import (TelemetryPoller, TelemetryDeltaEncoder, TELEMETRY_CHANNEL, TELEMETRY_LAST_KEY,
+                           TELEMETRY_PROTOCOL_VERSION)
+
+
+@patch('app.telemetry.CandyWashingMachine')
+@patch('app.telemetry.get_washer_info')
+def test_poller_publishes_merged_state(mock_get_washer_info, mock_candy_machine, app):
+    """ Testing that one poll samples both devices and publishes the merged state once. """
+    with app.app_context():
+        mock_get_washer_info.return_value = {'cycle_start': '2024-03-01T10:00:00+00:00', 'current_usage': 100}
+        mock_candy_machine.return_value.asdict.return_value = {'machine_state': {'code': 2, 'label': 'Running'}}
+        redis_client = Mock()
+
+        poller = TelemetryPoller(redis_client, interval=1, candy_interval=60)
+        state = poller.poll_once()
+
+        assert state['washer'] == {'cycle_start': '2024-03-01T10:00:00+00:00', 'current_usage': 100}
+        assert state['candy'] == {'machine_state': {'code': 2, 'label': 'Running'}}
+        redis_client.publish.assert_called_once_with(TELEMETRY_CHANNEL, json.dumps(state))
+        redis_client.set.assert_called_once_with(TELEMETRY_LAST_KEY, json.dumps(state))
+
+        # Candy is sampled on its own, slower schedule, and its last sample is repeated in between
+        state = poller.poll_once()
+        assert state['candy'] == {'machine_state': {'code': 2, 'label': 'Running'}}
+        assert mock_candy_machine.call_count == 1
+        assert not mock_candy_machine.return_value.update.called
+
+
+@patch('app.telemetry.CandyWashingMachine')
+@patch('app.telemetry.get_washer_info')
+def test_poller_survives_shelly_failure(mock_get_washer_info, mock_candy_machine, app):
+    """ Testing that a failing Shelly request still publishes the running time. """
+    with app.app_context():
+        mock_get_washer_info.side_effect = [RequestException('Shelly is down'), {'cycle_start': None}]
+        mock_candy_machine.return_value.asdict.return_value = {}
+        redis_client = Mock()
+
+        state = TelemetryPoller(redis_client).poll_once()
+
+        assert state['washer'] == {'cycle_start': None}
+        assert redis_client.publish.called
+
+
+def test_delta_encoder_sends_only_changes():
+    """ Testing that after the snapshot only changed fields are sent, with increasing sequence numbers. """
+    encoder = TelemetryDeltaEncoder(keyframe_interval=60)
+    state = {'cycle_start': '2024-03-01T10:00:00+00:00', 'current_usage': 100, 'relay_temperature': 40}
+
+    snapshot = json.loads(encoder.encode(state))
+    assert snapshot['v'] == TELEMETRY_PROTOCOL_VERSION
+    assert snapshot['type'] == 'snapshot'
+    assert snapshot['seq'] == 0
+    assert snapshot['data'] == state
+
+    assert encoder.encode(dict(state)) is None
+
+    delta = json.loads(encoder.encode({**state, 'current_usage': 250}))
+    assert delta['type'] == 'delta'
+    assert delta['seq'] == 1
+    assert delta['data'] == {'current_usage': 250}
+
+    delta = json.loads(encoder.encode({'cycle_start': None, 'current_usage': 250}))
+    assert delta['seq'] == 2
+    assert delta['data'] == {'cycle_start': None}
+    assert delta['removed'] == ['relay_temperature']
+
+
+def test_delta_encoder_repeats_keyframes():
+    """ Testing that a full snapshot is sent again once the keyframe interval passes. """
+    encoder = TelemetryDeltaEncoder(keyframe_interval=30)
+    encoder.encode({'current_usage': 100})
+
+    with patch('app.telemetry.time.monotonic', return_value=encoder.last_keyframe + 31):
+        keyframe = json.loads(encoder.encode({'current_usage': 100}))
+
+    assert keyframe['type'] == 'snapshot'
+    assert keyframe['seq'] == 1
+    assert keyframe['data'] == {'current_usage': 100}
+
+
+class StopPoller(BaseException):
+    pass
+
+
+def test_poller_survives_failing_tick(app):
+    """ Testing that an unexpected error in one tick is logged and the poller keeps running. """
+    with app.app_context():
+        poller = TelemetryPoller(Mock(), interval=1)
+        with patch.object(poller, 'poll_once', side_effect=[KeyError('meters'), {}, StopPoller()]) as mock_poll_once, \
+                patch('app.telemetry.time.sleep'):
+            try:
+                poller.run()
+            except StopPoller:
+                pass
+
+        assert mock_poll_once.call_count == 3
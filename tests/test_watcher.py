@@ -0,0 +1,110 @@
+import datetime
+from unittest.mock import patch
+
+import pytest
+
+from app.db import db
+from app.models import CeleryTask, cycle_ended_notification
+from app.candy import CandyMachineState
+from app.watcher import MachineWatcher, CYCLE_START_GRACE
+from app.tasks import machine_transition_task
+
+
+@patch('app.tasks.machine_transition_task')
+def test_watcher_dispatches_only_on_transitions(mock_transition_task, app):
+    """ Testing that handlers are dispatched once per subscription and only when the state changes. """
+    with app.app_context():
+        db.session.add(CeleryTask(id='subscription', kind=CeleryTask.TaskKinds.CYCLE_NOTIFICATION, user_id=1,
+                                  timestamp=datetime.datetime.now(datetime.timezone.utc) - CYCLE_START_GRACE))
+        db.session.add(CeleryTask(id='release', kind=CeleryTask.TaskKinds.RELEASE_DOOR))
+        db.session.commit()
+        watcher = MachineWatcher()
+
+        assert watcher.observe(CandyMachineState.IDLE) is False
+        assert watcher.observe(CandyMachineState.IDLE) is False
+        assert watcher.observe(CandyMachineState.RUNNING) is True
+
+        mock_transition_task.delay.assert_called_once_with(
+            'subscription', CandyMachineState.IDLE.code, CandyMachineState.RUNNING.code
+        )
+
+
+@patch('app.tasks.machine_transition_task')
+def test_watcher_retries_failed_dispatch(mock_transition_task, app):
+    """ Testing that a transition which could not be dispatched to every subscription is retried with the next sample. """
+    with app.app_context():
+        timestamp = datetime.datetime.now(datetime.timezone.utc) - CYCLE_START_GRACE
+        for subscription_id in ('first', 'second'):
+            db.session.add(CeleryTask(id=subscription_id, kind=CeleryTask.TaskKinds.CYCLE_NOTIFICATION, user_id=1,
+                                      timestamp=timestamp))
+        db.session.commit()
+        mock_transition_task.delay.side_effect = [None, ConnectionError('Broker is down')]
+        watcher = MachineWatcher(CandyMachineState.RUNNING)
+
+        with pytest.raises(ConnectionError):
+            watcher.observe(CandyMachineState.FINISHED1)
+
+        mock_transition_task.delay.side_effect = None
+        assert watcher.observe(CandyMachineState.FINISHED1) is False
+
+        transition = (CandyMachineState.RUNNING.code, CandyMachineState.FINISHED1.code)
+        assert sorted(call.args for call in mock_transition_task.delay.call_args_list) == \
+            [('first', *transition), ('second', *transition), ('second', *transition)]
+        assert watcher.pending == []
+
+
+@patch('app.tasks.machine_transition_task')
+def test_watcher_skips_cycles_in_start_grace(mock_transition_task, app):
+    """ Testing that cycles started less than the grace period ago are not notified about transitions. """
+    with app.app_context():
+        now = datetime.datetime.now(datetime.timezone.utc)
+        db.session.add(CeleryTask(id='new', kind=CeleryTask.TaskKinds.CYCLE_NOTIFICATION, user_id=1, timestamp=now))
+        db.session.add(CeleryTask(id='wash_then_dry', kind=CeleryTask.TaskKinds.WASH_THEN_DRY, user_id=1,
+                                  timestamp=now))
+        db.session.add(CeleryTask(id='old', kind=CeleryTask.TaskKinds.CYCLE_NOTIFICATION, user_id=2,
+                                  timestamp=now - CYCLE_START_GRACE - datetime.timedelta(minutes=1)))
+        db.session.commit()
+
+        watcher = MachineWatcher(CandyMachineState.RUNNING)
+        assert watcher.observe(CandyMachineState.FINISHED1) is True
+
+        dispatched = {call.args[0] for call in mock_transition_task.delay.call_args_list}
+        assert dispatched == {'wash_then_dry', 'old'}
+
+
+@patch('app.tasks.cycle_termination_reminder_task')
+@patch('app.tasks.send_push_to_user')
+def test_cycle_end_schedules_reminders(mock_send_push, mock_reminder_task, app):
+    """ Testing that the end of a program notifies the user and schedules termination reminders. """
+    with app.app_context():
+        db.session.add(CeleryTask(
+            id='subscription', kind=CeleryTask.TaskKinds.CYCLE_NOTIFICATION, user_id=1, ref_id=1,
+            payload={'terminate_cycle': False, 'finished_count': 0}
+        ))
+        db.session.commit()
+
+        machine_transition_task('subscription', CandyMachineState.RUNNING.code, CandyMachineState.FINISHED1.code)
+
+        assert mock_send_push.call_count == 1
+        assert mock_send_push.call_args[1]['notification'] == cycle_ended_notification
+        mock_reminder_task.apply_async.assert_called_once_with(('subscription', 1, 0), countdown=10 * 60)
+        assert db.session.get(CeleryTask, 'subscription').payload['finished_count'] == 1
+
+
+@patch('app.tasks.send_command')
+@patch('app.tasks.send_push_to_user')
+def test_wash_then_dry_starts_drying(mock_send_push, mock_send_command, app):
+    """ Testing that the drying program is started when the wash program ends. """
+    with app.app_context():
+        db.session.add(CeleryTask(
+            id='subscription', kind=CeleryTask.TaskKinds.WASH_THEN_DRY, user_id=1,
+            payload={'wash_command': 'wash', 'dry_command': 'dry', 'has_ran': False}
+        ))
+        db.session.commit()
+
+        machine_transition_task('subscription', CandyMachineState.IDLE.code, CandyMachineState.RUNNING.code)
+        assert not mock_send_command.called
+
+        machine_transition_task('subscription', CandyMachineState.RUNNING.code, CandyMachineState.FINISHED2.code)
+        mock_send_command.assert_called_once_with('dry')
+        assert db.session.get(CeleryTask, 'subscription') is None